@@ -0,0 +1,8 @@
+"""
+Benchmarks of the retrieval service with synthetic FHIR bundles.
+
+- generate.py: synthetic bundles at a configurable scale
+- run.py: reindex throughput, report latency and peak RSS of the service
+
+Author: Olli Puhakka
+"""
@@ -0,0 +1,287 @@
+#!/usr/bin/env python3
+
+"""
+Synthetic FHIR bundles for the benchmarks.
+
+The bundles are shaped like the Synthea bundles the indexer was written for and
+cover every resource type and variant index_fhir.parse_fhir handles: observations
+with a single value and with components, procedures with a performed time and
+period, care plans with one and several activities, the supported dosage
+instructions of medication requests and so on.
+
+The generated data is deterministic for a given seed.
+
+Usage:
+    python -m benchmark.generate <directory> [--patients 10] [--encounters 50] [--observations 5] [--seed 0]
+
+Author: Olli Puhakka
+"""
+import os
+import json
+import uuid
+import random
+import argparse
+import datetime
+
+GENDERS = ("female", "male")
+GIVEN_NAMES = ("Ann", "Bob", "Cecilia", "David", "Eva", "Frank", "Grace", "Henry")
+FAMILY_NAMES = ("Smith", "Virtanen", "Jones", "Korhonen", "Brown", "Nieminen")
+ENCOUNTER_TYPES = (
+    ("ambulatory", "General examination of patient (procedure)"),
+    ("ambulatory", "Encounter for check up (procedure)"),
+    ("outpatient", "Encounter for problem (procedure)"),
+    ("emergency", "Emergency room admission (procedure)"),
+    ("inpatient", "Hospital admission"),
+)
+REASONS = ("Hypertension", "Acute bronchitis (disorder)", "Fracture of forearm", "Viral sinusitis (disorder)")
+CONDITIONS = ("Hypertension", "Prediabetes", "Acute bronchitis (disorder)", "Viral sinusitis (disorder)", "Chronic sinusitis (disorder)")
+# Display, unit, typical value and spread of the single value observations
+OBSERVATIONS = (
+    ("Body Height", "cm", 170.0, 10.0),
+    ("Body Weight", "kg", 75.0, 15.0),
+    ("Body Mass Index", "kg/m2", 26.0, 4.0),
+    ("Heart rate", "/min", 72.0, 10.0),
+    ("Respiratory rate", "/min", 14.0, 2.0),
+    ("Glucose", "mg/dL", 95.0, 15.0),
+    ("Total Cholesterol", "mg/dL", 190.0, 30.0),
+)
+PROCEDURES = ("Standard pregnancy test", "Spirometry (procedure)", "Screening for occult blood", "Physical therapy")
+VACCINES = ("Influenza, seasonal, injectable, preservative free", "Td (adult) preservative free", "Hep B, adolescent or pediatric")
+CARE_PLAN_CATEGORIES = ("Respiratory therapy", "Diabetes self management plan", "Physical therapy procedure")
+ACTIVITIES = ("Recommendation to avoid exercise", "Deep breathing and coughing exercises", "Diabetic diet", "Exercise therapy")
+MEDICATIONS = ("Acetaminophen 325 MG Oral Tablet", "Amoxicillin 250 MG Oral Capsule", "Hydrochlorothiazide 25 MG Oral Tablet")
+ALLERGIES = (
+    ("food", "high", "Allergy to peanuts"),
+    ("food", "low", "Allergy to eggs"),
+    ("environment", "high", "Allergy to mould"),
+    ("environment", "low", "Allergy to grass pollen"),
+)
+
+
+def _reference(resource_id: str) -> dict:
+    return {"reference": f"urn:uuid:{resource_id}"}
+
+
+def _coding(display: str) -> dict:
+    return {"coding": [{"display": display}]}
+
+
+def _dosage_instruction(rng: random.Random) -> list[dict]:
+    """
+    One of the dosage instruction shapes supported by the indexer.
+    """
+    match rng.randrange(4):
+        case 0:
+            return []
+        case 1:
+            return [{"asNeededBoolean": True}]
+        case 2:
+            return [{"asNeededBoolean": False, "doseQuantity": {"value": 1},
+                     "timing": {"repeat": {"frequency": rng.randint(1, 3), "period": 1, "periodUnit": "d"}}}]
+        case _:
+            return [{"asNeededBoolean": False, "doseQuantity": {"value": 1},
+                     "timing": {"repeat": {"frequency": 1, "period": rng.choice((4, 6, 8)), "periodUnit": "h"}}}]
+
+
+def generate_bundle(encounters: int = 50, observations: int = 5, seed: int = 0) -> tuple[str, dict]:
+    """
+    Generate the FHIR bundle of one patient.
+
+    :param encounters: Number of encounters of the patient.
+    :param observations: Number of observations per encounter, one of them a blood pressure with components.
+    :param seed: Seed of the random data.
+    :return: Id of the patient and the bundle.
+    """
+    rng = random.Random(seed)
+
+    def new_id() -> str:
+        return str(uuid.UUID(int=rng.getrandbits(128), version=4))
+
+    patient_id = new_id()
+    birth = datetime.datetime(1940, 1, 1) + datetime.timedelta(days=rng.randrange(60 * 365))
+    timezone = datetime.timezone(datetime.timedelta(hours=rng.choice((-5, -4, 0, 2))))
+    patient = {
+        "resourceType": "Patient",
+        "id": patient_id,
+        "gender": rng.choice(GENDERS),
+        "birthDate": birth.date().isoformat(),
+        "name": [{"given": [rng.choice(GIVEN_NAMES)], "family": rng.choice(FAMILY_NAMES)}],
+    }
+    entries = [patient]
+
+    start = birth.replace(tzinfo=timezone) + datetime.timedelta(days=365)
+    step = max((datetime.datetime(2018, 1, 1, tzinfo=timezone) - start) / max(encounters, 1), datetime.timedelta(days=1))
+    time = start
+    for _ in range(encounters):
+        time += step * rng.uniform(0.5, 1.5)
+        time = time.replace(hour=rng.randint(7, 20), minute=rng.choice((0, 15, 30, 45)), second=0, microsecond=0)
+        class_, type_ = rng.choice(ENCOUNTER_TYPES)
+        end = time + datetime.timedelta(minutes=rng.choice((15, 30, 60, 120, 24 * 60)))
+        encounter_id = new_id()
+        encounter = {
+            "resourceType": "Encounter",
+            "id": encounter_id,
+            "status": "finished",
+            "class": {"code": class_},
+            "type": [{"text": type_}],
+            "patient": _reference(patient_id),
+            "period": {"start": time.isoformat(), "end": end.isoformat()},
+        }
+        if rng.random() < 0.4:
+            encounter["reason"] = _coding(rng.choice(REASONS))
+        entries.append(encounter)
+
+        condition_id = None
+        if rng.random() < 0.3:
+            condition_id = new_id()
+            condition = {
+                "resourceType": "Condition",
+                "id": condition_id,
+                "subject": _reference(patient_id),
+                "context": _reference(encounter_id),
+                "clinicalStatus": "active",
+                "verificationStatus": "confirmed",
+                "onsetDateTime": time.isoformat(),
+                "code": _coding(rng.choice(CONDITIONS)),
+            }
+            if rng.random() < 0.5:
+                condition["clinicalStatus"] = "resolved"
+                condition["abatementDateTime"] = (time + datetime.timedelta(days=rng.randint(7, 60))).isoformat()
+            entries.append(condition)
+
+        for i in range(observations):
+            observation = {
+                "resourceType": "Observation",
+                "id": new_id(),
+                "status": "final",
+                "subject": _reference(patient_id),
+                "encounter": _reference(encounter_id),
+                "effectiveDateTime": time.isoformat(),
+            }
+            if i == 0:
+                observation["code"] = _coding("Blood Pressure")
+                observation["component"] = [
+                    {"code": _coding("Systolic Blood Pressure"), "valueQuantity": {"value": round(rng.gauss(125, 12), 1), "unit": "mmHg"}},
+                    {"code": _coding("Diastolic Blood Pressure"), "valueQuantity": {"value": round(rng.gauss(80, 8), 1), "unit": "mmHg"}},
+                ]
+            else:
+                display, unit, mean, spread = OBSERVATIONS[(i - 1) % len(OBSERVATIONS)]
+                observation["code"] = _coding(display)
+                observation["valueQuantity"] = {"value": round(rng.gauss(mean, spread), 2), "unit": unit}
+            entries.append(observation)
+
+        if rng.random() < 0.3:
+            procedure = {
+                "resourceType": "Procedure",
+                "id": new_id(),
+                "subject": _reference(patient_id),
+                "encounter": _reference(encounter_id),
+                "status": "completed",
+                "code": _coding(rng.choice(PROCEDURES)),
+            }
+            if rng.random() < 0.5:
+                procedure["performedDateTime"] = time.isoformat()
+            else:
+                procedure["performedPeriod"] = {"start": time.isoformat(), "end": (time + datetime.timedelta(minutes=30)).isoformat()}
+            if condition_id is not None:
+                procedure["reasonReference"] = _reference(condition_id)
+            entries.append(procedure)
+
+        if rng.random() < 0.2:
+            entries.append({
+                "resourceType": "Immunization",
+                "id": new_id(),
+                "patient": _reference(patient_id),
+                "encounter": _reference(encounter_id),
+                "date": time.isoformat(),
+                "status": "completed",
+                "vaccineCode": _coding(rng.choice(VACCINES)),
+                "wasNotGiven": rng.random() < 0.1,
+                "primarySource": True,
+            })
+
+        if condition_id is not None and rng.random() < 0.5:
+            period = {"start": time.isoformat()}
+            if rng.random() < 0.5:
+                period["end"] = (time + datetime.timedelta(days=rng.randint(14, 90))).isoformat()
+            entries.append({
+                "resourceType": "CarePlan",
+                "id": new_id(),
+                "subject": _reference(patient_id),
+                "context": _reference(encounter_id),
+                "status": "completed" if "end" in period else "active",
+                "category": [_coding(rng.choice(CARE_PLAN_CATEGORIES))],
+                "period": period,
+                "activity": [
+                    {"detail": {"status": rng.choice(("in-progress", "completed")), "code": _coding(activity)}}
+                    for activity in rng.sample(ACTIVITIES, rng.randint(1, 3))
+                ],
+            })
+
+        if rng.random() < 0.3:
+            entries.append({
+                "resourceType": "MedicationRequest",
+                "id": new_id(),
+                "patient": _reference(patient_id),
+                "context": _reference(encounter_id),
+                "dateWritten": time.isoformat(),
+                "medicationCodeableConcept": _coding(rng.choice(MEDICATIONS)),
+                "dosageInstruction": _dosage_instruction(rng),
+            })
+
+        if rng.random() < 0.2:
+            entries.append({
+                "resourceType": "DiagnosticReport",
+                "id": new_id(),
+                "status": "final",
+                "subject": _reference(patient_id),
+                "encounter": _reference(encounter_id),
+                "effectiveDateTime": time.isoformat(),
+            })
+
+    for category, criticality, display in rng.sample(ALLERGIES, rng.randint(0, 2)):
+        entries.append({
+            "resourceType": "AllergyIntolerance",
+            "id": new_id(),
+            "patient": _reference(patient_id),
+            "assertedDate": (start + datetime.timedelta(days=rng.randrange(3650))).date().isoformat(),
+            "clinicalStatus": "active",
+            "verificationStatus": "confirmed",
+            "type": "allergy",
+            "category": [category],
+            "criticality": criticality,
+            "code": _coding(display),
+        })
+
+    return patient_id, {"resourceType": "Bundle", "type": "collection", "entry": [{"resource": entry} for entry in entries]}
+
+
+def write_bundles(directory: str, patients: int = 10, encounters: int = 50, observations: int = 5,
+                  seed: int = 0) -> list[str]:
+    """
+    Write the bundles of `patients` patients to <directory>/<patient_id>.json.
+
+    :return: Paths of the written bundles.
+    """
+    os.makedirs(directory, exist_ok=True)
+    paths = []
+    for i in range(patients):
+        patient_id, bundle = generate_bundle(encounters, observations, seed=seed * 1_000_003 + i)
+        path = os.path.join(directory, f"{patient_id}.json")
+        with open(path, 'w') as f:
+            json.dump(bundle, f)
+        paths.append(path)
+    return paths
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate synthetic FHIR bundles.")
+    parser.add_argument("directory", help="Directory the bundles are written to.")
+    parser.add_argument("--patients", type=int, default=10, help="Number of patients, one bundle per patient.")
+    parser.add_argument("--encounters", type=int, default=50, help="Encounters per patient.")
+    parser.add_argument("--observations", type=int, default=5, help="Observations per encounter.")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the random data.")
+    args = parser.parse_args()
+
+    for path in write_bundles(args.directory, args.patients, args.encounters, args.observations, args.seed):
+        print(path)
@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+
+"""
+Benchmark of the pure parse stage of the indexer, without the database.
+
+Synthetic bundles (see benchmark/generate.py) are decoded and transformed into rows
+by fhir_transform, the stage index_fhir.parse_fhir and the loader workers run
+before writing. The caches of the transform are cleared before each round, so
+every round starts cold like a new bundle would.
+
+Usage (from the repository root):
+    python -m benchmark.parse [--patients 20] [--encounters 50] [--observations 5] [--rounds 5]
+                              [--output parse-results.json]
+
+Author: Olli Puhakka
+"""
+import sys
+import json
+import time
+import argparse
+import datetime
+import platform
+
+from benchmark import generate
+from benchmark.run import RETRIEVAL_DIR, git_commit
+
+sys.path.insert(0, RETRIEVAL_DIR)
+import fhir_transform  # noqa: E402
+
+
+def clear_caches():
+    fhir_transform.datetime_from_isoformat.cache_clear()
+    fhir_transform.reference_id.cache_clear()
+
+
+def measure(bundles: list[bytes], rounds: int) -> dict:
+    """
+    Decode and transform the bundles `rounds` times, return the best round.
+    """
+    resources = sum(len(json.loads(bundle)['entry']) for bundle in bundles)
+    size = sum(len(bundle) for bundle in bundles)
+    decode = transform = float("inf")
+    rows = 0
+    for _ in range(rounds):
+        clear_caches()
+        started = time.perf_counter()
+        entries = [json.loads(bundle)['entry'] for bundle in bundles]
+        decoded = time.perf_counter()
+        rows = sum(sum(len(table_rows) for table_rows in fhir_transform.bundle_rows(entry).values()) for entry in entries)
+        transformed = time.perf_counter()
+        decode = min(decode, decoded - started)
+        transform = min(transform, transformed - decoded)
+    return {
+        "bundles": len(bundles),
+        "resources": resources,
+        "rows": rows,
+        "bytes": size,
+        "decode_s": round(decode, 4),
+        "transform_s": round(transform, 4),
+        "transform_resources_per_s": round(resources / transform),
+        "total_resources_per_s": round(resources / (decode + transform)),
+        "total_mb_per_s": round(size / (decode + transform) / 1e6, 2),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the parse stage of the indexer without the database.")
+    parser.add_argument("--patients", type=int, default=20, help="Number of generated patients.")
+    parser.add_argument("--encounters", type=int, default=50, help="Encounters per patient.")
+    parser.add_argument("--observations", type=int, default=5, help="Observations per encounter.")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the generated data.")
+    parser.add_argument("--rounds", type=int, default=5, help="Rounds measured, the best one is reported.")
+    parser.add_argument("--output", default="parse-results.json", help="File the results are written to.")
+    args = parser.parse_args()
+
+    bundles = [
+        json.dumps(generate.generate_bundle(args.encounters, args.observations, seed=args.seed * 1_000_003 + i)[1]).encode()
+        for i in range(args.patients)
+    ]
+    results = {
+        "commit": git_commit(),
+        "date": datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "config": {
+            "patients": args.patients,
+            "encounters": args.encounters,
+            "observations": args.observations,
+            "seed": args.seed,
+            "rounds": args.rounds,
+        },
+        "parse": measure(bundles, args.rounds),
+    }
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(json.dumps(results, indent=2))
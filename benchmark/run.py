@@ -0,0 +1,278 @@
+#!/usr/bin/env python3
+
+"""
+Benchmark of the ingestion and report paths of the retrieval service.
+
+The benchmark generates synthetic bundles (see benchmark/generate.py), starts the
+retrieval service against the database configured in the environment and measures:
+- /reindex throughput: bundles, resources and bytes indexed per second
+- /patient/{id}/report latency percentiles under concurrent load
+- peak RSS of the service process
+
+The results are written to a JSON file, so the results of two commits can be
+diffed. The database should be a local, disposable one: the generated patients
+are added to it.
+
+Usage (from the repository root, with the POSTGRES_* variables of .env set):
+    python -m benchmark.run [--patients 20] [--encounters 50] [--observations 5]
+                            [--concurrency 16] [--requests 500] [--output benchmark-results.json]
+
+Author: Olli Puhakka
+"""
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import datetime
+import platform
+import resource
+import tempfile
+import statistics
+import subprocess
+
+import httpx
+
+from benchmark import generate
+
+RETRIEVAL_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "retrieval")
+
+
+def percentiles(latencies: list[float]) -> dict:
+    """
+    Latency percentiles in milliseconds.
+    """
+    if len(latencies) < 2:
+        latencies = latencies * 2 or [0.0, 0.0]
+    cuts = statistics.quantiles(latencies, n=100, method="inclusive")
+    return {
+        "p50_ms": round(cuts[49] * 1000, 2),
+        "p95_ms": round(cuts[94] * 1000, 2),
+        "p99_ms": round(cuts[98] * 1000, 2),
+        "mean_ms": round(statistics.fmean(latencies) * 1000, 2),
+        "max_ms": round(max(latencies) * 1000, 2),
+    }
+
+
+def peak_rss_mb(pid: int) -> float | None:
+    """
+    Peak resident set size of the running process, None where /proc is not available.
+    """
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return round(int(line.split()[1]) / 1024, 1)
+    except OSError:
+        pass
+    return None
+
+
+class Service:
+    """
+    The retrieval service running in a subprocess for the duration of the benchmark.
+    """
+
+    def __init__(self, port: int, report_cache: bool, log: str):
+        self.port = port
+        self.url = f"http://127.0.0.1:{port}"
+        env = {
+            **os.environ,
+            "EMBED_ON_INGEST": "false",
+            # The report cache would measure the cache instead of rendering
+            "REPORT_CACHE_SIZE": os.environ.get("REPORT_CACHE_SIZE", "256") if report_cache else "0",
+            "REPORT_CACHE_DIR": os.environ.get("REPORT_CACHE_DIR", "") if report_cache else "",
+        }
+        self._log = open(log, 'w')
+        self.process = subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1", "--port", str(port), "--log-level", "warning"],
+            cwd=RETRIEVAL_DIR, env=env, stdout=self._log, stderr=subprocess.STDOUT,
+        )
+
+    def wait_ready(self, timeout: float = 60):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if self.process.poll() is not None:
+                raise RuntimeError(f"The service exited with code {self.process.returncode}, see the log")
+            try:
+                httpx.get(self.url, timeout=1).raise_for_status()
+                return
+            except httpx.HTTPError:
+                time.sleep(0.2)
+        raise RuntimeError(f"The service did not start in {timeout} seconds")
+
+    def stop(self) -> float | None:
+        """
+        Stop the service and return its peak RSS in MB.
+        """
+        rss = peak_rss_mb(self.process.pid)
+        self.process.terminate()
+        try:
+            self.process.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+            self.process.wait()
+        self._log.close()
+        if rss is None:
+            # Largest waited child, in KB on Linux and bytes on macOS
+            maxrss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+            rss = round(maxrss / (1024 * 1024 if platform.system() == "Darwin" else 1024), 1)
+        return rss
+
+
+async def reindex(client: httpx.AsyncClient, paths: list[str], concurrency: int) -> dict:
+    """
+    Post the bundles to /reindex and wait until all the jobs have finished.
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+    failed = []
+
+    async def index(path: str) -> dict:
+        async with semaphore:
+            with open(path, 'rb') as f:
+                body = f.read()
+            while True:
+                response = await client.post("/reindex", content=body, headers={"Content-Type": "application/json"})
+                if response.status_code != 503:
+                    break
+                # The job queue is full
+                await asyncio.sleep(0.5)
+            response.raise_for_status()
+            job_id = response.json()["job_id"]
+            while True:
+                job = (await client.get(f"/reindex/{job_id}")).json()
+                if job["status"] in ("finished", "failed"):
+                    break
+                await asyncio.sleep(0.05)
+            if job["status"] == "failed":
+                failed.append({"path": path, "error": job["error"]})
+            return job
+
+    started = time.perf_counter()
+    done = await asyncio.gather(*(index(path) for path in paths))
+    elapsed = time.perf_counter() - started
+    resources = sum(sum(job["resources"].values()) for job in done)
+    size = sum(job["bytes"] for job in done)
+    return {
+        "bundles": len(paths),
+        "resources": resources,
+        "bytes": size,
+        "failed": failed,
+        # Bundles already in the ingestion ledger of the database, e.g. of a previous run with the same seed
+        "unchanged": sum(1 for job in done if job.get("unchanged")),
+        "seconds": round(elapsed, 3),
+        "bundles_per_s": round(len(paths) / elapsed, 2),
+        "resources_per_s": round(resources / elapsed, 1),
+        "mb_per_s": round(size / elapsed / 1e6, 2),
+    }
+
+
+async def load_reports(client: httpx.AsyncClient, patient_ids: list[str], requests: int, concurrency: int,
+                       params: dict | None = None, seed: int = 0) -> dict:
+    """
+    Request the reports of random patients, `concurrency` requests at a time.
+    """
+    rng = random.Random(seed)
+    targets = [rng.choice(patient_ids) for _ in range(requests)]
+    latencies = []
+    errors = 0
+    size = 0
+
+    async def worker():
+        nonlocal errors, size
+        while targets:
+            patient_id = targets.pop()
+            started = time.perf_counter()
+            response = await client.get(f"/patient/{patient_id}/report", params=params)
+            body = response.content
+            latencies.append(time.perf_counter() - started)
+            if response.status_code != 200 or body.startswith(b'{"error"'):
+                errors += 1
+            size += len(body)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+    return {
+        "requests": requests,
+        "concurrency": concurrency,
+        "params": params or {},
+        "errors": errors,
+        "seconds": round(elapsed, 3),
+        "requests_per_s": round(requests / elapsed, 1),
+        "mean_bytes": round(size / max(requests, 1)),
+        **percentiles(latencies),
+    }
+
+
+def git_commit() -> str | None:
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=RETRIEVAL_DIR, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def run(args: argparse.Namespace, url: str) -> dict:
+    with tempfile.TemporaryDirectory(prefix="benchmark-") as directory:
+        paths = generate.write_bundles(directory, args.patients, args.encounters, args.observations, args.seed)
+        patient_ids = [os.path.basename(path).removesuffix(".json") for path in paths]
+        async with httpx.AsyncClient(base_url=url, timeout=args.timeout,
+                                     limits=httpx.Limits(max_connections=args.concurrency)) as client:
+            results = {"reindex": await reindex(client, paths, args.concurrency)}
+            # Warm up the connections of the service before measuring
+            await load_reports(client, patient_ids, min(args.concurrency, args.requests), args.concurrency, seed=args.seed)
+            results["report"] = await load_reports(client, patient_ids, args.requests, args.concurrency, seed=args.seed)
+            if args.max_tokens is not None:
+                results["budgeted_report"] = await load_reports(
+                    client, patient_ids, args.requests, args.concurrency, params={"max_tokens": args.max_tokens}, seed=args.seed,
+                )
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the ingestion and report paths of the retrieval service.")
+    parser.add_argument("--patients", type=int, default=20, help="Number of generated patients.")
+    parser.add_argument("--encounters", type=int, default=50, help="Encounters per patient.")
+    parser.add_argument("--observations", type=int, default=5, help="Observations per encounter.")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the generated data and the request order.")
+    parser.add_argument("--concurrency", type=int, default=16, help="Requests in flight at the same time.")
+    parser.add_argument("--requests", type=int, default=500, help="Number of report requests measured.")
+    parser.add_argument("--max-tokens", type=int, help="Also measure budgeted reports with this max_tokens.")
+    parser.add_argument("--report-cache", action="store_true", help="Keep the report cache of the service enabled.")
+    parser.add_argument("--url", help="Benchmark an already running service instead of starting one, RSS is not measured.")
+    parser.add_argument("--port", type=int, default=8765, help="Port of the started service.")
+    parser.add_argument("--timeout", type=float, default=120, help="Timeout of a request in seconds.")
+    parser.add_argument("--log", default=os.devnull, help="File the log of the started service is written to.")
+    parser.add_argument("--output", default="benchmark-results.json", help="File the results are written to.")
+    args = parser.parse_args()
+
+    service = None
+    if args.url is None:
+        service = Service(args.port, args.report_cache, args.log)
+    try:
+        if service is not None:
+            service.wait_ready()
+        results = asyncio.run(run(args, args.url or service.url))
+    finally:
+        rss = service.stop() if service is not None else None
+
+    results = {
+        "commit": git_commit(),
+        "date": datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "config": {
+            "patients": args.patients,
+            "encounters": args.encounters,
+            "observations": args.observations,
+            "seed": args.seed,
+            "concurrency": args.concurrency,
+            "report_cache": args.report_cache,
+        },
+        **results,
+        "service": {"peak_rss_mb": rss},
+    }
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(json.dumps(results, indent=2))
@@ -56,7 +56,11 @@ CREATE TABLE encounters (
     FOREIGN KEY (patient_id) REFERENCES patients(id)
 );
 
--- Create the observations table
+-- Create the observations table, partitioned by year if POSTGRES_PARTITION_OBSERVATIONS is on
+\set partition_observations `echo "${POSTGRES_PARTITION_OBSERVATIONS:-off}"`
+\if :partition_observations
+\ir partitioning/observations.sql
+\else
 CREATE TABLE observations (
     id UUID PRIMARY KEY,
     patient_id UUID NOT NULL,
@@ -69,6 +73,7 @@ CREATE TABLE observations (
     FOREIGN KEY (patient_id) REFERENCES patients(id),
     FOREIGN KEY (encounter_id) REFERENCES encounters(id)
 );
+\endif
 
 -- Create the conditions table
 CREATE TABLE conditions (
@@ -153,3 +158,36 @@ CREATE TABLE allergy_intolerances (
     FOREIGN KEY (patient_id) REFERENCES patients(id)
 );
 
+
+-- Schema migrations applied to the database, see retrieval/migrate.py
+CREATE TABLE schema_migrations (
+    version INTEGER PRIMARY KEY,
+    name TEXT NOT NULL,
+    applied_at TIMESTAMPTZ NOT NULL DEFAULT now()
+);
+
+-- Fresh databases get all the migrations right away
+\ir migrations/001_patient_access_indexes.sql
+INSERT INTO schema_migrations (version, name) VALUES (1, '001_patient_access_indexes');
+\ir migrations/002_patient_data_version.sql
+INSERT INTO schema_migrations (version, name) VALUES (2, '002_patient_data_version');
+\ir migrations/003_record_embeddings.sql
+INSERT INTO schema_migrations (version, name) VALUES (3, '003_record_embeddings');
+\ir migrations/004_embedding_cache.sql
+INSERT INTO schema_migrations (version, name) VALUES (4, '004_embedding_cache');
+\ir migrations/005_encounter_indexed_at.sql
+INSERT INTO schema_migrations (version, name) VALUES (5, '005_encounter_indexed_at');
+\ir migrations/006_patient_summary.sql
+INSERT INTO schema_migrations (version, name) VALUES (6, '006_patient_summary');
+\ir migrations/007_ingest_errors.sql
+INSERT INTO schema_migrations (version, name) VALUES (7, '007_ingest_errors');
+\ir migrations/008_ingestion_ledger.sql
+INSERT INTO schema_migrations (version, name) VALUES (8, '008_ingestion_ledger');
+\ir migrations/009_encounter_indexed_version.sql
+INSERT INTO schema_migrations (version, name) VALUES (9, '009_encounter_indexed_version');
+\ir migrations/010_encounter_first_observation.sql
+INSERT INTO schema_migrations (version, name) VALUES (10, '010_encounter_first_observation');
+\ir migrations/011_ingestion_duplicates.sql
+INSERT INTO schema_migrations (version, name) VALUES (11, '011_ingestion_duplicates');
+\ir migrations/012_drop_encounter_indexed_at.sql
+INSERT INTO schema_migrations (version, name) VALUES (12, '012_drop_encounter_indexed_at');
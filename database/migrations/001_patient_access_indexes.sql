@@ -0,0 +1,60 @@
+-- Indexes for the patient and encounter access paths of retrieval/patient.py.
+--
+-- Every accessor filters by patient_id, optionally by encounter_id, and orders
+-- by the date of the record, so the indexes lead with the same columns.
+-- Columns selected by the accessors are included where it allows index-only
+-- scans and the row is small; observations carry arrays and are not covered.
+
+-- Patient.encounters(): patient_id = ? ORDER BY period_start
+CREATE INDEX IF NOT EXISTS encounters_patient_period_idx
+    ON encounters (patient_id, period_start)
+    INCLUDE (id, class, type, period_end, reason_display);
+
+-- Patient.conditions(): patient_id = ? [AND encounter_id = ?] ORDER BY onset_date
+CREATE INDEX IF NOT EXISTS conditions_patient_onset_idx
+    ON conditions (patient_id, onset_date)
+    INCLUDE (id, encounter_id, clinical_status, verification_status, abatement_data, code_display);
+CREATE INDEX IF NOT EXISTS conditions_patient_encounter_onset_idx
+    ON conditions (patient_id, encounter_id, onset_date)
+    INCLUDE (id, clinical_status, verification_status, abatement_data, code_display);
+
+-- Patient.observations(): patient_id = ? [AND encounter_id = ?] ORDER BY observation_date
+CREATE INDEX IF NOT EXISTS observations_patient_date_idx
+    ON observations (patient_id, observation_date);
+CREATE INDEX IF NOT EXISTS observations_patient_encounter_date_idx
+    ON observations (patient_id, encounter_id, observation_date);
+
+-- Patient.procedures(): patient_id = ? [AND encounter_id = ?] [AND condition_id = ?] ORDER BY performed_date
+CREATE INDEX IF NOT EXISTS procedures_patient_performed_idx
+    ON procedures (patient_id, performed_date)
+    INCLUDE (encounter_id, condition_id, status, performed_date_end, code_display);
+CREATE INDEX IF NOT EXISTS procedures_patient_encounter_performed_idx
+    ON procedures (patient_id, encounter_id, performed_date)
+    INCLUDE (condition_id, status, performed_date_end, code_display);
+CREATE INDEX IF NOT EXISTS procedures_patient_condition_performed_idx
+    ON procedures (patient_id, condition_id, performed_date)
+    WHERE condition_id IS NOT NULL;
+
+-- Patient.care_plans(): patient_id = ? [AND encounter_id = ?] ORDER BY period_start_date
+CREATE INDEX IF NOT EXISTS care_plans_patient_start_idx
+    ON care_plans (patient_id, period_start_date)
+    INCLUDE (encounter_id, status, category_display, period_end_date, details);
+CREATE INDEX IF NOT EXISTS care_plans_patient_encounter_start_idx
+    ON care_plans (patient_id, encounter_id, period_start_date)
+    INCLUDE (status, category_display, period_end_date, details);
+
+-- Patient.immunizations(): patient_id = ? AND was_given IS TRUE [AND encounter_id = ?]
+CREATE INDEX IF NOT EXISTS immunizations_patient_encounter_given_idx
+    ON immunizations (patient_id, encounter_id)
+    INCLUDE (date, status, vaccine_display)
+    WHERE was_given IS TRUE;
+
+-- Patient.medications(): patient_id = ? [AND encounter_id = ?]
+CREATE INDEX IF NOT EXISTS medication_requests_patient_encounter_idx
+    ON medication_requests (patient_id, encounter_id)
+    INCLUDE (date_written, medication_display, dosage_instruction);
+
+-- Patient.allergies(): patient_id = ? AND type = 'allergy' [AND clinical_status = 'active'] ORDER BY asserted_date
+CREATE INDEX IF NOT EXISTS allergy_intolerances_patient_type_status_asserted_idx
+    ON allergy_intolerances (patient_id, type, clinical_status, asserted_date)
+    INCLUDE (category, criticality, display);
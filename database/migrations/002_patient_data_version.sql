@@ -0,0 +1,5 @@
+-- Per-patient data version, bumped by the indexer whenever it writes rows of the
+-- patient. Cached reports are keyed by the version, see retrieval/report_cache.py.
+ALTER TABLE patients
+    ADD COLUMN IF NOT EXISTS data_version BIGINT NOT NULL DEFAULT 0,
+    ADD COLUMN IF NOT EXISTS updated_at TIMESTAMPTZ NOT NULL DEFAULT now();
@@ -0,0 +1,26 @@
+-- Text embeddings of the indexed clinical records for semantic search (/search).
+-- The dimension must match the EMBEDDING_MODEL of the retrieval service,
+-- 384 for the default sentence-transformers/all-MiniLM-L6-v2.
+CREATE EXTENSION IF NOT EXISTS vector;
+
+CREATE TABLE IF NOT EXISTS record_embeddings (
+    id serial PRIMARY KEY,
+    patient_id UUID NOT NULL,
+    encounter_id UUID DEFAULT NULL,
+    resource_type TEXT NOT NULL,    -- 'Condition'
+    record_id TEXT NOT NULL,        -- id of the row in the table of the resource type
+    record_date TIMESTAMPTZ NOT NULL,
+    content TEXT NOT NULL,          -- 'Body Weight: 80.1 kg'
+    embedding vector(384) NOT NULL,
+    UNIQUE (resource_type, record_id),
+    FOREIGN KEY (patient_id) REFERENCES patients(id),
+    FOREIGN KEY (encounter_id) REFERENCES encounters(id)
+);
+
+-- Approximate nearest neighbour search over all records
+CREATE INDEX IF NOT EXISTS record_embeddings_embedding_idx
+    ON record_embeddings USING hnsw (embedding vector_cosine_ops);
+
+-- Searches filtered by patient and date
+CREATE INDEX IF NOT EXISTS record_embeddings_patient_type_date_idx
+    ON record_embeddings (patient_id, resource_type, record_date);
@@ -0,0 +1,7 @@
+-- Embeddings of the texts embedded so far, keyed by a hash of the model name and
+-- the text. Synthea repeats the same displays across millions of records, so
+-- each distinct text is encoded only once, across bundles and reindex runs.
+CREATE TABLE IF NOT EXISTS embedding_cache (
+    text_hash BYTEA PRIMARY KEY,    -- sha256(model || '\0' || text)
+    embedding vector(384) NOT NULL
+);
@@ -0,0 +1,7 @@
+-- Time each encounter was indexed. Incremental reports (since_version) only return
+-- the encounters indexed after the watermark of the previous report of the patient.
+ALTER TABLE encounters
+    ADD COLUMN IF NOT EXISTS indexed_at TIMESTAMPTZ NOT NULL DEFAULT now();
+
+CREATE INDEX IF NOT EXISTS encounters_patient_indexed_idx
+    ON encounters (patient_id, indexed_at);
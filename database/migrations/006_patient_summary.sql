@@ -0,0 +1,96 @@
+-- Precomputed summary of each patient, served by /patient/{id}/summary with one
+-- primary key lookup. The indexer refreshes the summaries of the patients it
+-- writes rows of, in the same transaction, with refresh_patient_summaries().
+CREATE TABLE IF NOT EXISTS patient_summary (
+    patient_id UUID PRIMARY KEY,
+    data_version BIGINT NOT NULL,
+    active_conditions JSONB NOT NULL,    -- [{"display": ..., "onset_date": ...}]
+    active_medications JSONB NOT NULL,   -- [{"display": ..., "dosage_instruction": ..., "date_written": ...}]
+    allergies JSONB NOT NULL,            -- {"food": [{"display": ..., "criticality": ...}]}
+    latest_observations JSONB NOT NULL,  -- [{"display": ..., "value": ..., "unit": ..., "date": ...}]
+    encounter_count INTEGER NOT NULL,
+    encounters_by_class JSONB NOT NULL,  -- {"ambulatory": 12, "emergency": 1}
+    first_encounter_at TIMESTAMPTZ,
+    last_encounter_at TIMESTAMPTZ,
+    refreshed_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+    FOREIGN KEY (patient_id) REFERENCES patients(id)
+);
+
+-- Medications don't have a status, the active ones are those prescribed within
+-- a year of the latest prescription of the patient.
+CREATE OR REPLACE FUNCTION refresh_patient_summaries(patient_ids UUID[]) RETURNS void
+LANGUAGE sql AS $$
+INSERT INTO patient_summary AS s (
+    patient_id, data_version, active_conditions, active_medications, allergies, latest_observations,
+    encounter_count, encounters_by_class, first_encounter_at, last_encounter_at, refreshed_at
+)
+SELECT
+    p.id,
+    p.data_version,
+    coalesce((
+        SELECT jsonb_agg(jsonb_build_object('display', c.code_display, 'onset_date', c.onset_date) ORDER BY c.onset_date)
+        FROM (
+            SELECT code_display, min(onset_date) onset_date FROM conditions
+            WHERE patient_id = p.id AND clinical_status = 'active' AND abatement_data IS NULL
+            GROUP BY code_display
+        ) c
+    ), '[]'),
+    coalesce((
+        SELECT jsonb_agg(jsonb_build_object('display', m.medication_display, 'dosage_instruction', m.dosage_instruction,
+                                            'date_written', m.date_written) ORDER BY m.date_written DESC)
+        FROM (
+            SELECT DISTINCT ON (medication_display) medication_display, dosage_instruction, date_written,
+                max(date_written) OVER () latest
+            FROM medication_requests WHERE patient_id = p.id
+            ORDER BY medication_display, date_written DESC
+        ) m
+        WHERE m.date_written >= m.latest - interval '1 year'
+    ), '[]'),
+    coalesce((
+        SELECT jsonb_object_agg(a.category, a.allergies)
+        FROM (
+            SELECT category, jsonb_agg(jsonb_build_object('display', display, 'criticality', criticality) ORDER BY asserted_date) allergies
+            FROM allergy_intolerances
+            WHERE patient_id = p.id AND type = 'allergy' AND clinical_status = 'active'
+            GROUP BY category
+        ) a
+    ), '{}'),
+    coalesce((
+        SELECT jsonb_agg(jsonb_build_object('display', o.display, 'value', o.value, 'unit', o.unit, 'date', o.observation_date) ORDER BY o.display)
+        FROM (
+            SELECT DISTINCT ON (x.display) x.display, x.value, x.unit, obs.observation_date
+            FROM observations obs, unnest(obs.display, obs.value, obs.unit) AS x(display, value, unit)
+            WHERE obs.patient_id = p.id
+            ORDER BY x.display, obs.observation_date DESC
+        ) o
+    ), '[]'),
+    e.encounter_count,
+    coalesce(e.encounters_by_class, '{}'),
+    e.first_encounter_at,
+    e.last_encounter_at,
+    now()
+FROM patients p
+CROSS JOIN LATERAL (
+    SELECT coalesce(sum(n), 0) encounter_count, jsonb_object_agg(class, n) encounters_by_class,
+        min(first_at) first_encounter_at, max(last_at) last_encounter_at
+    FROM (
+        SELECT class, count(*) n, min(period_start) first_at, max(period_start) last_at
+        FROM encounters WHERE patient_id = p.id GROUP BY class
+    ) by_class
+) e
+WHERE p.id = ANY(patient_ids)
+ON CONFLICT (patient_id) DO UPDATE SET
+    data_version = excluded.data_version,
+    active_conditions = excluded.active_conditions,
+    active_medications = excluded.active_medications,
+    allergies = excluded.allergies,
+    latest_observations = excluded.latest_observations,
+    encounter_count = excluded.encounter_count,
+    encounters_by_class = excluded.encounters_by_class,
+    first_encounter_at = excluded.first_encounter_at,
+    last_encounter_at = excluded.last_encounter_at,
+    refreshed_at = excluded.refreshed_at;
+$$;
+
+-- Summaries of the patients indexed before this migration
+SELECT refresh_patient_summaries(array_agg(id)) FROM patients;
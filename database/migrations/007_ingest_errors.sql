@@ -0,0 +1,16 @@
+-- Resources the indexer could not parse in tolerant mode (loader.py --tolerant,
+-- /reindex?tolerant=true). The raw resource is kept with the reason, so it can be
+-- indexed again once its shape is supported.
+CREATE TABLE IF NOT EXISTS ingest_errors (
+    id serial PRIMARY KEY,
+    patient_id UUID,                -- patient of the bundle, NULL if it wasn't parsed yet
+    resource_type TEXT,             -- 'Observation'
+    resource_id TEXT,
+    error_class TEXT NOT NULL,      -- 'NotImplementedError'
+    reason TEXT NOT NULL,           -- 'Observation not fully implemented yet!'
+    resource JSONB NOT NULL,
+    created_at TIMESTAMPTZ NOT NULL DEFAULT now()
+);
+
+-- Counting and reprocessing the errors per class
+CREATE INDEX IF NOT EXISTS ingest_errors_class_idx ON ingest_errors (resource_type, error_class);
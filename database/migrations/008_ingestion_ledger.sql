@@ -0,0 +1,33 @@
+-- Ingestion ledger: content hashes of the indexed bundles and resources. A bundle
+-- indexed before is skipped without parsing it, and of a changed bundle only the
+-- changed resources are written, see retrieval/index_fhir.py. Delete the rows to
+-- index the bundles again.
+CREATE TABLE IF NOT EXISTS ingested_bundles (
+    content_hash TEXT PRIMARY KEY,  -- sha256 of the bundle
+    patient_id UUID,
+    indexed_at TIMESTAMPTZ NOT NULL DEFAULT now()  -- first indexed
+);
+
+CREATE TABLE IF NOT EXISTS ingested_resources (
+    resource_type TEXT NOT NULL,    -- 'Observation'
+    resource_id TEXT NOT NULL,      -- id of the FHIR resource
+    patient_id UUID,
+    content_hash TEXT NOT NULL,     -- blake2b of the resource
+    indexed_at TIMESTAMPTZ NOT NULL DEFAULT now(), -- first indexed
+    PRIMARY KEY (resource_type, resource_id)
+);
+
+-- Ids of the FHIR resources of the tables with a serial key, the rows of changed
+-- resources are upserted by them. Rows indexed before this migration don't have one,
+-- see 011_ingestion_duplicates.sql.
+ALTER TABLE procedures ADD COLUMN IF NOT EXISTS fhir_id TEXT;
+ALTER TABLE immunizations ADD COLUMN IF NOT EXISTS fhir_id TEXT;
+ALTER TABLE care_plans ADD COLUMN IF NOT EXISTS fhir_id TEXT;
+ALTER TABLE medication_requests ADD COLUMN IF NOT EXISTS fhir_id TEXT;
+ALTER TABLE allergy_intolerances ADD COLUMN IF NOT EXISTS fhir_id TEXT;
+
+CREATE UNIQUE INDEX IF NOT EXISTS procedures_fhir_id_idx ON procedures (fhir_id);
+CREATE UNIQUE INDEX IF NOT EXISTS immunizations_fhir_id_idx ON immunizations (fhir_id);
+CREATE UNIQUE INDEX IF NOT EXISTS care_plans_fhir_id_idx ON care_plans (fhir_id);
+CREATE UNIQUE INDEX IF NOT EXISTS medication_requests_fhir_id_idx ON medication_requests (fhir_id);
+CREATE UNIQUE INDEX IF NOT EXISTS allergy_intolerances_fhir_id_idx ON allergy_intolerances (fhir_id);
@@ -0,0 +1,13 @@
+-- Data version of the patient in which the encounter or one of its records was last
+-- written. Incremental reports (since_version) return the encounters written after the
+-- data version of the previous report of the patient. The versions are bumped under the
+-- lock of the patient row, so unlike the transaction start times of indexed_at they
+-- follow the order the writes commit in.
+ALTER TABLE encounters
+    ADD COLUMN IF NOT EXISTS indexed_version BIGINT NOT NULL DEFAULT 0;
+
+-- The existing encounters count as written in the current version of their patient
+UPDATE encounters e SET indexed_version = p.data_version FROM patients p WHERE p.id = e.patient_id;
+
+CREATE INDEX IF NOT EXISTS encounters_patient_indexed_version_idx
+    ON encounters (patient_id, indexed_version);
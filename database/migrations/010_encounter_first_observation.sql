@@ -0,0 +1,11 @@
+-- Date of the earliest observation of each encounter, kept up to date by the indexer
+-- when it writes the encounter or its records. The observation queries of the reports
+-- are bounded by it, which lets Postgres skip the older rows and, with the observations
+-- partitioned by date, the older partitions. Observations may be dated before the start
+-- of their encounter, so the start itself can't be used as the bound.
+ALTER TABLE encounters
+    ADD COLUMN IF NOT EXISTS first_observation_at TIMESTAMPTZ;
+
+UPDATE encounters e SET first_observation_at = o.first_observation_at
+FROM (SELECT encounter_id, min(observation_date) first_observation_at FROM observations GROUP BY encounter_id) o
+WHERE o.encounter_id = e.id;
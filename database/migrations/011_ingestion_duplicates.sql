@@ -0,0 +1,53 @@
+-- The rows of the tables with a serial key indexed before 008_ingestion_ledger.sql have
+-- no fhir_id, so the upserts by fhir_id can't find them and index them again as new rows.
+-- The ids of their resources aren't stored anywhere, so instead the indexer deletes the
+-- rows without fhir_id of a patient with delete_legacy_records() when it writes the
+-- patient of a bundle, and the bundle writes them again with their fhir_id.
+CREATE OR REPLACE FUNCTION delete_legacy_records(patient_ids UUID[]) RETURNS void
+LANGUAGE sql AS $$
+WITH procedures AS (
+    DELETE FROM procedures WHERE patient_id = ANY(patient_ids) AND fhir_id IS NULL
+    RETURNING 'Procedure'::text resource_type, id::text record_id
+), immunizations AS (
+    DELETE FROM immunizations WHERE patient_id = ANY(patient_ids) AND fhir_id IS NULL
+    RETURNING 'Immunization'::text resource_type, id::text record_id
+), care_plans AS (
+    DELETE FROM care_plans WHERE patient_id = ANY(patient_ids) AND fhir_id IS NULL
+    RETURNING 'CarePlan'::text resource_type, id::text record_id
+), medication_requests AS (
+    DELETE FROM medication_requests WHERE patient_id = ANY(patient_ids) AND fhir_id IS NULL
+    RETURNING 'MedicationRequest'::text resource_type, id::text record_id
+), allergy_intolerances AS (
+    DELETE FROM allergy_intolerances WHERE patient_id = ANY(patient_ids) AND fhir_id IS NULL
+    RETURNING 'AllergyIntolerance'::text resource_type, id::text record_id
+), deleted AS (
+    SELECT * FROM procedures UNION ALL SELECT * FROM immunizations UNION ALL SELECT * FROM care_plans
+    UNION ALL SELECT * FROM medication_requests UNION ALL SELECT * FROM allergy_intolerances
+)
+DELETE FROM record_embeddings e USING deleted d
+WHERE e.resource_type = d.resource_type AND e.record_id = d.record_id;
+$$;
+
+-- The patients indexed again since 008 have both the old rows and the new ones with
+-- fhir_id, delete the old copies.
+CREATE OR REPLACE VIEW reindexed_patients AS
+SELECT patient_id FROM procedures WHERE fhir_id IS NOT NULL
+UNION SELECT patient_id FROM immunizations WHERE fhir_id IS NOT NULL
+UNION SELECT patient_id FROM care_plans WHERE fhir_id IS NOT NULL
+UNION SELECT patient_id FROM medication_requests WHERE fhir_id IS NOT NULL
+UNION SELECT patient_id FROM allergy_intolerances WHERE fhir_id IS NOT NULL;
+
+SELECT delete_legacy_records(array_agg(patient_id)) FROM reindexed_patients;
+SELECT refresh_patient_summaries(array_agg(patient_id)) FROM reindexed_patients;
+UPDATE patients SET data_version = data_version + 1, updated_at = now()
+WHERE id IN (SELECT patient_id FROM reindexed_patients);
+
+DROP VIEW reindexed_patients;
+
+-- Quarantined resources are upserted by the resource, so indexing a changed bundle
+-- again doesn't add them again. Keep the latest of the repeated ones.
+DELETE FROM ingest_errors e USING ingest_errors later
+WHERE later.patient_id = e.patient_id AND later.resource_type = e.resource_type
+    AND later.resource_id = e.resource_id AND later.id > e.id;
+
+CREATE UNIQUE INDEX IF NOT EXISTS ingest_errors_resource_idx ON ingest_errors (patient_id, resource_type, resource_id);
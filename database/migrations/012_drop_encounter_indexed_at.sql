@@ -0,0 +1,6 @@
+-- Incremental reports select the changed encounters by indexed_version since
+-- 009_encounter_indexed_version.sql, the indexed_at time of 005 isn't used anymore.
+DROP INDEX IF EXISTS encounters_patient_indexed_idx;
+
+ALTER TABLE encounters
+    DROP COLUMN IF EXISTS indexed_at;
@@ -0,0 +1,83 @@
+-- Observations partitioned by year of observation_date, an optional alternative to
+-- the plain table of create_database.sql for large databases. Reports of a recent
+-- window bound observation_date (see retrieval/patient.py), so Postgres only reads
+-- the partitions of the window instead of the whole history of the patient.
+--
+-- A fresh database gets it with POSTGRES_PARTITION_OBSERVATIONS=on when the database
+-- is created by create_database.sql.
+-- An existing database is converted with partition_observations.sql.
+--
+-- The primary key of a partitioned table must include the partition column, so the
+-- key is (id, observation_date). The indexer upserts on the name of the key, which
+-- is the same for both tables. An observation whose date changes in the source moves
+-- to its new date, as it's updated in place in the plain table: the old row is deleted
+-- by the move_observation trigger below when the row of the new date is written.
+CREATE TABLE observations (
+    id UUID NOT NULL,
+    patient_id UUID NOT NULL,
+    encounter_id UUID NOT NULL,
+    observation_date TIMESTAMPTZ NOT NULL,
+    status TEXT,     -- 'final'
+    display TEXT[] NOT NULL,
+    value NUMERIC(18,4)[],
+    unit TEXT[],
+    CONSTRAINT observations_pkey PRIMARY KEY (id, observation_date),
+    FOREIGN KEY (patient_id) REFERENCES patients(id),
+    FOREIGN KEY (encounter_id) REFERENCES encounters(id)
+) PARTITION BY RANGE (observation_date);
+
+-- Observations older than the yearly partitions
+CREATE TABLE observations_history PARTITION OF observations FOR VALUES FROM (MINVALUE) TO ('2010-01-01');
+-- Observations of the years without a partition yet
+CREATE TABLE observations_default PARTITION OF observations DEFAULT;
+
+-- Create the yearly partitions of the years first_year..last_year which don't exist
+-- yet, moving their rows out of the default partition. Run it ahead of each new year,
+-- e.g. SELECT create_observation_partitions(2027, 2027);
+CREATE OR REPLACE FUNCTION create_observation_partitions(first_year INTEGER, last_year INTEGER) RETURNS void
+LANGUAGE plpgsql AS $$
+DECLARE
+    partition TEXT;
+    low TEXT;
+    high TEXT;
+BEGIN
+    FOR year IN first_year..last_year LOOP
+        partition := format('observations_%s', year);
+        CONTINUE WHEN to_regclass(partition) IS NOT NULL;
+        low := format('%s-01-01', year);
+        high := format('%s-01-01', year + 1);
+        EXECUTE format('CREATE TABLE %I (LIKE observations INCLUDING DEFAULTS INCLUDING CONSTRAINTS)', partition);
+        EXECUTE format(
+            'WITH moved AS (DELETE FROM observations_default WHERE observation_date >= %L AND observation_date < %L RETURNING *) '
+            'INSERT INTO %I SELECT * FROM moved', low, high, partition);
+        EXECUTE format('ALTER TABLE observations ATTACH PARTITION %I FOR VALUES FROM (%L) TO (%L)', partition, low, high);
+    END LOOP;
+END $$;
+
+SELECT create_observation_partitions(2010, extract(year FROM now())::integer + 1);
+
+-- The current date of each observation, so that an observation written with another
+-- date is found by its key instead of probing every partition for the id.
+CREATE TABLE observation_dates (
+    id UUID PRIMARY KEY,
+    observation_date TIMESTAMPTZ NOT NULL
+);
+
+CREATE OR REPLACE FUNCTION move_observation() RETURNS trigger
+LANGUAGE plpgsql AS $$
+DECLARE
+    previous TIMESTAMPTZ;
+BEGIN
+    SELECT observation_date INTO previous FROM observation_dates WHERE id = NEW.id FOR UPDATE;
+    IF NOT FOUND THEN
+        INSERT INTO observation_dates (id, observation_date) VALUES (NEW.id, NEW.observation_date)
+        ON CONFLICT (id) DO NOTHING;
+    ELSIF previous <> NEW.observation_date THEN
+        DELETE FROM observations WHERE id = NEW.id AND observation_date = previous;
+        UPDATE observation_dates SET observation_date = NEW.observation_date WHERE id = NEW.id;
+    END IF;
+    RETURN NEW;
+END $$;
+
+CREATE TRIGGER observations_move BEFORE INSERT ON observations
+    FOR EACH ROW EXECUTE FUNCTION move_observation();
@@ -0,0 +1,26 @@
+-- Convert the observations table of an existing database into the partitioned table
+-- of observations.sql, keeping the rows. Run it as the owner of the tables while the
+-- indexer is stopped, the table is locked for the duration of the copy:
+--
+--     psql -d fhir -f database/partitioning/partition_observations.sql
+BEGIN;
+
+ALTER TABLE observations RENAME TO observations_unpartitioned;
+ALTER TABLE observations_unpartitioned RENAME CONSTRAINT observations_pkey TO observations_unpartitioned_pkey;
+DROP INDEX IF EXISTS observations_patient_date_idx;
+DROP INDEX IF EXISTS observations_patient_encounter_date_idx;
+
+\ir observations.sql
+
+INSERT INTO observations (id, patient_id, encounter_id, observation_date, status, display, value, unit)
+SELECT id, patient_id, encounter_id, observation_date, status, display, value, unit
+FROM observations_unpartitioned;
+
+DROP TABLE observations_unpartitioned;
+
+-- Recreate the indexes of the observations, the other ones exist already
+\ir ../migrations/001_patient_access_indexes.sql
+
+COMMIT;
+
+ANALYZE observations;
@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+
+"""
+Async database access for the endpoints of the retrieval service.
+
+Queries run on a psycopg 3 AsyncConnectionPool, so a request waiting for the
+database doesn't hold a thread and independent queries of one request can run
+concurrently on separate connections.
+
+Author: Olli Puhakka
+"""
+import os
+import asyncio
+import contextlib
+import time
+import logging
+from typing import AsyncIterator
+import psycopg
+import psycopg_pool
+
+import queries
+
+logger = logging.getLogger(__file__)
+
+_pool = None
+_pool_lock = asyncio.Lock()
+
+
+async def get_pool() -> psycopg_pool.AsyncConnectionPool:
+    """
+    Return the process wide async connection pool, opening it on first use.
+
+    The pool uses the same settings as database.get_pool():
+    - POSTGRES_POOL_MIN: connections opened up front (default 1)
+    - POSTGRES_POOL_MAX: maximum number of connections (default 10)
+    - POSTGRES_POOL_TIMEOUT: seconds to wait for a free connection (default 30)
+    """
+    global _pool
+    async with _pool_lock:
+        if _pool is None or _pool.closed:
+            pool = psycopg_pool.AsyncConnectionPool(
+                min_size = int(os.environ.get('POSTGRES_POOL_MIN', 1)),
+                max_size = int(os.environ.get('POSTGRES_POOL_MAX', 10)),
+                timeout  = float(os.environ.get('POSTGRES_POOL_TIMEOUT', 30)),
+                kwargs   = {
+                    "host":     os.environ['POSTGRES_HOST'],
+                    "port":     os.environ['POSTGRES_PORT'],
+                    "dbname":   os.environ['POSTGRES_DB'],
+                    "user":     os.environ['POSTGRES_TOOL_USER'],
+                    "password": os.environ['POSTGRES_TOOL_PASSWORD'],
+                },
+                open = False,
+            )
+            await pool.open()
+            _pool = pool
+        return _pool
+
+
+async def close_pool():
+    """
+    Close the async connection pool, if it was opened.
+    """
+    global _pool
+    async with _pool_lock:
+        if _pool is not None:
+            await _pool.close()
+            _pool = None
+
+
+class AsyncDatabase:
+
+    @contextlib.asynccontextmanager
+    async def connection(self):
+        """
+        Check out a pooled connection for several queries in one transaction,
+        e.g. for reading server side cursors.
+        """
+        pool = await get_pool()
+        async with pool.connection() as conn:
+            yield conn
+
+    async def db_execute(self, query: str, data: tuple) -> list[tuple]:
+        """
+        Execute the query with data.
+
+        The query runs in its own transaction on a pooled connection. If the
+        connection turns out to be closed, the query is retried once on a new one.
+        Statements of the query registry run as prepared statements.
+
+        :param query: SQL query to execute, a string or a queries.query().
+        :param data: Data to pass to the query.
+        :return: List of tuples containing the results of the query.
+        """
+        pool = await get_pool()
+        for attempt in range(2):
+            async with pool.connection() as conn:
+                try:
+                    async with conn.cursor() as curs:
+                        # Registry statements are prepared on each connection by the driver
+                        started = time.perf_counter()
+                        await curs.execute(query, data, prepare=isinstance(query, queries.Query) or None)
+                        queries.record(query, time.perf_counter() - started, max(curs.rowcount, 0))
+                        return await curs.fetchall() if curs.description is not None else []
+                except psycopg.OperationalError:
+                    # Retry only if the connection itself was lost, the pool replaces broken connections
+                    if not conn.broken or attempt > 0:
+                        raise
+                    logger.warning("Database connection lost, retrying with a new connection")
+
+    async def db_iterate(self, query: str, data: tuple, itersize: int = 2000) -> AsyncIterator[tuple]:
+        """
+        Execute the query and iterate over the results from a server side cursor,
+        fetching `itersize` rows at a time like Database.db_iterate.
+        """
+        async with self.connection() as conn:
+            async with conn.cursor(name="db_iterate") as curs:
+                curs.itersize = itersize
+                await curs.execute(query, data)
+                async for row in curs:
+                    yield row
@@ -1,59 +1,266 @@
 #!/usr/bin/env python3
 
 import os
+import time
+import threading
+import contextlib
+import collections
+from typing import Iterator
 import psycopg2
+import psycopg2.pool
+import psycopg2.extensions
 import logging
-logging.basicConfig(level=logging.DEBUG)
+
+import queries
+
 logger = logging.getLogger(__file__)
 
 
+class PoolTimeout(psycopg2.pool.PoolError):
+    """
+    Raised when no connection could be checked out from the pool in time.
+    """
+
+
+class _Connection(psycopg2.extensions.connection):
+    """
+    Connection which keeps track of the registry statements prepared on it.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared = {}  # Query.key -> EXECUTE statement
+
+
+def execute(curs, query: str, data: tuple):
+    """
+    Execute the query on the cursor.
+
+    Statements of the query registry are prepared on the connection on first use
+    and then executed by name. All the executions are recorded in the registry.
+    """
+    started = time.perf_counter()
+    if not isinstance(query, queries.Query):
+        curs.execute(query, data)
+        queries.record(query, time.perf_counter() - started, max(curs.rowcount, 0))
+        return
+    prepared = curs.connection.prepared
+    statement = prepared.get(query.key)
+    if statement is None:
+        curs.execute(f"PREPARE {query.key} AS {query.positional()}")
+        # The arguments are cast to the parameter types, psycopg2 sends e.g. lists of uuids as text[]
+        curs.execute("SELECT parameter_types::text[] FROM pg_prepared_statements WHERE name = %s", (query.key,))
+        types = curs.fetchone()[0]
+        statement = f"EXECUTE {query.key}" + (f" ({', '.join(f'%s::{t}' for t in types)})" if types else "")
+        prepared[query.key] = statement
+    curs.execute(statement, data)
+    queries.record(query, time.perf_counter() - started, max(curs.rowcount, 0))
+
+
+class ConnectionPool:
+    """
+    Thread-safe pool of PostgreSQL connections.
+
+    - At most `maxconn` connections are checked out at the same time, other threads
+      wait for a free connection up to `timeout` seconds.
+    - Idle connections are kept open for reuse, `minconn` of them are opened up front.
+    - Connections which have been idle longer than `check_interval` seconds are
+      health checked on checkout and replaced by a new connection if they are broken.
+    """
+
+    def __init__(self, minconn: int, maxconn: int, timeout: float, check_interval: float, **connect_kwargs):
+        if minconn < 0 or maxconn < 1 or minconn > maxconn:
+            raise ValueError(f"Invalid pool size: min {minconn}, max {maxconn}")
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.timeout = timeout
+        self.check_interval = check_interval
+        self._connect_kwargs = connect_kwargs
+        self._slots = threading.BoundedSemaphore(maxconn)
+        self._lock = threading.Lock()
+        self._idle = collections.deque()  # (connection, returned_at)
+        self._closed = False
+        for _ in range(minconn):
+            self._idle.append((self._connect(), time.monotonic()))
+
+    def _connect(self):
+        logger.debug("Opening a new database connection")
+        return psycopg2.connect(connection_factory=_Connection, **self._connect_kwargs)
+
+    @staticmethod
+    def _is_healthy(conn) -> bool:
+        """
+        Check that the connection is still usable by running a trivial query.
+        """
+        try:
+            with conn.cursor() as curs:
+                curs.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def getconn(self):
+        """
+        Check out a connection from the pool.
+
+        Waits up to `timeout` seconds for a free connection and raises PoolTimeout
+        if none becomes available.
+        """
+        if self._closed:
+            raise psycopg2.pool.PoolError("Connection pool is closed")
+        if not self._slots.acquire(timeout=self.timeout):
+            raise PoolTimeout(f"No free database connection in {self.timeout} seconds (max {self.maxconn})")
+        try:
+            while True:
+                with self._lock:
+                    conn, returned_at = self._idle.pop() if self._idle else (None, None)
+                if conn is None:
+                    return self._connect()
+                if conn.closed:
+                    continue
+                if time.monotonic() - returned_at >= self.check_interval and not self._is_healthy(conn):
+                    logger.warning("Discarding broken database connection")
+                    self._close(conn)
+                    continue
+                return conn
+        except BaseException:
+            self._slots.release()
+            raise
+
+    def putconn(self, conn):
+        """
+        Return a checked out connection to the pool.
+
+        Broken connections and connections left in a failed state are closed instead.
+        """
+        try:
+            if self._closed or conn.closed:
+                self._close(conn)
+                return
+            status = conn.info.transaction_status
+            if status == psycopg2.extensions.TRANSACTION_STATUS_UNKNOWN:
+                self._close(conn)
+                return
+            if status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                try:
+                    conn.rollback()
+                except psycopg2.Error:
+                    self._close(conn)
+                    return
+            with self._lock:
+                self._idle.append((conn, time.monotonic()))
+        finally:
+            self._slots.release()
+
+    @contextlib.contextmanager
+    def connection(self):
+        """
+        Context manager which checks out a connection and returns it to the pool afterwards.
+        """
+        conn = self.getconn()
+        try:
+            yield conn
+        finally:
+            self.putconn(conn)
+
+    @staticmethod
+    def _close(conn):
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
+
+    def closeall(self):
+        """
+        Close all idle connections and refuse new checkouts.
+        """
+        self._closed = True
+        with self._lock:
+            while self._idle:
+                self._close(self._idle.pop()[0])
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool() -> ConnectionPool:
+    """
+    Return the process wide connection pool, creating it on first use.
+
+    Pool settings are read from the environment:
+    - POSTGRES_POOL_MIN: connections opened up front (default 1)
+    - POSTGRES_POOL_MAX: maximum number of connections (default 10)
+    - POSTGRES_POOL_TIMEOUT: seconds to wait for a free connection (default 30)
+    - POSTGRES_POOL_CHECK_INTERVAL: idle seconds after which a connection is
+      health checked on checkout (default 30)
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is None or _pool._closed:
+            _pool = ConnectionPool(
+                minconn        = int(os.environ.get('POSTGRES_POOL_MIN', 1)),
+                maxconn        = int(os.environ.get('POSTGRES_POOL_MAX', 10)),
+                timeout        = float(os.environ.get('POSTGRES_POOL_TIMEOUT', 30)),
+                check_interval = float(os.environ.get('POSTGRES_POOL_CHECK_INTERVAL', 30)),
+                host     = os.environ['POSTGRES_HOST'],
+                port     = os.environ['POSTGRES_PORT'],
+                database = os.environ['POSTGRES_DB'],
+                user     = os.environ['POSTGRES_TOOL_USER'],
+                password = os.environ['POSTGRES_TOOL_PASSWORD'],
+            )
+        return _pool
+
+
 class Database:
-    database_connection = None
 
     def __init__(self):
         """
-        Initializes the database connection.
+        Initializes the database access using the shared connection pool.
         """
-        if self.database_connection is None:
-            self.__init_database__()
-
-    @classmethod
-    def __init_database__(cls):
-        cls.database_connection = psycopg2.connect(
-            host     = os.environ['POSTGRES_HOST'],
-            port     = os.environ['POSTGRES_PORT'],
-            database = os.environ['POSTGRES_DB'],
-            user     = os.environ['POSTGRES_TOOL_USER'],
-            password = os.environ['POSTGRES_TOOL_PASSWORD'],
-        )
-        return cls.database_connection
+        self.pool = get_pool()
 
     def db_execute(self, query: str, data: tuple) -> list[tuple]:
         """
         Execute the query with data.
 
-        :param query: SQL query to execute.
+        The query runs in its own transaction on a pooled connection. If the
+        connection turns out to be closed, the query is retried once on a new one.
+        Statements of the query registry run as prepared statements.
+
+        :param query: SQL query to execute, a string or a queries.query().
         :param data: Data to pass to the query.
         :return: List of tuples containing the results of the query.
         """
-        try:
-            with self.database_connection:
-                with self.database_connection.cursor() as curs:
-                    curs.execute(query, data)
-                    return curs.fetchall()
-        except psycopg2.InterfaceError as e:
-            # connection already closed ?
-            # Reinitialize connection and try again
-            self.__init_database__()
-            with self.database_connection:
-                with self.database_connection.cursor() as curs:
-                    curs.execute(query, data)
-                    return curs.fetchall()
-
-
+        for attempt in range(2):
+            with self.pool.connection() as conn:
+                try:
+                    with conn:
+                        with conn.cursor() as curs:
+                            execute(curs, query, data)
+                            return curs.fetchall() if curs.description is not None else []
+                except (psycopg2.InterfaceError, psycopg2.OperationalError):
+                    # Retry only if the connection itself was lost
+                    if not conn.closed or attempt > 0:
+                        raise
+                    logger.warning("Database connection lost, retrying with a new connection")
 
+    def db_iterate(self, query: str, data: tuple, itersize: int = 2000) -> Iterator[tuple]:
+        """
+        Execute the query and iterate over the results from a server side cursor.
 
+        The rows are fetched `itersize` at a time, so the results are never all in
+        memory. The pooled connection is held until the iteration ends or the
+        generator is closed.
 
-if __name__ == "__main__":
-    # Test the module
-    pass
+        :param query: SQL query to execute.
+        :param data: Data to pass to the query.
+        :param itersize: Rows fetched per round trip.
+        """
+        with self.pool.connection() as conn:
+            with conn:
+                with conn.cursor(name="db_iterate") as curs:
+                    curs.itersize = itersize
+                    curs.execute(query, data)
+                    yield from curs
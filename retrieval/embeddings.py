@@ -0,0 +1,255 @@
+#!/usr/bin/env python3
+
+"""
+Text embeddings of the indexed clinical records and semantic search over them.
+
+Conditions, observations, procedures, medications and care plans are embedded
+with the sentence-transformers EMBEDDING_MODEL and stored in the pgvector
+table record_embeddings, which is searched by /search.
+
+Usage (embed all the records which have no embedding yet):
+    python embeddings.py [--patient <patient_id> ...]
+
+Author: Olli Puhakka
+"""
+import os
+import hashlib
+import argparse
+import threading
+import datetime
+import logging
+import psycopg2.extras
+
+import database
+import metrics
+
+logger = logging.getLogger(__file__)
+
+# Records per resource type as (patient_id, encounter_id, record_id, record_date, content, text).
+# The content is returned in search results and the text is what gets embedded.
+RECORD_QUERIES = {
+    "Condition": """SELECT patient_id, encounter_id, id::text record_id, onset_date record_date,
+        code_display || ' (' || clinical_status || ')' content,
+        code_display text
+        FROM conditions""",
+    "Observation": """SELECT patient_id, encounter_id, id::text record_id, observation_date record_date,
+        coalesce((SELECT string_agg(coalesce(d, '') || ': ' || coalesce(trim_scale(v)::text, '') || coalesce(' ' || u, ''), ', ')
+         FROM unnest(display, value, unit) AS x(d, v, u)), '') content,
+        array_to_string(display, ', ') text
+        FROM observations""",
+    "Procedure": """SELECT patient_id, encounter_id, id::text record_id, performed_date record_date,
+        code_display content,
+        code_display text
+        FROM procedures""",
+    "MedicationRequest": """SELECT patient_id, encounter_id, id::text record_id, date_written record_date,
+        medication_display || coalesce(' (' || dosage_instruction || ')', '') content,
+        medication_display text
+        FROM medication_requests""",
+    "CarePlan": """SELECT patient_id, encounter_id, id::text record_id, period_start_date record_date,
+        category_display || ': ' || details || ' (' || status || ')' content,
+        category_display || ': ' || details text
+        FROM care_plans""",
+}
+
+# Candidates searched from the HNSW index per result when the search is filtered
+FILTERED_EF_SEARCH_FACTOR = 20
+
+_model = None
+_model_lock = threading.Lock()
+
+
+def get_model():
+    """
+    Return the embedding model, loading it on first use.
+    """
+    global _model
+    with _model_lock:
+        if _model is None:
+            # Imported here, loading torch takes seconds and most processes never embed anything
+            from sentence_transformers import SentenceTransformer
+            _model = SentenceTransformer(model_name())
+        return _model
+
+
+def model_name() -> str:
+    return os.environ.get('EMBEDDING_MODEL', 'sentence-transformers/all-MiniLM-L6-v2')
+
+
+def to_vector(embedding) -> str:
+    """
+    Format the embedding as a pgvector literal: '[0.1,0.2,...]'
+    """
+    return "[" + ",".join(str(float(value)) for value in embedding) + "]"
+
+
+def embed(texts: list[str]) -> list[str]:
+    """
+    Embed the texts and return the embeddings as pgvector literals.
+    """
+    embeddings = get_model().encode(
+        texts,
+        batch_size=int(os.environ.get('EMBEDDING_BATCH_SIZE', 256)),
+        normalize_embeddings=True,
+    )
+    return [to_vector(embedding) for embedding in embeddings]
+
+
+def text_hash(text: str) -> bytes:
+    """
+    Hash identifying the embedding of the text with the current model.
+    """
+    return hashlib.sha256(f"{model_name()}\0{text}".encode()).digest()
+
+
+def cache_embeddings(texts: list[str], db: database.Database) -> dict[str, bytes]:
+    """
+    Make sure the embedding cache has the embeddings of the texts.
+
+    The texts are deduplicated and only the texts which have never been embedded
+    before are encoded, all of them in one batched call to the model.
+
+    :return: Hash of each text, the key of its embedding in embedding_cache.
+    """
+    hashes = {text: text_hash(text) for text in set(texts)}
+    result = db.db_execute("SELECT text_hash FROM embedding_cache WHERE text_hash = ANY(%s)", (list(hashes.values()),))
+    cached = {bytes(row[0]) for row in result}
+    missing = [text for text, hash in hashes.items() if hash not in cached]
+    if missing:
+        vectors = embed(missing)
+        with db.pool.connection() as conn:
+            with conn:
+                with conn.cursor() as curs:
+                    psycopg2.extras.execute_values(
+                        curs,
+                        "INSERT INTO embedding_cache (text_hash, embedding) VALUES %s ON CONFLICT DO NOTHING",
+                        [(hashes[text], vector) for text, vector in zip(missing, vectors)],
+                        template="(%s, %s::vector)",
+                    )
+    logger.debug(f"Embedded {len(missing)} new texts, {len(hashes) - len(missing)} cached, {len(texts)} records")
+    return hashes
+
+
+def index_records(patient_ids: list[str] | None = None, batch_size: int = 4096, db: database.Database = None) -> int:
+    """
+    Embed the records which don't have an embedding yet.
+
+    The embeddings come from the embedding cache, so only texts never seen before
+    are encoded by the model.
+
+    :param patient_ids: Only embed the records of these patients, all patients if None.
+    :param batch_size: Number of records embedded and written at a time.
+    :return: Number of records embedded.
+    """
+    if db is None:
+        db = database.Database()
+    count = 0
+    for resource_type, records_query in RECORD_QUERIES.items():
+        _where = ["NOT EXISTS (SELECT 1 FROM record_embeddings e WHERE e.resource_type = %s AND e.record_id = r.record_id)"]
+        data = (resource_type,)
+        if patient_ids is not None:
+            _where.append("r.patient_id = ANY(%s::uuid[])")
+            data = (*data, list(patient_ids),)
+        _where = " AND ".join(_where)
+        query = f"SELECT r.* FROM ({records_query}) r WHERE {_where} LIMIT {int(batch_size)}"
+        while True:
+            records = db.db_execute(query, data)
+            if not records:
+                break
+            hashes = cache_embeddings([record[5] for record in records], db)
+            with db.pool.connection() as conn:
+                with conn:
+                    with conn.cursor() as curs:
+                        # The vectors are copied from the cache inside the database
+                        psycopg2.extras.execute_values(
+                            curs,
+                            """INSERT INTO record_embeddings (patient_id, encounter_id, resource_type, record_id, record_date, content, embedding)
+                            SELECT r.patient_id, r.encounter_id, r.resource_type, r.record_id, r.record_date, r.content, c.embedding
+                            FROM (VALUES %s) r (patient_id, encounter_id, resource_type, record_id, record_date, content, text_hash)
+                            JOIN embedding_cache c ON c.text_hash = r.text_hash
+                            ON CONFLICT DO NOTHING""",
+                            [(*record[:2], resource_type, *record[2:5], hashes[record[5]]) for record in records],
+                            template="(%s::uuid, %s::uuid, %s, %s, %s::timestamptz, %s, %s::bytea)",
+                            page_size=len(records),
+                        )
+                        written = curs.rowcount
+            count += written
+            logger.debug(f"Embedded {written} {resource_type} records")
+            if written < len(records):
+                # The records left out would be selected again forever, e.g. when
+                # their cache entries are missing or the rows were written meanwhile
+                logger.warning(f"Embedded only {written} of {len(records)} {resource_type} records, stopping")
+                break
+    return count
+
+
+def search(query: str, resource_types: list[str] | None = None, patient_id: str | None = None,
+           date_from: datetime.datetime | None = None, date_to: datetime.datetime | None = None,
+           limit: int = 10) -> list[dict]:
+    """
+    Find the records semantically closest to the query.
+
+    :param resource_types: Only search these resource types, all if None.
+    :param patient_id: Only search the records of the patient.
+    :param date_from: Only search records from this date on.
+    :param date_to: Only search records until this date.
+    :return: Matching records ordered by cosine similarity, best first.
+    """
+    vector = embed([query])[0]
+    _where = ["TRUE"]
+    data = ()
+    if resource_types is not None:
+        _where.append("resource_type = ANY(%s)")
+        data = (*data, list(resource_types),)
+    if patient_id is not None:
+        _where.append("patient_id = %s")
+        data = (*data, patient_id,)
+    if date_from is not None:
+        _where.append("record_date >= %s")
+        data = (*data, date_from,)
+    if date_to is not None:
+        _where.append("record_date <= %s")
+        data = (*data, date_to,)
+    _where = " AND ".join(_where)
+    columns = "resource_type, record_id, patient_id, encounter_id, record_date, content, 1 - (embedding <=> %s::vector) score"
+    # Exact search: the matching records are read by the btree indexes and ordered
+    exact = f"""WITH records AS MATERIALIZED (SELECT * FROM record_embeddings WHERE {_where})
+        SELECT {columns} FROM records ORDER BY embedding <=> %s::vector LIMIT %s"""
+    # Approximate search by the HNSW index. The query vector is repeated in ORDER BY, the
+    # index is only used with a parameter there.
+    approximate = f"""SELECT {columns} FROM record_embeddings WHERE {_where} ORDER BY embedding <=> %s::vector LIMIT %s"""
+    db = database.Database()
+    with db.pool.connection() as conn:
+        with conn:
+            with conn.cursor() as curs:
+                if patient_id is None:
+                    if _where != "TRUE":
+                        # The filters are applied to the candidates of the index search, search more of them
+                        curs.execute("SELECT set_config('hnsw.ef_search', %s, true)",
+                                     (str(min(1000, max(40, limit * FILTERED_EF_SEARCH_FACTOR))),))
+                    database.execute(curs, approximate, (vector, *data, vector, limit))
+                    result = curs.fetchall()
+                if patient_id is not None or (len(result) < limit and _where != "TRUE"):
+                    # The records of a patient are few, and the index search filtered out too
+                    # many of its candidates when it found less than the limit
+                    database.execute(curs, exact, (*data, vector, vector, limit))
+                    result = curs.fetchall()
+    return [{
+        "resourceType": row[0],
+        "id": row[1],
+        "patient_id": row[2],
+        "encounter_id": row[3],
+        "date": row[4],
+        "content": row[5],
+        "score": row[6],
+    } for row in result]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Embed the indexed records which have no embedding yet.")
+    parser.add_argument("--patient", action="append", help="Only embed the records of the patient, can be given multiple times.")
+    args = parser.parse_args()
+
+    metrics.configure_logging()
+    count = index_records(args.patient)
+    logger.info(f"Embedded {count} records")
+    database.get_pool().closeall()
@@ -0,0 +1,381 @@
+#!/usr/bin/env python3
+
+"""
+Transform FHIR resources into the rows written by the indexer, without touching the database.
+
+Each supported resource type has an extractor in EXTRACTORS, which returns the row
+of the resource as a tuple in the column order of TABLE_COLUMNS, or None for the
+resources which are not stored. The references and dates repeat a lot within a
+bundle (every observation of an encounter refers to the same patient, encounter and
+time), so they are converted through small caches.
+
+The transform is pure, so it can be profiled and run in parallel on its own,
+see loader.py and benchmark/parse.py. index_fhir.parse_fhir writes the rows.
+
+In tolerant mode the resources which fail to transform, e.g. shapes which are not
+supported yet, are quarantined into ingest_errors rows with the raw resource and
+the reason, and the rest of the bundle is transformed as usual.
+
+The content hashes of the bundles and the resources are recorded in the ingestion
+ledger, so the indexer can skip the bundles and resources which haven't changed
+since they were written, see index_fhir.flush_rows.
+
+Author: Olli Puhakka
+"""
+import sys
+import json
+import hashlib
+import datetime
+import collections
+import functools
+import logging
+from typing import Callable, Iterable
+
+logger = logging.getLogger(__file__)
+
+# Columns written by the indexer per table. The tables are in foreign key order,
+# so flushing them in this order never references a row that is not there yet.
+TABLE_COLUMNS = {
+    "patients": ("id", "date_of_birth", "deceased_at", "gender", "email"),
+    "encounters": ("id", "patient_id", "status", "class", "type", "period_start", "period_end", "reason_display"),
+    "conditions": ("id", "patient_id", "encounter_id", "clinical_status", "verification_status", "onset_date", "abatement_data", "code_display"),
+    "observations": ("id", "patient_id", "encounter_id", "observation_date", "status", "display", "value", "unit"),
+    "procedures": ("patient_id", "encounter_id", "condition_id", "status", "performed_date", "performed_date_end", "code_display", "fhir_id"),
+    "immunizations": ("patient_id", "encounter_id", "date", "status", "vaccine_display", "was_given", "primary_source", "fhir_id"),
+    "care_plans": ("patient_id", "encounter_id", "status", "category_display", "period_start_date", "period_end_date", "details", "fhir_id"),
+    "medication_requests": ("patient_id", "encounter_id", "date_written", "medication_display", "dosage_instruction", "fhir_id"),
+    "allergy_intolerances": ("patient_id", "asserted_date", "clinical_status", "type", "category", "criticality", "display", "fhir_id"),
+    # Resources which failed to transform in tolerant mode, see error_row()
+    "ingest_errors": ("patient_id", "resource_type", "resource_id", "error_class", "reason", "resource"),
+    # Ingestion ledger, content hashes of the written resources and bundles, see ledger_row()
+    "ingested_resources": ("resource_type", "resource_id", "patient_id", "content_hash"),
+    "ingested_bundles": ("content_hash", "patient_id"),
+}
+
+# Resource type -> (table, extractor)
+EXTRACTORS: dict[str, tuple[str | None, Callable[[dict], tuple | None]]] = {}
+
+# Version of the rows the extractors return, part of the content hashes of the bundles.
+# Bump it when the rows of the same resources change, so the indexed bundles are parsed again.
+TRANSFORM_VERSION = 1
+
+# Added to each date, to artificially make the dataset appear more recent
+DATE_SHIFT = datetime.timedelta(days=7*365)
+URN_UUID = "urn:uuid:"
+
+
+@functools.lru_cache(maxsize=8192)
+def datetime_from_isoformat(dt: str) -> datetime.datetime:
+    """
+    Create a datetime object from iso date and return it.
+    - Timezone information is removed, using local time here
+    - Adding 7 years to each date, to artificially make the dataset appear more recent
+    """
+    return datetime.datetime.fromisoformat(dt).replace(tzinfo=None) + DATE_SHIFT
+
+
+@functools.lru_cache(maxsize=8192)
+def reference_id(reference: str) -> str:
+    """
+    Return the id of a reference like "urn:uuid:<id>". The ids are interned, so the
+    buffered rows of a bundle share one string per referenced resource.
+    """
+    if reference.startswith(URN_UUID):
+        return sys.intern(reference[len(URN_UUID):])
+    return sys.intern(reference.split(':')[2])
+
+
+def extractor(resource_type: str, table: str | None):
+    """
+    Register the decorated function as the extractor of the resource type, the rows go to the table.
+    """
+    def register(extract: Callable[[dict], tuple | None]):
+        EXTRACTORS[resource_type] = (table, extract)
+        return extract
+    return register
+
+
+@extractor('Patient', "patients")
+def patient_row(res: dict) -> tuple:
+    return (
+        res['id'],
+        datetime_from_isoformat(res['birthDate']),
+        datetime_from_isoformat(res['deceasedDateTime']) if 'deceasedDateTime' in res else None,
+        res['gender'],
+        f"{res['name'][0]['given'][0]}.{res['name'][0]['family']}@localhost",  # email
+    )
+
+
+@extractor('Encounter', "encounters")
+def encounter_row(res: dict) -> tuple:
+    return (
+        res['id'],
+        reference_id(res['patient']['reference']),
+        res['status'],
+        res['class']['code'],
+        res['type'][0]['text'],
+        datetime_from_isoformat(res['period']['start']),
+        datetime_from_isoformat(res['period']['end']),
+        res['reason']['coding'][0]['display'] if 'reason' in res else None,
+    )
+
+
+@extractor('Observation', "observations")
+def observation_row(res: dict) -> tuple:
+    if 'component' in res:
+        components = res['component']
+        display = [item['code']['coding'][0]['display'] for item in components]
+        value = [item["valueQuantity"]["value"] for item in components]
+        unit = [item["valueQuantity"]["unit"] for item in components]
+    elif 'valueQuantity' in res:
+        display = [res['code']['coding'][0]['display']]
+        value = [res["valueQuantity"]["value"]]
+        unit = [res["valueQuantity"]["unit"]]
+    else:
+        # TODO: valueCodeableConcept
+        raise NotImplementedError(f"{res['resourceType']} not fully implemented yet!")
+    return (
+        res['id'],
+        reference_id(res['subject']['reference']),
+        reference_id(res['encounter']['reference']),
+        datetime_from_isoformat(res['effectiveDateTime']),
+        res['status'],
+        display,
+        value,
+        unit,
+    )
+
+
+@extractor('Condition', "conditions")
+def condition_row(res: dict) -> tuple:
+    return (
+        res['id'],
+        reference_id(res['subject']['reference']),
+        reference_id(res['context']['reference']),
+        res['clinicalStatus'],
+        res['verificationStatus'],
+        datetime_from_isoformat(res['onsetDateTime']),
+        datetime_from_isoformat(res['abatementDateTime']) if 'abatementDateTime' in res else None,
+        res['code']['coding'][0]['display'],
+    )
+
+
+@extractor('Procedure', "procedures")
+def procedure_row(res: dict) -> tuple:
+    return (
+        reference_id(res['subject']['reference']),
+        reference_id(res['encounter']['reference']),
+        reference_id(res['reasonReference']['reference']) if 'reasonReference' in res else None,
+        res['status'],
+        datetime_from_isoformat(res['performedDateTime'] if 'performedDateTime' in res else res['performedPeriod']['start']),
+        datetime_from_isoformat(res['performedPeriod']['end']) if 'performedPeriod' in res else None,
+        res['code']['coding'][0]['display'],
+        res.get('id'),
+    )
+
+
+@extractor('DiagnosticReport', None)
+def diagnostic_report_row(res: dict) -> None:
+    # Doesn't seem to contain valuable information
+    return None
+
+
+@extractor('Immunization', "immunizations")
+def immunization_row(res: dict) -> tuple:
+    return (
+        reference_id(res['patient']['reference']),
+        reference_id(res['encounter']['reference']),
+        datetime_from_isoformat(res['date']),
+        res['status'],
+        res['vaccineCode']['coding'][0]['display'],
+        not res['wasNotGiven'],
+        res['primarySource'],
+        res.get('id'),
+    )
+
+
+@extractor('CarePlan', "care_plans")
+def care_plan_row(res: dict) -> tuple:
+    # TODO: Check that all get saved...
+    activities = []
+    for item in res['activity']:
+        if item['detail']['status'] not in ('in-progress', 'completed'):
+            raise NotImplementedError(f"Activity status {item['detail']['status']} for {res['resourceType']} not implemented yet!")
+        activities.append(item['detail']['code']['coding'][0]['display'])
+    if len(activities) < 2:
+        details = activities[0]
+    else:
+        # Quick'n'dirty concat: 'Food allergy diet and Allergy education'
+        details = ", ".join(activities[:-1]) + " and " + activities[-1]
+    return (
+        reference_id(res['subject']['reference']),
+        reference_id(res['context']['reference']),
+        res['status'],
+        res['category'][0]['coding'][0]['display'],
+        datetime_from_isoformat(res['period']['start']),
+        datetime_from_isoformat(res['period']['end']) if 'end' in res['period'] else None,
+        details,
+        res.get('id'),
+    )
+
+
+def dosage_instruction(res: dict) -> str | None:
+    """
+    Describe the dosage instruction of a medication request, e.g. "1 dose every 6 hours".
+    """
+    # TODO: Special dosage instructions
+    if len(res['dosageInstruction']) > 1:
+        raise NotImplementedError(f"Dosage Instruction > 1 {res['resourceType']} not implemented yet!")
+    if len(res['dosageInstruction']) == 0 or len(res['dosageInstruction'][0]) == 0:
+        return None
+    doseage = res['dosageInstruction'][0]
+    if 'asNeededBoolean' not in doseage:
+        logger.error(f"{str(doseage)}")
+        raise NotImplementedError(f"Dosage Instruction {res['resourceType']} not implemented yet!")
+    if doseage['asNeededBoolean']:
+        return 'as needed'
+    if 'timing' not in doseage:
+        raise NotImplementedError(f"Final else Dosage Instruction {res['resourceType']} not implemented yet!")
+    repeat = doseage['timing']['repeat']
+    if repeat['period'] == 1 and repeat['periodUnit'] == "d":
+        # 1 dose 2 times per day
+        return f"{doseage['doseQuantity']['value']} dose {repeat['frequency']} times per day"
+    if repeat['periodUnit'] == "h" and repeat['frequency'] == 1:
+        # x dose every n hours
+        return f"{doseage['doseQuantity']['value']} dose every {repeat['period']} hours"
+    raise NotImplementedError(f"Dosage Instruction {res['resourceType']} not fully implemented yet!")
+
+
+@extractor('MedicationRequest', "medication_requests")
+def medication_request_row(res: dict) -> tuple:
+    return (
+        reference_id(res['patient']['reference']),
+        reference_id(res['context']['reference']),
+        datetime_from_isoformat(res['dateWritten']),
+        res['medicationCodeableConcept']['coding'][0]['display'],
+        dosage_instruction(res),
+        res.get('id'),
+    )
+
+
+@extractor('AllergyIntolerance', "allergy_intolerances")
+def allergy_intolerance_row(res: dict) -> tuple:
+    return (
+        reference_id(res['patient']['reference']),
+        datetime_from_isoformat(res['assertedDate']),
+        res['clinicalStatus'],
+        res['type'],
+        res['category'][0],  # Saving only first category
+        res['criticality'],
+        res['code']['coding'][0]['display'],
+        res.get('id'),
+    )
+
+
+def transform(res: dict) -> tuple[str | None, tuple | None]:
+    """
+    Transform one FHIR resource into its table and row.
+
+    :return: The table and the row, (None, None) for the resources which are not stored.
+    """
+    try:
+        table, extract = EXTRACTORS[res['resourceType']]
+    except KeyError:
+        raise Exception(f'Not handled: {res["resourceType"]}') from None
+    row = extract(res)
+    return (table, row) if row is not None else (None, None)
+
+
+def error_class(res: dict, error: Exception) -> str:
+    """
+    Class of the error the errors are counted by, e.g. "Observation/NotImplementedError".
+    """
+    resource_type = res.get('resourceType') if isinstance(res, dict) else None
+    return f"{resource_type}/{type(error).__name__}"
+
+
+def error_row(res: dict, error: Exception, patient_id: str | None) -> tuple:
+    """
+    Row of ingest_errors quarantining the resource which failed to transform.
+
+    :param patient_id: Patient of the bundle, None if the Patient resource hasn't been transformed.
+    """
+    resource_type = res.get('resourceType') if isinstance(res, dict) else None
+    resource_id = res.get('id') if isinstance(res, dict) else None
+    return (
+        patient_id,
+        resource_type,
+        resource_id,
+        type(error).__name__,
+        f"Missing {error}" if isinstance(error, KeyError) else str(error) or repr(error),
+        json.dumps(res, default=str),
+    )
+
+
+def row_hash(row: tuple) -> str:
+    """
+    Content hash of a resource: the hash of its row, so only the changes of the stored
+    values cause the resource to be written again. Hashing the row is also several
+    times cheaper than serializing the whole resource.
+    """
+    return hashlib.blake2b(repr(row).encode(), digest_size=16).hexdigest()
+
+
+def bundle_hasher():
+    """
+    Return a new hash object of the content hash of a bundle, updated with the raw bytes of the bundle.
+    """
+    return hashlib.sha256(f"{TRANSFORM_VERSION}:".encode())
+
+
+def bundle_hash(data: bytes) -> str:
+    """
+    Content hash of the raw bytes of a bundle.
+    """
+    hasher = bundle_hasher()
+    hasher.update(data)
+    return hasher.hexdigest()
+
+
+def ledger_row(res: dict, row: tuple, patient_id: str | None) -> tuple | None:
+    """
+    Row of ingested_resources recording the content hash of the resource written as
+    the row, None for the resources without an id.
+    """
+    if 'id' not in res:
+        return None
+    return (res['resourceType'], res['id'], patient_id, row_hash(row))
+
+
+def bundle_rows(entry: Iterable[dict], tolerant: bool = False,
+                errors: collections.Counter | None = None) -> dict[str, list[tuple]]:
+    """
+    Transform the bundle entries into rows per table, in the order of TABLE_COLUMNS.
+    The content hashes of the resources are added to the ingested_resources rows.
+
+    :param tolerant: Quarantine the resources which fail to transform into ingest_errors
+                     rows instead of raising.
+    :param errors: Counter updated with the number of quarantined resources per error class.
+    """
+    rows = {table: [] for table in TABLE_COLUMNS}
+    patient_id = None
+    for item in entry:
+        res = item.get('resource', item)
+        try:
+            table, row = transform(res)
+        except Exception as e:
+            if not tolerant:
+                raise
+            rows["ingest_errors"].append(error_row(res, e, patient_id))
+            if errors is not None:
+                errors[error_class(res, e)] += 1
+            continue
+        if table == "patients":
+            patient_id = row[0]
+            rows["ingest_errors"] = [(patient_id, *error[1:]) for error in rows["ingest_errors"]]
+        if row is not None:
+            rows[table].append(row)
+            ledger = ledger_row(res, row, patient_id)
+            if ledger is not None:
+                rows["ingested_resources"].append(ledger)
+    return rows
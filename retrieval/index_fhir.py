@@ -14,26 +14,349 @@ TODO: Handle timezones... Current functionality:
 Author: Olli Puhakka
 """
 import os
+import io
+import collections
 import argparse
 import json
-import psycopg2
 import datetime
 import logging
+from typing import BinaryIO, Iterable, Iterator
+
+import ijson
+
+import database
+import embeddings
+import fhir_transform
+import metrics
+import queries
+import report_cache
 
-logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger(__file__)
 
+# Rows buffered at most when streaming a bundle, before they are flushed
+STREAM_FLUSH_ROWS = 5000
+
+# Columns written by the indexer per table, in foreign key order
+TABLE_COLUMNS = fhir_transform.TABLE_COLUMNS
+
+# Resource type and FHIR id column of the tables of the patient records. The rows of
+# changed resources are upserted by the id, the tables with a serial key have the id
+# of the resource in fhir_id.
+RESOURCE_KEYS = {
+    "patients": ("Patient", "id"),
+    "encounters": ("Encounter", "id"),
+    "conditions": ("Condition", "id"),
+    "observations": ("Observation", "id"),
+    "procedures": ("Procedure", "fhir_id"),
+    "immunizations": ("Immunization", "fhir_id"),
+    "care_plans": ("CarePlan", "fhir_id"),
+    "medication_requests": ("MedicationRequest", "fhir_id"),
+    "allergy_intolerances": ("AllergyIntolerance", "fhir_id"),
+}
+# Conflict targets of the upserts per table, the tables not listed are only inserted into
+CONFLICT_KEYS = {
+    **{table: (column,) for table, (_, column) in RESOURCE_KEYS.items()},
+    "ingested_resources": ("resource_type", "resource_id"),
+    "ingested_bundles": ("content_hash",),
+    # A quarantined resource is updated when its bundle is indexed again
+    "ingest_errors": ("patient_id", "resource_type", "resource_id"),
+}
+# Conflict targets named by the constraint instead of the columns. Observations may be
+# partitioned by date, and then their primary key is (id, observation_date), see
+# database/partitioning/observations.sql. The name of the key is the same either way.
+CONFLICT_CONSTRAINTS = {
+    "observations": "observations_pkey",
+}
+# Resource types of the tables whose records are embedded for /search, see embeddings.RECORD_QUERIES
+EMBEDDED_TABLES = {
+    table: resource_type for table, (resource_type, _) in RESOURCE_KEYS.items() if resource_type in embeddings.RECORD_QUERIES
+}
+# Column of the encounter of the rows of the encounters and their records
+ENCOUNTER_COLUMNS = {
+    table: "id" if table == "encounters" else "encounter_id"
+    for table in RESOURCE_KEYS if table == "encounters" or "encounter_id" in TABLE_COLUMNS[table]
+}
+
+
+def on_conflict(table: str) -> str:
+    """
+    ON CONFLICT clause of the inserts into the table: the rows of changed resources are
+    updated, rows identical to the stored ones are left alone.
+    """
+    keys = CONFLICT_KEYS.get(table)
+    if keys is None:
+        return ""
+    columns = [column for column in TABLE_COLUMNS[table] if column not in keys]
+    updates = [f"{column} = excluded.{column}" for column in columns]
+    current = ", ".join(f"{table}.{column}" for column in columns)
+    excluded = ", ".join(f"excluded.{column}" for column in columns)
+    target = f"ON CONSTRAINT {CONFLICT_CONSTRAINTS[table]}" if table in CONFLICT_CONSTRAINTS else f"({', '.join(keys)})"
+    return (f" ON CONFLICT {target} DO UPDATE SET {', '.join(updates)}"
+            f" WHERE ({current}) IS DISTINCT FROM ({excluded})")
+
+
+def upsert(table: str, values: str) -> str:
+    """
+    Statement inserting the rows of `values` (VALUES or SELECT) into the table.
+
+    The statement returns one row per row actually inserted or updated, with the id of
+    the encounter of the row, NULL for the tables without encounters. The versions of
+    those encounters are bumped by bump_data_versions().
+
+    The rows of changed resources are updated in place and keep their id, so the
+    embeddings of the written rows are deleted in the same statement.
+    embeddings.index_records() then embeds their current content.
+    """
+    insert = f"INSERT INTO {table} ({', '.join(TABLE_COLUMNS[table])}) {values}{on_conflict(table)}"
+    encounter = ENCOUNTER_COLUMNS.get(table, "NULL")
+    if table not in EMBEDDED_TABLES:
+        return f"{insert} RETURNING {encounter}::text"
+    return (f"WITH written AS ({insert} RETURNING id::text, {encounter}::text encounter_id),"
+            f" stale AS (DELETE FROM record_embeddings e USING written"
+            f" WHERE e.resource_type = '{EMBEDDED_TABLES[table]}' AND e.record_id = written.id)"
+            f" SELECT encounter_id FROM written")
+
+
+# Statements of the row by row inserts, registered once per table
+INSERT_QUERIES = {
+    table: queries.query(f"insert_{table}", upsert(table, f"VALUES ({', '.join(['%s'] * len(columns))})"))
+    for table, columns in TABLE_COLUMNS.items()
+}
+LEDGER_HASHES_QUERY = queries.query(
+    "ledger_hashes",
+    "SELECT l.resource_type, l.resource_id, l.content_hash FROM ingested_resources l "
+    "JOIN unnest(%s::text[], %s::text[]) AS k(resource_type, resource_id) USING (resource_type, resource_id)",
+)
+BUNDLE_INDEXED_QUERY = queries.query("bundle_indexed", "SELECT 1 FROM ingested_bundles WHERE content_hash = %s")
+BUMP_DATA_VERSIONS_QUERY = queries.query(
+    "bump_data_versions",
+    "WITH bumped AS (UPDATE patients SET data_version = data_version + 1, updated_at = now() "
+    "WHERE id = ANY(%s::uuid[]) RETURNING id, data_version) "
+    "UPDATE encounters e SET indexed_version = bumped.data_version, first_observation_at = "
+    "(SELECT min(o.observation_date) FROM observations o WHERE o.patient_id = e.patient_id AND o.encounter_id = e.id) "
+    "FROM bumped WHERE e.patient_id = bumped.id AND e.id = ANY(%s::uuid[])",
+)
+REFRESH_SUMMARIES_QUERY = queries.query("refresh_patient_summaries", "SELECT refresh_patient_summaries(%s::uuid[])")
+DELETE_LEGACY_RECORDS_QUERY = queries.query("delete_legacy_records", "SELECT delete_legacy_records(%s::uuid[])")
+
+
+def _copy_value(value) -> str | None:
+    """
+    Format a value for COPY in csv format. None is returned as is and becomes NULL.
+    """
+    if value is None:
+        return None
+    if isinstance(value, bool):
+        return "t" if value else "f"
+    if isinstance(value, (datetime.date, datetime.datetime)):
+        return value.isoformat()
+    if isinstance(value, (list, tuple)):
+        # Array literal: {"a","b"} / {1.5,NULL}
+        items = []
+        for item in value:
+            item = _copy_value(item)
+            if item is None:
+                items.append("NULL")
+            else:
+                items.append('"' + item.replace("\\", "\\\\").replace('"', '\\"') + '"')
+        return "{" + ",".join(items) + "}"
+    return str(value)
+
+
+def _csv_buffer(rows: list[tuple]) -> io.StringIO:
+    """
+    Write the rows to an in-memory csv file for COPY.
+    """
+    buffer = io.StringIO()
+    for row in rows:
+        # Values are always quoted, an unquoted empty value is NULL
+        buffer.write(",".join(
+            "" if value is None else '"' + value.replace('"', '""') + '"'
+            for value in map(_copy_value, row)
+        ))
+        buffer.write("\n")
+    buffer.seek(0)
+    return buffer
+
+
+def flush_rows(rows: dict[str, list[tuple]], db: database.Database = None, refresh_summaries: bool = True,
+               stale_summaries: set[str] | None = None) -> dict[str, int]:
+    """
+    Write the given rows per table to the DB in a single transaction.
+
+    The rows of the resources whose content hash in the ingestion ledger hasn't
+    changed are skipped. Each table is copied into a temporary staging table with COPY
+    and then moved into the actual table with one INSERT ... ON CONFLICT, so the rows
+    of changed resources are upserted the same way as when inserting row by row, and
+    their embeddings are deleted to be embedded again.
+    The data versions and the summaries of the patients are updated in the same transaction.
+
+    :param rows: Rows per table, columns as in TABLE_COLUMNS.
+    :param db: Database to use, the shared pool by default.
+    :param refresh_summaries: Refresh the summaries of the patients. A bundle written in
+                              several transactions refreshes them only with its last rows.
+    :param stale_summaries: Ids of the patients whose summaries are not refreshed yet, the
+                            patients of the rows are added to it and the summaries of all of
+                            them are refreshed with refresh_summaries.
+    :return: Number of rows flushed per table, without the skipped ones.
+    """
+    if db is None:
+        db = database.Database()
+    counts = {}
+    with db.pool.connection() as conn:
+        with conn:
+            with conn.cursor() as curs:
+                rows = changed_rows(curs, rows)
+                delete_legacy_records(curs, [row[0] for row in rows.get("patients", [])])
+                encounter_ids = set()
+                for table, columns in TABLE_COLUMNS.items():
+                    if not rows.get(table):
+                        continue
+                    _columns = ", ".join(columns)
+                    curs.execute(f"CREATE TEMPORARY TABLE staging_{table} ON COMMIT DROP AS SELECT {_columns} FROM {table} WITH NO DATA")
+                    curs.copy_expert(f"COPY staging_{table} ({_columns}) FROM STDIN WITH (FORMAT csv)", _csv_buffer(rows[table]))
+                    curs.execute(upsert(table, f"SELECT {_columns} FROM staging_{table}"))
+                    written = curs.fetchall()
+                    encounter_ids.update(encounter_id for encounter_id, in written if encounter_id is not None)
+                    logger.debug(f"Flushed {len(rows[table])} rows to {table}, {len(written)} written")
+                    counts[table] = len(rows[table])
+                    metrics.ROWS_WRITTEN.inc(table, amount=len(rows[table]))
+                patient_ids = _patient_ids(rows)
+                bump_data_versions(curs, patient_ids, sorted(encounter_ids))
+                if stale_summaries is None:
+                    stale_summaries = set()
+                stale_summaries.update(patient_ids)
+                if refresh_summaries:
+                    refresh_patient_summaries(curs, sorted(stale_summaries))
+                    stale_summaries.clear()
+    for patient_id in patient_ids:
+        report_cache.get_cache().invalidate(patient_id)
+    return counts
+
+
+def changed_rows(curs, rows: dict[str, list[tuple]]) -> dict[str, list[tuple]]:
+    """
+    Drop the rows of the resources whose content hash in the ingestion ledger is the
+    same as in the ingested_resources rows, and the repeated rows of a resource.
+    """
+    ledger = rows.get("ingested_resources")
+    unchanged = set()
+    if ledger:
+        database.execute(curs, LEDGER_HASHES_QUERY, ([row[0] for row in ledger], [row[1] for row in ledger]))
+        indexed = {(resource_type, resource_id): content_hash for resource_type, resource_id, content_hash in curs.fetchall()}
+        unchanged = {
+            (resource_type, resource_id) for resource_type, resource_id, _, content_hash in ledger
+            if indexed.get((resource_type, resource_id)) == content_hash
+        }
+    changed = {}
+    for table, table_rows in rows.items():
+        if table == "ingested_resources":
+            resource_type, key = None, lambda row: (row[0], row[1])
+        elif table == "ingest_errors":
+            resource_type, key = None, lambda row: (row[1], row[2])
+        elif table in RESOURCE_KEYS:
+            resource_type, column = RESOURCE_KEYS[table]
+            index = TABLE_COLUMNS[table].index(column)
+            key = lambda row, index=index, resource_type=resource_type: (resource_type, row[index])
+        else:
+            changed[table] = table_rows
+            continue
+        seen = set()
+        changed[table] = []
+        for row in table_rows:
+            row_key = key(row)
+            if row_key[1] is not None:
+                if row_key in seen or row_key in unchanged:
+                    continue
+                seen.add(row_key)
+            changed[table].append(row)
+    if unchanged:
+        logger.debug(f"Skipped {len(unchanged)} unchanged resources")
+    return changed
+
+
+def bundle_indexed(content_hash: str, db: database.Database = None) -> bool:
+    """
+    Check whether the bundle with the content hash has already been indexed, see fhir_transform.bundle_hash().
+    """
+    if db is None:
+        db = database.Database()
+    return bool(db.db_execute(BUNDLE_INDEXED_QUERY, (content_hash,)))
+
+
+def _patient_ids(rows: dict[str, list[tuple]]) -> list[str]:
+    """
+    Return the ids of the patients the rows belong to.
+    """
+    patient_ids = set()
+    for table, table_rows in rows.items():
+        if table not in RESOURCE_KEYS:
+            # Quarantined resources and the ledger don't change the records of the patient
+            continue
+        index = TABLE_COLUMNS[table].index("id" if table == "patients" else "patient_id")
+        patient_ids.update(row[index] for row in table_rows)
+    return sorted(patient_ids)
+
+
+def bump_data_versions(curs, patient_ids: list[str], encounter_ids: list[str] = ()):
+    """
+    Bump the data version of the patients, which invalidates their cached reports, and
+    record the new version as the indexed_version of the written encounters, the
+    encounters returned by the upsert() statements. The first_observation_at of the
+    written encounters, the bound of the observation queries, is updated as well.
+
+    The bump locks the patient rows until the transaction commits, so the versions of a
+    patient are ordered by commit. Incremental reports return the encounters written
+    after the data version of the previous report, including the encounters of which
+    only some records changed.
+    """
+    if patient_ids:
+        database.execute(curs, BUMP_DATA_VERSIONS_QUERY, (patient_ids, list(encounter_ids)))
+
+
+def delete_legacy_records(curs, patient_ids: list[str]):
+    """
+    Delete the records of the patients indexed before the ingestion ledger, which have
+    no fhir_id to be upserted by. Called when the patients of a bundle are written, the
+    bundle then writes the records again, see database/migrations/011_ingestion_duplicates.sql.
+    """
+    if patient_ids:
+        database.execute(curs, DELETE_LEGACY_RECORDS_QUERY, (patient_ids,))
+
+
+def refresh_patient_summaries(curs, patient_ids: list[str]):
+    """
+    Refresh the precomputed summaries of the patients served by /patient/{id}/summary.
+    """
+    if patient_ids:
+        database.execute(curs, REFRESH_SUMMARIES_QUERY, (patient_ids,))
+
+
 class Patient:
-    database_connection = None
 
-    def __init__(self, id, gender, birth_date, deceased_at, email):
+    def __init__(self, id, gender, birth_date, deceased_at, email, bulk: bool = False):
         # TODO: description has age-> age changes over time so this should be calculated in tool instead or as virtual database column.
 
-        # Initialize the db:
-        if self.database_connection is None:
-            self.__init_database__()
+        # The db is initialized on first use, parsing in bulk mode doesn't need it
+        self._db = None
+
+        # In bulk mode the rows are buffered per table and written by flush()
+        self.bulk = bulk
+        self._rows = {table: [] for table in TABLE_COLUMNS}
+        self.buffered = 0
+        # Rows written to the DB per table
+        self.written = collections.Counter()
+        # Encounters written row by row since the last touch()
+        self._encounter_ids = set()
+        # Patients flushed without refreshing their summaries, see flush()
+        self._stale_summaries = set()
 
         # Initialize the patient
+        if not bulk:
+            with self.db.pool.connection() as conn:
+                with conn:
+                    with conn.cursor() as curs:
+                        delete_legacy_records(curs, [id])
         self.db_add_patient(id, gender, birth_date, deceased_at, email)
         self.patient_id = id
 
@@ -41,7 +364,7 @@ class Patient:
         if deceased_at is None:
             now = datetime.datetime.now()
         else:
-            now = datetime.datetime.fromisoformat(deceased_at).replace(tzinfo=None)
+            now = deceased_at
         age = now.year - birth_date.year
         if birth_date.month > now.month or (birth_date.month == now.month and birth_date.day > now.day):
             # If the birthday is still in future for the current year
@@ -49,332 +372,271 @@ class Patient:
         description = f'Patient is {age} year old {gender}'
         logger.info(description)
 
-    @classmethod
-    def __init_database__(cls):
-        cls.database_connection = psycopg2.connect(
-            host     = os.environ['POSTGRES_HOST'],
-            port     = os.environ['POSTGRES_PORT'],
-            database = os.environ['POSTGRES_DB'],
-            user     = os.environ['POSTGRES_TOOL_USER'],
-            password = os.environ['POSTGRES_TOOL_PASSWORD'],
-        )
-        return cls.database_connection
-
-    def _db_execute(self, query: str, data: tuple):
+    @property
+    def db(self) -> database.Database:
+        if self._db is None:
+            self._db = database.Database()
+        return self._db
+
+    def _db_insert(self, table: str, row: tuple):
+        """
+        Insert the row into the table, or buffer it for flush() in bulk mode.
+        """
+        if self.bulk:
+            self._rows[table].append(row)
+            self.buffered += 1
+            return
+        written = self.db.db_execute(INSERT_QUERIES[table], row)
+        self._encounter_ids.update(encounter_id for encounter_id, in written if encounter_id is not None)
+        self.written[table] += 1
+        metrics.ROWS_WRITTEN.inc(table)
+
+    def take_rows(self) -> dict[str, list[tuple]]:
+        """
+        Return the rows buffered in bulk mode and empty the buffer.
+        """
+        rows = self._rows
+        self._rows = {table: [] for table in TABLE_COLUMNS}
+        self.buffered = 0
+        return rows
+
+    def flush(self, refresh_summaries: bool = True) -> dict[str, int]:
+        """
+        Write the rows buffered in bulk mode to the DB in a single transaction.
+
+        :param refresh_summaries: Refresh the summary of the patient, False for the flushes
+                                  before the last one of a bundle written in several transactions.
+        :return: Number of rows flushed per table.
+        """
+        counts = flush_rows(self.take_rows(), self.db, refresh_summaries, self._stale_summaries)
+        self.written.update(counts)
+        return counts
+
+    def refresh_summaries(self):
         """
-        Execute the query with data.
+        Refresh the summaries left stale by the flushes without refresh_summaries, when the
+        rest of the bundle is not flushed.
         """
-        try:
-            with self.database_connection:
-                with self.database_connection.cursor() as curs:
-                    curs.execute(query, data)
-        except psycopg2.InterfaceError as e:
-            # connection already closed ?
-            # Reinitialize connection and try again
-            self.__init_database__()
-            with self.database_connection:
-                with self.database_connection.cursor() as curs:
-                    curs.execute(query, data)
+        if self._stale_summaries:
+            with self.db.pool.connection() as conn:
+                with conn:
+                    with conn.cursor() as curs:
+                        refresh_patient_summaries(curs, sorted(self._stale_summaries))
+            self._stale_summaries.clear()
+
+    def touch(self):
+        """
+        Bump the data version and refresh the summary of the patient after writing rows row by row.
+        """
+        with self.db.pool.connection() as conn:
+            with conn:
+                with conn.cursor() as curs:
+                    bump_data_versions(curs, [self.patient_id], sorted(self._encounter_ids))
+                    refresh_patient_summaries(curs, [self.patient_id])
+        self._encounter_ids.clear()
+        report_cache.get_cache().invalidate(self.patient_id)
 
     def db_add_patient(self, id, gender, birth_date, deceased_at, email):
         """
         Inserts patient data into the DB.
         """
-        self._db_execute(
-            "INSERT INTO patients (id, date_of_birth, deceased_at, gender, email) VALUES (%s, %s, %s, %s, %s) ON CONFLICT DO NOTHING",
-            (id, birth_date, deceased_at, gender, email),
-        )
+        self._db_insert("patients", (id, birth_date, deceased_at, gender, email))
 
     def db_add_encounter(self, id, patient_id, status, class_, type, period_start, period_end, reason):
         """
         Inserts encounter data into the DB.
         """
-        self._db_execute(
-            """INSERT INTO encounters (id, patient_id, status, class, type, period_start, period_end, reason_display)
-            VALUES (%s, %s, %s, %s, %s, %s, %s, %s) ON CONFLICT DO NOTHING""",
-            (id, patient_id, status, class_, type, period_start, period_end, reason),
-        )
+        self._db_insert("encounters", (id, patient_id, status, class_, type, period_start, period_end, reason))
 
-
-    def db_add_allergy_intolerance(self, patient_id, asserted_date, clinical_status, type, category, criticality, display):
+    def db_add_allergy_intolerance(self, patient_id, asserted_date, clinical_status, type, category, criticality, display, fhir_id=None):
         """
         Inserts allergy or intolerance into the DB.
         """
-        self._db_execute(
-            """INSERT INTO allergy_intolerances (patient_id, asserted_date, clinical_status, type, category, criticality, display)
-            VALUES (%s, %s, %s, %s, %s, %s, %s) ON CONFLICT DO NOTHING""",
-            (patient_id, asserted_date, clinical_status, type, category, criticality, display),
-        )
+        self._db_insert("allergy_intolerances", (patient_id, asserted_date, clinical_status, type, category, criticality, display, fhir_id))
 
     def db_add_condition(self, id, patient_id, encounter_id, clinical_status, verification_status, onset_date, abatement_data, code_display):
         """
         Inserts condition into the DB.
         """
-        self._db_execute(
-            """INSERT INTO conditions (id, patient_id, encounter_id, clinical_status, verification_status, onset_date, abatement_data, code_display)
-            VALUES (%s, %s, %s, %s, %s, %s, %s, %s) ON CONFLICT DO NOTHING""",
-            (id, patient_id, encounter_id, clinical_status, verification_status, onset_date, abatement_data, code_display),
-        )
+        self._db_insert("conditions", (id, patient_id, encounter_id, clinical_status, verification_status, onset_date, abatement_data, code_display))
 
     def db_add_observation(self, id, patient_id, encounter_id, observation_date, status, display, value, unit):
         """
         Inserts observation into the DB.
         """
-        self._db_execute(
-            """INSERT INTO observations (id, patient_id, encounter_id, observation_date, status, display, value, unit)
-            VALUES (%s, %s, %s, %s, %s, %s, %s, %s) ON CONFLICT DO NOTHING""",
-            (id, patient_id, encounter_id, observation_date, status, display, value, unit),
-        )
+        self._db_insert("observations", (id, patient_id, encounter_id, observation_date, status, display, value, unit))
 
-    def db_add_careplan(self, patient_id, encounter_id, status, category_display, period_start_date, period_end_date, details):
+    def db_add_careplan(self, patient_id, encounter_id, status, category_display, period_start_date, period_end_date, details, fhir_id=None):
         """
         Inserts care-plan into the DB.
         """
-        self._db_execute(
-            """INSERT INTO care_plans (patient_id, encounter_id, status, category_display, period_start_date, period_end_date, details)
-            VALUES (%s, %s, %s, %s, %s, %s, %s) ON CONFLICT DO NOTHING""",
-            (patient_id, encounter_id, status, category_display, period_start_date, period_end_date, details),
-        )
+        self._db_insert("care_plans", (patient_id, encounter_id, status, category_display, period_start_date, period_end_date, details, fhir_id))
 
-    def db_add_medication_request(self, patient_id, encounter_id, date_written, medication_display, dosage_instruction):
+    def db_add_medication_request(self, patient_id, encounter_id, date_written, medication_display, dosage_instruction, fhir_id=None):
         """
         Inserts medication request into the DB.
         """
-        self._db_execute(
-            """INSERT INTO medication_requests (patient_id, encounter_id, date_written, medication_display, dosage_instruction)
-            VALUES (%s, %s, %s, %s, %s) ON CONFLICT DO NOTHING""",
-            (patient_id, encounter_id, date_written, medication_display, dosage_instruction),
-        )
+        self._db_insert("medication_requests", (patient_id, encounter_id, date_written, medication_display, dosage_instruction, fhir_id))
 
-    def db_add_procedure(self, patient_id, encounter_id, condition_id, status, performed_date, performed_date_end, code_display):
+    def db_add_procedure(self, patient_id, encounter_id, condition_id, status, performed_date, performed_date_end, code_display, fhir_id=None):
         """
         Inserts procedure into the DB.
         """
-        self._db_execute(
-            """INSERT INTO procedures (patient_id, encounter_id, condition_id, status, performed_date, performed_date_end, code_display)
-            VALUES (%s, %s, %s, %s, %s, %s, %s) ON CONFLICT DO NOTHING""",
-            (patient_id, encounter_id, condition_id, status, performed_date, performed_date_end, code_display),
-        )
+        self._db_insert("procedures", (patient_id, encounter_id, condition_id, status, performed_date, performed_date_end, code_display, fhir_id))
 
-    def db_add_immunization(self, patient_id, encounter_id, date, status, vaccine_display, was_given, primary_source):
+    def db_add_immunization(self, patient_id, encounter_id, date, status, vaccine_display, was_given, primary_source, fhir_id=None):
         """
         Inserts immunization into the DB.
         """
-        self._db_execute(
-            """INSERT INTO immunizations (patient_id, encounter_id, date, status, vaccine_display, was_given, primary_source)
-            VALUES (%s, %s, %s, %s, %s, %s, %s) ON CONFLICT DO NOTHING""",
-            (patient_id, encounter_id, date, status, vaccine_display, was_given, primary_source),
-        )
+        self._db_insert("immunizations", (patient_id, encounter_id, date, status, vaccine_display, was_given, primary_source, fhir_id))
 
 
-def datetime_from_isoformat(dt: str | None) -> datetime.datetime:
+def parse_fhir(entry: Iterable[dict], bulk: bool = True, flush: bool = True, max_buffered_rows: int | None = None,
+               stats: collections.Counter | None = None, tolerant: bool = False,
+               errors: collections.Counter | None = None, bundle_hash: str | None = None) -> Patient | None:
     """
-    Create a datetime object from iso date and return it.
-    - Timezone information is removed, using local time here
-    - Adding 7 years to each date, to artificially make the dataset appear more recent
+    Parse the given FHIR resource data and save to database.
+    The resources are transformed into rows by fhir_transform.
+
+    @param entry: The FHIR resource data to parse, a list or e.g. iter_fhir_entries().
+    @param bulk: Buffer the rows and write the whole bundle in one transaction
+                 instead of committing each row separately.
+    @param flush: Write the buffered rows at the end. Without flushing the rows
+                  are left in the returned patient, see Patient.take_rows().
+    @param max_buffered_rows: Flush whenever this many rows are buffered, which keeps
+                              the memory use flat for large bundles but writes the
+                              bundle in several transactions. The summary of the
+                              patient is refreshed once, with the last of them.
+    @param stats: Counter updated with the number of resources parsed per resource type.
+    @param tolerant: Quarantine the resources which fail to parse into the ingest_errors
+                     table with the raw resource and the reason, and keep parsing the
+                     rest of the bundle, instead of aborting the bundle.
+    @param errors: Counter updated with the number of quarantined resources per error class.
+    @param bundle_hash: Content hash of the bundle, recorded in the ingestion ledger with
+                        the last rows of the bundle. See bundle_indexed().
+    @return: The patient of the bundle.
     """
-    return datetime.datetime.fromisoformat(dt).replace(tzinfo=None) + datetime.timedelta(days=7*365)
 
-
-def parse_fhir(entry: dict):
+    patient = None
+    # Resources parsed per type for the metrics, added once at the end
+    parsed = collections.Counter()
+    # Quarantined resources waiting for the patient of the bundle
+    quarantined = []
+    try:
+        for row in entry:
+            if max_buffered_rows and flush and patient is not None and patient.buffered >= max_buffered_rows:
+                patient.flush(refresh_summaries=False)
+            res = row['resource']
+            parsed[res['resourceType']] += 1
+            if stats is not None:
+                stats[res['resourceType']] += 1
+            try:
+                table, values = fhir_transform.transform(res)
+                if table == "patients":
+                    id, birth_date, deceased_at, gender, email = values
+                    patient = Patient(id, gender, birth_date, deceased_at, email, bulk=bulk)
+                    for error_row in quarantined:
+                        patient._db_insert("ingest_errors", (patient.patient_id, *error_row[1:]))
+                    quarantined = []
+                elif table is not None:
+                    if patient is None:
+                        raise ValueError(f"{res['resourceType']} before the Patient of the bundle")
+                    patient._db_insert(table, values)
+                if table is not None:
+                    ledger = fhir_transform.ledger_row(res, values, patient.patient_id)
+                    if ledger is not None:
+                        patient._db_insert("ingested_resources", ledger)
+            except Exception as e:
+                if not tolerant:
+                    raise
+                error_class = fhir_transform.error_class(res, e)
+                logger.debug(f"Quarantined {error_class} {res.get('id')}: {e}")
+                metrics.INGEST_ERRORS.inc(res.get('resourceType'), type(e).__name__)
+                if errors is not None:
+                    errors[error_class] += 1
+                error_row = fhir_transform.error_row(res, e, patient.patient_id if patient is not None else None)
+                if patient is None:
+                    quarantined.append(error_row)
+                else:
+                    patient._db_insert("ingest_errors", error_row)
+    except BaseException:
+        if patient is not None and patient.bulk:
+            # The rows flushed before the error are committed
+            patient.refresh_summaries()
+        raise
+    finally:
+        for resource_type, count in parsed.items():
+            metrics.RESOURCES_INDEXED.inc(resource_type, amount=count)
+        if patient is not None and not patient.bulk:
+            # Rows written row by row are already committed, also on errors
+            patient.touch()
+
+    if patient is not None and bundle_hash is not None:
+        patient._db_insert("ingested_bundles", (bundle_hash, patient.patient_id))
+    if patient is not None and patient.bulk and flush:
+        patient.flush()
+    if quarantined and flush:
+        # Nothing of the bundle could be parsed, only its errors are written
+        flush_rows({"ingest_errors": quarantined})
+    return patient
+
+def iter_fhir_entries(file: BinaryIO) -> Iterator[dict]:
     """
-    Parse the given FHIR resource data and save to database.
+    Iterate over the entries of a FHIR bundle read from a binary file-like object.
 
-    @param entry: The FHIR resource data to parse.
+    The bundle is parsed incrementally, so only one entry is held in memory at a time.
     """
+    return ijson.items(file, 'entry.item', use_float=True)
 
-    patient = None
-    for row in entry:
-        res = row['resource']
-        match res['resourceType']:
-            case 'Patient':
-                patient = Patient(
-                    res['id'],
-                    res['gender'],
-                    datetime_from_isoformat(res['birthDate']),
-                    datetime_from_isoformat(res['deceasedDateTime']) if 'deceasedDateTime' in res else None,
-                    f"{res['name'][0]['given'][0]}.{res['name'][0]['family']}@localhost",  # email
-                )
-
-            case 'Encounter':
-                patient.db_add_encounter(
-                    res['id'],
-                    res['patient']['reference'].split(':')[2],
-                    res['status'],
-                    res['class']['code'],
-                    res['type'][0]['text'],
-                    datetime_from_isoformat(res['period']['start']),
-                    datetime_from_isoformat(res['period']['end']),
-                    res['reason']['coding'][0]['display'] if 'reason' in res else None,
-                )
-
-            case 'Observation':
-                # id, patient_id, encounter_id, observation_date, status, display, value, unit
-                display = []
-                value = []
-                unit = []
-                if 'component' in res:
-                    for item in res['component']:
-                        display.append(item['code']['coding'][0]['display'])
-                        value.append(item["valueQuantity"]["value"])
-                        unit.append(item["valueQuantity"]["unit"])
-                elif 'valueQuantity' in res:
-                    display.append(res['code']['coding'][0]['display'])
-                    value.append(res["valueQuantity"]["value"])
-                    unit.append(res["valueQuantity"]["unit"])
-                else:
-                    raise NotImplementedError(f"{res['resourceType']} not fully implemented yet!")
-
-                patient.db_add_observation(
-                    res['id'],
-                    res['subject']['reference'].split(':')[2],
-                    res['encounter']['reference'].split(':')[2],
-                    datetime_from_isoformat(res['effectiveDateTime']),
-                    res['status'],
-                    display,
-                    value,
-                    unit,
-                )
-                continue
-                # This is not yet implemented:
-                if 'valueCodeableConcept' in res:
-                    value = f'{res["code"]["coding"][0]["display"]}: {res["valueCodeableConcept"]["coding"][0]["display"]}' 
-                    print(f'{res["resourceType"]}: {value} {display} in {time_at}')
-
-            case 'Condition':
-                # id, patient_id, encounter_id, clinical_status, verification_status, onset_date, abatement_data, code_display
-                patient.db_add_condition(
-                    res['id'],
-                    res['subject']['reference'].split(':')[2],
-                    res['context']['reference'].split(':')[2],
-                    res['clinicalStatus'],
-                    res['verificationStatus'],
-                    datetime_from_isoformat(res['onsetDateTime']),
-                    datetime_from_isoformat(res['abatementDateTime']) if 'abatementDateTime' in res else None,
-                    res['code']['coding'][0]['display']
-                )
-
-            case 'Procedure':
-                # patient_id, encounter_id, condition_id, status, performed_date, code_display
-                patient.db_add_procedure(
-                    res['subject']['reference'].split(':')[2],
-                    res['encounter']['reference'].split(':')[2],
-                    res['reasonReference']['reference'].split(':')[2] if 'reasonReference' in res else None,
-                    res['status'],
-                    datetime_from_isoformat(res['performedDateTime'] if 'performedDateTime' in res else res['performedPeriod']['start']),
-                    datetime_from_isoformat(res['performedPeriod']['end']) if 'performedPeriod' in res else None,
-                    res['code']['coding'][0]['display'],
-                )
-
-            case 'DiagnosticReport':
-                # Doesn't seem to contain valuable information
-                continue
-                raise NotImplementedError(f"{res['resourceType']} not implemented yet!")
-
-            case 'Immunization':
-                # patient_id, encounter_id, date, status, vaccine_display, was_given, primary_source
-                patient.db_add_immunization(
-                    res['patient']['reference'].split(':')[2],
-                    res['encounter']['reference'].split(':')[2],
-                    datetime_from_isoformat(res['date']),
-                    res['status'],
-                    res['vaccineCode']['coding'][0]['display'],
-                    not res['wasNotGiven'],
-                    res['primarySource'],
-                )
-
-            case 'CarePlan':
-                # TODO: Check that all get saved...
-                activities = []
-                for item in res['activity']:
-                    if item['detail']['status'] not in ('in-progress', 'completed'):
-                        raise NotImplementedError(f"Activity status {item['detail']['status']} for {res['resourceType']} not implemented yet!")
-                    activities.append(item['detail']['code']['coding'][0]['display'])
-                if len(activities) < 2:
-                    details = activities[0]
-                else:
-                    # Quick'n'dirty concat: 'Food allergy diet and Allergy education'
-                    details = ", ".join(activities[:-1]) + " and " + activities[-1]
-
-                patient.db_add_careplan(
-                    res['subject']['reference'].split(':')[2],
-                    res['context']['reference'].split(':')[2],
-                    res['status'],
-                    res['category'][0]['coding'][0]['display'],
-                    datetime_from_isoformat(res['period']['start']),
-                    datetime_from_isoformat(res['period']['end']) if 'end' in res['period'] else None,
-                    details,
-                )
-
-            case 'MedicationRequest':
-                # TODO: Special dosage instructions
-                if len(res['dosageInstruction']) > 1:
-                    raise NotImplementedError(f"Dosage Instruction > 1 {res['resourceType']} not implemented yet!")
-                if len(res['dosageInstruction']) == 0 or len(res['dosageInstruction'][0]) == 0:
-                    dosage_instruction = None
-                elif 'asNeededBoolean' not in res['dosageInstruction'][0]:
-                    logger.error(f"{str(res['dosageInstruction'][0])}")
-                    raise NotImplementedError(f"Dosage Instruction {res['resourceType']} not implemented yet!")
-                elif res['dosageInstruction'][0]['asNeededBoolean']:
-                    dosage_instruction = 'as needed'
-                elif 'timing' in res['dosageInstruction'][0]:
-                    doseage = res['dosageInstruction'][0]
-                    if doseage['timing']['repeat']['period'] == 1 and doseage['timing']['repeat'] ['periodUnit']== "d":
-                        # 1 dose 2 times per day
-                        dosage_instruction = f"{doseage['doseQuantity']['value']} dose {doseage['timing']['repeat']['frequency']} times per day"
-                    elif doseage['timing']['repeat'] ['periodUnit']== "h" and doseage['timing']['repeat']['frequency'] == 1:
-                        # x dose every n hours
-                        dosage_instruction = f"{doseage['doseQuantity']['value']} dose every {doseage['timing']['repeat']['period']} hours"
-                    else:
-                        raise NotImplementedError(f"Dosage Instruction {res['resourceType']} not fully implemented yet!")
-                else:
-                    raise NotImplementedError(f"Final else Dosage Instruction {res['resourceType']} not implemented yet!")
-                dosage_instruction
-                patient.db_add_medication_request(
-                    res['patient']['reference'].split(':')[2],
-                    res['context']['reference'].split(':')[2],
-                    datetime_from_isoformat(res['dateWritten']),
-                    res['medicationCodeableConcept']['coding'][0]['display'],
-                    dosage_instruction,
-                )
-
-            case 'AllergyIntolerance':
-                patient.db_add_allergy_intolerance(
-                    res['patient']['reference'].split(':')[2],
-                    datetime_from_isoformat(res['assertedDate']),
-                    res['clinicalStatus'],
-                    res['type'],
-                    res['category'][0],  # Saving only first category
-                    res['criticality'],
-                    res['code']['coding'][0]['display'],
-                )
-
-            case _:
-                raise Exception(f'Not handled: {res["resourceType"]}')
 
 def valid_json_file(path):
     """
-    Check if the given path is a valid json file.
+    Check if the given path is an existing file.
+    The content is validated when it is parsed, so the file is read only once.
     """
     if not os.path.isfile(path):
         raise argparse.ArgumentTypeError(f"File {path} does not exist.")
-    try:
-        with open(path, 'r') as f:
-            json.load(f)
-    except json.JSONDecodeError:
-        raise argparse.ArgumentTypeError(f"File {path} is not a valid json file.")
     return path
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Index FHIR resources to a database.")
     parser.add_argument("json_file", type=valid_json_file, help="Path to the json file containing the FHIR resources.")
+    parser.add_argument("--row-by-row", action="store_true", help="Commit each row separately instead of bulk loading the bundle.")
+    parser.add_argument("--stream", action="store_true", help="Parse the file incrementally to keep memory use flat for large bundles.")
+    parser.add_argument("--embed", action="store_true", help="Embed the indexed records for semantic search.")
+    parser.add_argument("--tolerant", action="store_true", help="Quarantine the resources which fail to parse into ingest_errors instead of aborting.")
     args = parser.parse_args()
 
-    with open(args.json_file, 'r') as f:
-        data = json.load(f)
+    metrics.configure_logging()
+    patient = None
+    errors = collections.Counter()
+    hasher = fhir_transform.bundle_hasher()
+    with open(args.json_file, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            hasher.update(chunk)
+    content_hash = hasher.hexdigest()
     try:
-        parse_fhir(data['entry'])
+        if bundle_indexed(content_hash):
+            print(f"File {args.json_file} is already indexed.")
+        elif args.stream:
+            with open(args.json_file, 'rb') as f:
+                patient = parse_fhir(iter_fhir_entries(f), bulk=not args.row_by_row, max_buffered_rows=STREAM_FLUSH_ROWS,
+                                     tolerant=args.tolerant, errors=errors, bundle_hash=content_hash)
+        else:
+            with open(args.json_file, 'r') as f:
+                try:
+                    data = json.load(f)
+                except json.JSONDecodeError:
+                    parser.error(f"File {args.json_file} is not a valid json file.")
+            patient = parse_fhir(data['entry'], bulk=not args.row_by_row, tolerant=args.tolerant, errors=errors,
+                                 bundle_hash=content_hash)
+    except ijson.JSONError:
+        print(f"File {args.json_file} is not a valid json file.")
     except NotImplementedError as e:
         print(e)
-    Patient.database_connection.close()
\ No newline at end of file
+    for error_class, count in errors.most_common():
+        print(f"Quarantined {count} resources: {error_class}")
+    if args.embed and patient is not None:
+        embeddings.index_records([patient.patient_id])
+    database.get_pool().closeall()
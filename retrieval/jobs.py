@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+
+"""
+Background reindex jobs.
+
+Bundles posted to /reindex are spooled to disk and indexed by a small pool of
+worker threads, so the HTTP request returns right away and ingestion bursts
+can't take over the threads serving the report endpoints.
+
+Author: Olli Puhakka
+"""
+import os
+import uuid
+import datetime
+import threading
+import collections
+import logging
+from concurrent import futures
+
+import embeddings
+import index_fhir
+
+logger = logging.getLogger(__file__)
+
+
+class QueueFull(Exception):
+    """
+    Raised when too many jobs are already waiting.
+    """
+
+
+class ReindexJob:
+
+    def __init__(self, path: str, size: int, tolerant: bool = False, content_hash: str | None = None):
+        self.id = uuid.uuid4().hex
+        self.path = path
+        self.size = size
+        # Content hash of the bundle, an already indexed bundle is skipped
+        self.content_hash = content_hash
+        self.unchanged = False
+        # Quarantine the resources which fail to parse instead of failing the job
+        self.tolerant = tolerant
+        self.status = "queued"  # queued, running, embedding, finished, failed
+        self.created_at = datetime.datetime.now(datetime.timezone.utc)
+        self.started_at = None
+        self.finished_at = None
+        self.patient_id = None
+        # Resources parsed per resource type, updated while the job runs
+        self.resources = collections.Counter()
+        # Resources quarantined into ingest_errors per error class
+        self.quarantined = collections.Counter()
+        # Rows written per table
+        self.rows = {}
+        # Records embedded for semantic search
+        self.embedded = 0
+        self.error = None
+
+    def as_dict(self) -> dict:
+        return {
+            "job_id": self.id,
+            "status": self.status,
+            "bytes": self.size,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            "patient_id": self.patient_id,
+            "resources": dict(self.resources),
+            "quarantined": dict(self.quarantined),
+            "rows": self.rows,
+            "embedded": self.embedded,
+            "unchanged": self.unchanged,
+            "error": self.error,
+        }
+
+
+class JobQueue:
+    """
+    Runs reindex jobs with bounded concurrency and keeps track of their status.
+    """
+
+    def __init__(self, workers: int, max_queued: int, max_kept: int, embed: bool = True):
+        """
+        :param workers: Number of jobs running at the same time.
+        :param max_queued: Number of jobs allowed to wait for a worker.
+        :param max_kept: Number of jobs kept for the status endpoints.
+        :param embed: Embed the indexed records for semantic search.
+        """
+        self.embed = embed
+        self.max_queued = max_queued
+        self.max_kept = max_kept
+        self._executor = futures.ThreadPoolExecutor(workers, thread_name_prefix="reindex")
+        self._jobs = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def submit(self, path: str, size: int, tolerant: bool = False, content_hash: str | None = None) -> ReindexJob:
+        """
+        Queue the spooled bundle in the file for indexing. The file is removed when the job is done.
+
+        :param tolerant: Quarantine the resources which fail to parse instead of failing the job.
+        :param content_hash: Content hash of the bundle, see fhir_transform.bundle_hash().
+        """
+        job = ReindexJob(path, size, tolerant, content_hash)
+        with self._lock:
+            queued = sum(1 for item in self._jobs.values() if item.status == "queued")
+            if queued >= self.max_queued:
+                raise QueueFull(f"{queued} reindex jobs are already queued")
+            self._jobs[job.id] = job
+            self._forget_old_jobs()
+        self._executor.submit(self._run, job)
+        return job
+
+    def _forget_old_jobs(self):
+        finished = [job_id for job_id, job in self._jobs.items() if job.status in ("finished", "failed")]
+        for job_id in finished[:max(0, len(self._jobs) - self.max_kept)]:
+            del self._jobs[job_id]
+
+    def get(self, job_id: str) -> ReindexJob | None:
+        return self._jobs.get(job_id)
+
+    def list(self) -> list[ReindexJob]:
+        with self._lock:
+            return list(self._jobs.values())
+
+    def _run(self, job: ReindexJob):
+        job.status = "running"
+        job.started_at = datetime.datetime.now(datetime.timezone.utc)
+        logger.info(f"Reindex job {job.id} started")
+        try:
+            if job.content_hash is not None and index_fhir.bundle_indexed(job.content_hash):
+                # Nothing to do, the same bundle has already been indexed
+                job.unchanged = True
+                job.status = "finished"
+                return
+            with open(job.path, 'rb') as f:
+                patient = index_fhir.parse_fhir(
+                    index_fhir.iter_fhir_entries(f),
+                    max_buffered_rows=index_fhir.STREAM_FLUSH_ROWS,
+                    stats=job.resources,
+                    tolerant=job.tolerant,
+                    errors=job.quarantined,
+                    bundle_hash=job.content_hash,
+                )
+            if patient is not None:
+                job.patient_id = patient.patient_id
+                job.rows = dict(patient.written)
+                if self.embed:
+                    job.status = "embedding"
+                    job.embedded = embeddings.index_records([patient.patient_id])
+            job.status = "finished"
+        except Exception as e:
+            logger.error(f"Reindex job {job.id} failed: {e!r}")
+            job.error = str(e)
+            job.status = "failed"
+        finally:
+            job.finished_at = datetime.datetime.now(datetime.timezone.utc)
+            os.remove(job.path)
+        logger.info(f"Reindex job {job.id} {job.status}")
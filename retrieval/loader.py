@@ -0,0 +1,251 @@
+#!/usr/bin/env python3
+
+"""
+Load whole directories of FHIR bundles (e.g. the Synthea dataset) into the database.
+
+The bundles are parsed in a pool of processes and the parsed rows are written by
+a bounded number of writer threads, each using one pooled database connection.
+The outcome of every file is appended to a manifest file, so an interrupted run
+can be resumed by running the same command again.
+
+Usage:
+    python loader.py path/to/fhir/ --workers 8 --writers 4
+
+Author: Olli Puhakka
+"""
+import os
+import sys
+import glob
+import json
+import time
+import argparse
+import collections
+import logging
+import multiprocessing
+from concurrent import futures
+
+import database
+import embeddings
+import fhir_transform
+import index_fhir
+import metrics
+
+logger = logging.getLogger(__file__)
+
+
+def find_bundles(paths: list[str]) -> list[str]:
+    """
+    Expand the given files, directories and glob patterns into a sorted list of json files.
+    """
+    files = set()
+    for path in paths:
+        if os.path.isdir(path):
+            files.update(glob.glob(os.path.join(path, "**", "*.json"), recursive=True))
+        elif os.path.isfile(path):
+            files.add(path)
+        else:
+            matches = glob.glob(path, recursive=True)
+            if not matches:
+                logger.warning(f"No files match {path}")
+            files.update(match for match in matches if os.path.isfile(match))
+    return sorted(os.path.abspath(file) for file in files)
+
+
+def read_manifest(path: str) -> dict[str, dict]:
+    """
+    Read the latest manifest entry of every file from a previous run.
+    """
+    entries = {}
+    if not os.path.isfile(path):
+        return entries
+    with open(path, 'r') as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                # Last line of an interrupted run may be incomplete
+                continue
+            entries[entry["path"]] = entry
+    return entries
+
+
+# Content hashes of the bundles in the ingestion ledger when the load started, set in the worker processes
+_indexed_bundles = frozenset()
+
+
+def init_worker(level: int, indexed_bundles: frozenset[str]):
+    global _indexed_bundles
+    metrics.configure_logging(level)
+    _indexed_bundles = indexed_bundles
+
+
+def indexed_bundles(db: database.Database) -> frozenset[str]:
+    """
+    Content hashes of the bundles in the ingestion ledger.
+    """
+    return frozenset(content_hash for content_hash, in db.db_execute("SELECT content_hash FROM ingested_bundles", ()))
+
+
+def parse_bundle(path: str, tolerant: bool = False) -> tuple[dict[str, list[tuple]] | None, int, collections.Counter]:
+    """
+    Parse the bundle without touching the database. Runs in a worker process.
+
+    :param tolerant: Quarantine the resources which fail to parse instead of failing the bundle.
+    :return: Parsed rows per table, None if the same bundle has already been indexed,
+             the number of resources in the bundle and the number of quarantined
+             resources per error class.
+    """
+    with open(path, 'rb') as f:
+        content = f.read()
+    content_hash = fhir_transform.bundle_hash(content)
+    errors = collections.Counter()
+    if content_hash in _indexed_bundles:
+        return None, 0, errors
+    data = json.loads(content)
+    rows = fhir_transform.bundle_rows(data['entry'], tolerant=tolerant, errors=errors)
+    patient_id = rows["patients"][0][0] if rows["patients"] else None
+    rows["ingested_bundles"].append((content_hash, patient_id))
+    return rows, len(data['entry']), errors
+
+
+def load(paths: list[str], workers: int, writers: int, manifest_path: str, retry_failed: bool = True,
+         tolerant: bool = False) -> bool:
+    """
+    Load the bundles in parallel and record the result of each file in the manifest.
+
+    The bundles already in the ingestion ledger are not parsed again and recorded as
+    unchanged, only the changed resources of the other bundles are written.
+    In tolerant mode the resources which fail to parse are written to the ingest_errors
+    table and the rest of the bundle is loaded, the quarantined resources per error
+    class are recorded in the manifest and logged at the end.
+
+    :return: True if all the files were loaded successfully.
+    """
+    done = read_manifest(manifest_path)
+    pending = [
+        path for path in paths
+        if path not in done or (done[path]["status"] == "failed" and retry_failed)
+    ]
+    skipped = len(paths) - len(pending)
+    if skipped:
+        logger.info(f"Skipping {skipped} files already in the manifest {manifest_path}")
+    if not pending:
+        return True
+
+    db = database.Database()
+    # Keep a bounded number of bundles in memory between parsing and writing
+    max_in_flight = workers + 2 * writers
+    start = time.monotonic()
+    last_report = start
+    loaded = failed = unchanged = rows_total = 0
+    quarantined = collections.Counter()
+
+    # Spawned workers don't inherit the database connections of this process
+    context = multiprocessing.get_context("spawn")
+    level = logging.getLogger().level
+    with futures.ProcessPoolExecutor(workers, mp_context=context, initializer=init_worker,
+                                     initargs=(level, indexed_bundles(db))) as parsers, \
+            futures.ThreadPoolExecutor(writers, thread_name_prefix="writer") as writer_pool, \
+            open(manifest_path, 'a') as manifest:
+        queue = iter(pending)
+        parsing = {}
+        writing = {}
+        started = {}
+
+        def submit_next():
+            path = next(queue, None)
+            if path is not None:
+                started[path] = time.monotonic()
+                parsing[parsers.submit(parse_bundle, path, tolerant)] = path
+
+        def record(path, status, rows=0, resources=0, error=None, errors=None):
+            entry = {
+                "path": path,
+                "status": status,
+                "resources": resources,
+                "rows": rows,
+                "seconds": round(time.monotonic() - started.pop(path), 3),
+                "error": error,
+            }
+            if errors:
+                entry["quarantined"] = dict(errors)
+            manifest.write(json.dumps(entry) + "\n")
+            manifest.flush()
+
+        for _ in range(max_in_flight):
+            submit_next()
+
+        while parsing or writing:
+            finished, _ = futures.wait([*parsing, *writing], return_when=futures.FIRST_COMPLETED)
+            for future in finished:
+                if future in parsing:
+                    path = parsing.pop(future)
+                    try:
+                        rows, resources, errors = future.result()
+                    except Exception as e:
+                        logger.error(f"Parsing {path} failed: {e!r}")
+                        record(path, "failed", error=repr(e))
+                        failed += 1
+                        submit_next()
+                        continue
+                    if rows is None:
+                        record(path, "unchanged")
+                        unchanged += 1
+                        submit_next()
+                        continue
+                    writing[writer_pool.submit(index_fhir.flush_rows, rows, db)] = (path, resources, errors)
+                else:
+                    path, resources, errors = writing.pop(future)
+                    try:
+                        counts = future.result()
+                    except Exception as e:
+                        logger.error(f"Writing {path} failed: {e!r}")
+                        record(path, "failed", resources=resources, error=repr(e))
+                        failed += 1
+                    else:
+                        rows = sum(counts.values())
+                        record(path, "ok", rows=rows, resources=resources, errors=errors)
+                        rows_total += rows
+                        loaded += 1
+                        quarantined.update(errors)
+                    submit_next()
+
+            now = time.monotonic()
+            if now - last_report >= 5 or not (parsing or writing):
+                last_report = now
+                elapsed = now - start
+                logger.info(
+                    f"{loaded + failed + unchanged}/{len(pending)} bundles, {failed} failed, {unchanged} unchanged, "
+                    f"{(loaded + failed + unchanged) / elapsed:.1f} bundles/s, {rows_total / elapsed:.0f} rows/s"
+                )
+
+    for error_class, count in quarantined.most_common():
+        logger.info(f"Quarantined {count} resources: {error_class}")
+
+    database.get_pool().closeall()
+    return failed == 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Index directories of FHIR bundles to a database in parallel.")
+    parser.add_argument("paths", nargs="+", help="Json files, directories or glob patterns of the FHIR bundles.")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="Number of parser processes (default: number of cores).")
+    parser.add_argument("--writers", type=int, default=4, help="Number of concurrent database writers (default: 4).")
+    parser.add_argument("--manifest", default="loader_manifest.jsonl", help="File recording the result of each bundle, used to resume interrupted runs.")
+    parser.add_argument("--skip-failed", action="store_true", help="Don't retry files which failed in a previous run.")
+    parser.add_argument("--embed", action="store_true", help="Embed the indexed records for semantic search after loading.")
+    parser.add_argument("--tolerant", action="store_true", help="Quarantine the resources which fail to parse into ingest_errors instead of failing the bundle.")
+    parser.add_argument("--verbose", action="store_true", help="Enable debug logging.")
+    args = parser.parse_args()
+
+    metrics.configure_logging(logging.DEBUG if args.verbose else None)
+    if args.writers > int(os.environ.get('POSTGRES_POOL_MAX', 10)):
+        logger.warning("More writers than POSTGRES_POOL_MAX connections, some writers will wait for a connection")
+
+    files = find_bundles(args.paths)
+    logger.info(f"Found {len(files)} bundles")
+    ok = load(files, args.workers, args.writers, args.manifest, retry_failed=not args.skip_failed, tolerant=args.tolerant)
+    if args.embed:
+        logger.info(f"Embedded {embeddings.index_records()} records")
+        database.get_pool().closeall()
+    sys.exit(0 if ok else 1)
@@ -6,27 +6,151 @@ Simple API for Retrieval.
 
 Author: Olli Puhakka
 """
+import os
+import json
+import uuid
+import base64
+import hashlib
+import asyncio
+import collections
 import datetime
+import tempfile
+import time
+import contextlib
 import logging
 logger = logging.getLogger(__file__)
-from fastapi import FastAPI, Request
+import anyio
+import anyio.from_thread
+import ijson
+from fastapi import FastAPI, Query, Request, Response
+from fastapi.responses import StreamingResponse
+from fastapi.concurrency import run_in_threadpool
 from pydantic import BaseModel
 
+import async_database
+import embeddings
+import fhir_transform
 import index_fhir
+import jobs
+import metrics
 import patient
+import queries
+import report
+import report_cache
 
-class Fhir(BaseModel):
-    type: str
-    entry: list
-    resourceType: str
+metrics.configure_logging()
 
 class SearchRequest(BaseModel):
     resourceType: str
     query: str
-    searchParams: dict
+    searchParams: dict = {}
+
+
+class BatchReportRequest(BaseModel):
+    ids: list[uuid.UUID]
+    max_tokens: int | None = None
+    max_chars: int | None = None
+
+
+class RequestBodyReader:
+    """
+    Blocking file-like reader of a request body, for parsing it in a worker thread
+    while the body is still being received.
+    """
+
+    def __init__(self, request: Request):
+        self._chunks = request.stream()
+        self._buffer = b""
+        self._done = False
+
+    async def _next_chunk(self) -> bytes:
+        try:
+            return await anext(self._chunks)
+        except StopAsyncIteration:
+            self._done = True
+            return b""
+
+    def read(self, size: int = -1) -> bytes:
+        while not self._done and (size < 0 or len(self._buffer) < size):
+            # Fetch the next chunk from the event loop
+            self._buffer += anyio.from_thread.run(self._next_chunk)
+        if size < 0:
+            size = len(self._buffer)
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+
+class ClosingStreamingResponse(StreamingResponse):
+    """
+    Streaming response which closes its async generator when the response ends, also
+    when the client disconnects in the middle. The generator, e.g. a streamed report,
+    then releases the pooled connection it reads from right away.
+    """
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            await self.body_iterator.aclose()
+
 
+@contextlib.asynccontextmanager
+async def lifespan(app: FastAPI):
+    yield
+    await async_database.close_pool()
 
-app = FastAPI()
+
+app = FastAPI(lifespan=lifespan)
+
+MARKDOWN = "text/markdown; charset=utf-8"
+
+reindex_jobs = jobs.JobQueue(
+    workers    = int(os.environ.get('REINDEX_WORKERS', 2)),
+    max_queued = int(os.environ.get('REINDEX_MAX_QUEUED', 100)),
+    max_kept   = int(os.environ.get('REINDEX_JOBS_KEPT', 1000)),
+    embed      = os.environ.get('EMBED_ON_INGEST', 'true').lower() in ('1', 'true', 'yes'),
+)
+
+
+@app.middleware("http")
+async def record_request_duration(request: Request, call_next):
+    """
+    Record the time until the response starts per endpoint, streamed bodies are not included.
+    """
+    started = time.perf_counter()
+    response = await call_next(request)
+    # The route template keeps e.g. the patient ids out of the labels
+    route = request.scope.get("route")
+    metrics.REQUEST_DURATION.observe(
+        time.perf_counter() - started,
+        request.method, route.path if route is not None else "unmatched", response.status_code,
+    )
+    return response
+
+
+def collect_service_metrics() -> list[str]:
+    """
+    Metrics of the report cache, the reindex jobs and the async connection pool,
+    read when the metrics are rendered.
+    """
+    lines = []
+    cache = report_cache.get_cache().info()
+    for name in ("hits", "disk_hits", "misses", "evictions", "invalidations"):
+        lines.extend(metrics.gauge(f"report_cache_{name}_total", f"Report cache {name.replace('_', ' ')}.", cache[name], kind="counter"))
+    lines.extend(metrics.gauge("report_cache_entries", "Reports in the in-memory report cache.", cache["entries"]))
+    statuses = collections.Counter(job.status for job in reindex_jobs.list())
+    lines.extend(["# HELP reindex_jobs Reindex jobs kept per status.", "# TYPE reindex_jobs gauge"])
+    lines.extend(f'reindex_jobs{{status="{status}"}} {statuses[status]}' for status in ("queued", "running", "embedding", "finished", "failed"))
+    pool = async_database._pool
+    if pool is not None:
+        stats = pool.get_stats()
+        lines.extend(metrics.gauge("db_pool_connections", "Open connections of the async pool.", stats.get("pool_size", 0)))
+        lines.extend(metrics.gauge("db_pool_available_connections", "Idle connections of the async pool.", stats.get("pool_available", 0)))
+        lines.extend(metrics.gauge("db_pool_requests_waiting", "Requests waiting for a connection of the async pool.", stats.get("requests_waiting", 0)))
+    return lines
+
+
+metrics.register_collector(collect_service_metrics)
 
 
 @app.get("/")
@@ -34,107 +158,429 @@ def read_root():
     return {"Hello": "World"}
 
 
-@app.post("/reindex")
-def reindex_jsons(item: Fhir):
+@app.post("/reindex", status_code=202)
+async def reindex_jsons(request: Request, response: Response, tolerant: bool = False):
     """
-    Reindex the JSONs in the FHIR item.
+    Queue the FHIR bundle in the request body for reindexing.
+
+    The bundle is spooled to disk and indexed in the background, the returned
+    job id can be used to follow the progress at /reindex/{job_id}.
+    With tolerant=true the resources which fail to parse are quarantined into the
+    ingest_errors table and the rest of the bundle is indexed.
+    A bundle which has already been indexed as is finishes right away, unchanged
+    resources of a changed bundle are not written again.
     """
-    logger.info(f"Reindexing JSONs in FHIR item of type {item.resourceType}")
-    item_dict = item.dict()
+    fd, path = tempfile.mkstemp(suffix=".json", prefix="reindex-", dir=os.environ.get('REINDEX_SPOOL_DIR'))
+    os.close(fd)
+    size = 0
+    hasher = fhir_transform.bundle_hasher()
+    async with await anyio.open_file(path, 'wb') as f:
+        async for chunk in request.stream():
+            await f.write(chunk)
+            hasher.update(chunk)
+            size += len(chunk)
     try:
-        index_fhir.parse_fhir(item_dict['entry'])
-    except NotImplementedError as e:
+        job = reindex_jobs.submit(path, size, tolerant, hasher.hexdigest())
+    except jobs.QueueFull as e:
+        os.remove(path)
         logger.error(f"Error: {e}")
+        response.status_code = 503
         return {"error": str(e)}
+    logger.info(f"Queued reindex job {job.id} ({size} bytes)")
+    return {"job_id": job.id, "status": job.status}
+
+
+@app.get("/reindex")
+async def list_reindex_jobs():
+    """
+    List the recent reindex jobs and their status.
+    """
+    return [job.as_dict() for job in reindex_jobs.list()]
+
+
+@app.get("/reindex/{job_id}")
+async def get_reindex_job(job_id: str):
+    """
+    Retrieve the status and progress of a reindex job.
+
+    Example: {"job_id": "...", "status": "running", "resources": {"Encounter": 12, "Observation": 140},
+              "quarantined": {"Observation/NotImplementedError": 2}, ...}
+    """
+    job = reindex_jobs.get(job_id)
+    if job is None:
+        return {"error": "Reindex job not found"}
+    return job.as_dict()
+
+
+@app.post("/reindex/stream")
+async def reindex_stream(request: Request, tolerant: bool = False):
+    """
+    Reindex the FHIR bundle in the request body.
+
+    The bundle is parsed incrementally while the body is received and the rows are
+    written in batches, so the memory use stays flat regardless of the bundle size.
+    With tolerant=true the resources which fail to parse are quarantined, the counts
+    per error class are returned.
+    """
+    logger.info("Reindexing streamed FHIR bundle")
+    entries = index_fhir.iter_fhir_entries(RequestBodyReader(request))
+    errors = collections.Counter()
+    try:
+        await run_in_threadpool(index_fhir.parse_fhir, entries, max_buffered_rows=index_fhir.STREAM_FLUSH_ROWS,
+                                tolerant=tolerant, errors=errors)
+    except (NotImplementedError, ijson.JSONError) as e:
+        logger.error(f"Error: {e}")
+        return {"error": str(e)}
+    if tolerant:
+        return {"status": "success", "quarantined": dict(errors)}
     return {"status":"success"}
 
 
 @app.post("/search")
 def search_database(data: SearchRequest):
     """
-    Search the database for the given FHIR item.
+    Search the indexed records semantically closest to the query.
+
+    - resourceType: Condition, Observation, Procedure, MedicationRequest, CarePlan or * for all of them.
+    - searchParams: Optional "patient" id, "from" and "to" dates and "limit" of results (default 10, max 100).
+
+    Example: {"results": [{"resourceType": "Condition", "content": "Hypertension (active)", "score": 0.83, ...}]}
     """
-    pass
+    if data.resourceType in ("*", ""):
+        resource_types = None
+    elif data.resourceType in embeddings.RECORD_QUERIES:
+        resource_types = [data.resourceType]
+    else:
+        return {"error": f"Searching {data.resourceType} resources is not supported"}
+    params = data.searchParams
+    try:
+        date_from = datetime.datetime.fromisoformat(params["from"]) if params.get("from") else None
+        date_to = datetime.datetime.fromisoformat(params["to"]) if params.get("to") else None
+        limit = min(max(int(params.get("limit", 10)), 1), 100)
+    except (TypeError, ValueError) as e:
+        return {"error": f"Invalid search parameters: {e}"}
+    results = embeddings.search(
+        data.query,
+        resource_types=resource_types,
+        patient_id=params.get("patient"),
+        date_from=date_from,
+        date_to=date_to,
+        limit=limit,
+    )
+    return {"results": results}
 
 @app.get("/patient/{id}/allergies")
-def get_patient_allergies(id: str):
+async def get_patient_allergies(id: str):
     """
     Retrieve allergies for a specific patient.
 
     Example: {"food":["Peanuts (severe)","Wheat (severe)","Eggs (mild)","Soya (mild)","Tree pollen (severe)","Grass pollen (mild)","Dander (animal) (severe)","Mould (severe)"]}
     """
-    p = patient.Patient(id)
-    allergies = p.allergies()
+    p = patient.AsyncPatient(id)
+    try:
+        # The patient lookup and the allergies are independent queries
+        _, allergies = await asyncio.gather(p.load(), p.allergies())
+    except patient.PatientNotFound as e:
+        logger.error(f"Error: {e}")
+        return {"error": "Patient not found"}
     if allergies is None:
         return {"error": "Patient allergies not found"}
     return allergies
 
+@app.get("/patient/{id}/summary")
+async def get_patient_summary(id: str):
+    """
+    Retrieve the precomputed summary of a patient with a single lookup.
+
+    Example: {"age": 59, "gender": "female", "active_conditions": [{"display": "Hypertension", "onset_date": "..."}],
+              "active_medications": [...], "allergies": {"food": ["Peanuts (severe)"]},
+              "latest_observations": [{"display": "Body Weight", "value": 81.2, "unit": "kg", "date": "..."}],
+              "encounters": {"count": 20, "by_class": {"ambulatory": 19, "emergency": 1}, "first": "...", "last": "..."}, ...}
+    """
+    try:
+        return await patient.AsyncPatient(id).summary()
+    except patient.PatientNotFound as e:
+        logger.error(f"Error: {e}")
+        return {"error": "Patient summary not found"}
+
+
+def report_version_token(p: patient.PatientRecords) -> str:
+    """
+    Opaque token identifying the patient data a report was rendered from.
+
+    Passing the token back as since_version returns only the encounters written, or with
+    records written, after the data version of the report.
+    """
+    token = json.dumps({"v": p.data_version()}, separators=(",", ":"))
+    return base64.urlsafe_b64encode(token.encode()).decode().rstrip("=")
+
+
+def parse_report_version_token(token: str) -> int:
+    """
+    Parse a token from report_version_token.
+
+    :return: The data version of the patient the report was rendered from.
+    :raises ValueError: If the token is not valid.
+    """
+    try:
+        data = json.loads(base64.urlsafe_b64decode(token + "=" * (-len(token) % 4)))
+        return int(data["v"])
+    except (TypeError, KeyError, AttributeError, UnicodeDecodeError, base64.binascii.Error, json.JSONDecodeError) as e:
+        raise ValueError(f"Invalid report version token: {token}") from e
+
+
+def report_etag(p: patient.PatientRecords, *options) -> str:
+    """
+    Weak ETag of a report of the patient. The report only changes with the data version
+    of the patient, the age in its header and the report options.
+    """
+    key = repr((p.id, p.data_version(), p.age(), options))
+    return f'W/"{hashlib.sha256(key.encode()).hexdigest()[:32]}"'
+
+
+def etag_matches(if_none_match: str | None, etag: str) -> bool:
+    """
+    Check the If-None-Match header of a request against the ETag, with the weak comparison.
+    """
+    if not if_none_match:
+        return False
+    tags = {tag.strip().removeprefix("W/") for tag in if_none_match.split(",")}
+    return "*" in tags or etag.removeprefix("W/") in tags
+
+
+def parse_include(include: str | None) -> set[str] | None:
+    """
+    Parse the comma separated names of the records to include in a report.
+
+    :raises ValueError: If a name is not one of patient.RECORD_NAMES.
+    """
+    if include is None:
+        return None
+    names = {name.strip() for name in include.split(",") if name.strip()}
+    unknown = names.difference(patient.RECORD_NAMES)
+    if unknown:
+        raise ValueError(f"Unknown records {', '.join(sorted(unknown))}, expected some of {', '.join(patient.RECORD_NAMES)}")
+    return names
+
+
 @app.get("/patient/{id}/report")
-def get_patient_encounters(id: str, request: Request):
+async def get_patient_encounters(id: str, request: Request, response: Response, since: datetime.datetime | None = None,
+                                 since_version: str | None = None, max_tokens: int | None = None,
+                                 max_chars: int | None = None, stream: bool = False,
+                                 from_: datetime.datetime | None = Query(None, alias="from"),
+                                 to: datetime.datetime | None = None, include: str | None = None,
+                                 limit_encounters: int | None = None):
     """
     Retrieve full report of all patient encounters.
+
+    - since: Only the encounters which started after this time.
+    - since_version: Only the encounters written, or with records written, after the report
+      which returned this token.
+    - from, to: Only the encounters which started at or after `from` and before `to`.
+    - include: Only these records of the encounters, comma separated: conditions, observations,
+      procedures, care_plans, immunizations, medications. The other tables are not read.
+    - limit_encounters: Only this many of the most recent encounters.
+    - max_tokens, max_chars: Size budget of the report. Observations are collapsed into
+      trends and older encounters are summarized to fit in the budget.
+    - stream: Stream the report as text/markdown, each encounter as soon as its rows are read.
+      The report is then not JSON encoded and budgets are not supported.
+
+    The X-Report-Version header of the response has the token of the returned report.
+    The full report is cached until the data of the patient changes.
+    The response has an ETag, a request with a matching If-None-Match gets 304 Not Modified
+    without the report being rendered.
     """
+    budget = report.report_budget(max_tokens, max_chars)
+    if budget is not None and budget <= 0:
+        return {"error": "max_tokens and max_chars must be positive"}
+    if budget is not None and stream:
+        return {"error": "max_tokens and max_chars are not supported with stream"}
+    if from_ is not None and to is not None:
+        try:
+            if from_ >= to:
+                return {"error": "from must be before to"}
+        except TypeError:
+            return {"error": "from and to must both have a time zone or neither"}
+    if limit_encounters is not None and limit_encounters <= 0:
+        return {"error": "limit_encounters must be positive"}
+    try:
+        include = parse_include(include)
+    except ValueError as e:
+        logger.error(f"Error: {e}")
+        return {"error": str(e)}
+    window = {"start": from_, "end": to, "limit": limit_encounters}
+    scope = report.describe_scope(from_, to, limit_encounters, include)
+    version = None
+    if since_version is not None:
+        try:
+            version = parse_report_version_token(since_version)
+        except ValueError as e:
+            logger.error(f"Error: {e}")
+            return {"error": "Invalid since_version"}
 
     # Create a patient instance for the specific patient.
-    p = patient.Patient(id)
-
-    report = [
-        f"Patient is {p.age()} year old {p.gender()}.",
-        f"**Date of Birth:** {p.date_of_birth()}",
-        "",
-        "## Medical encounters",
-    ]
-    for encounter in p.encounters():
-        report.append(f"### {encounter['class'].capitalize()} - {encounter['type']}")
-        report.append(f"- **Date**: {encounter['period_start'].replace(tzinfo=None)}")
-        if encounter['duration'] > datetime.timedelta(hours=1):
-            report.append(f"- **Duration**: {encounter['duration']}")
-        report.append(f"- **Reason**: {encounter['reason']}")
-
-        # Add conditions to the report:
-        conditions = [
-            condition['code_display'] if condition['abatement_date'] is None
-            else f"{condition['code_display']} (until {condition['abatement_date'].replace(tzinfo=None)})"
-            for condition in p.conditions(encounter_id=encounter['id'])
-        ]
-        if conditions:
-            report.append(f"- **Conditions confirmed:** {", ".join(conditions)}")
-
-        # Add observations to the report
-        observations = p.observations(encounter_id=encounter['id'])
-        if observations:
-            report.append("- **Observations**:")
-        for observation in observations:
-            for i in range(len(observation['display'])):
-                report.append(f"  - {observation['display'][i]}: {observation['value'][i]} {observation['unit'][i]}")
-
-        # Add procedures to the report
-        procedures = p.procedures(encounter_id=encounter['id'])
-        if procedures:
-            report.append("- **Procedures**:")
-        for procedure in procedures:
-            report.append(f"  - {procedure['code_display']}")
-
-        # Add care plans to the report
-        care_plans = p.care_plans(encounter_id=encounter['id'])
-        if care_plans:
-            report.append("- **Care Plans**:")
-        for care_plan in care_plans:
-            report.append(f"  - {care_plan['details']} (Status: {care_plan['status']})")
-
-        # Add immunizations to the report
-        immunizations = p.immunizations(encounter_id=encounter['id'])
-        if immunizations:
-            report.append("- **Immunizations**:")
-        for immunization in immunizations:
-            report.append(f"  - {immunization['vaccine_display']}")
-
-        # Add medication to the report
-        medications = p.medications(encounter_id=encounter['id'])
-        if medications:
-            report.append("- **Medications**:")
-        for medication in medications:
-            report.append(f"  - {medication['medication_display']}")
-
-        report.append("")
-    return "\n".join(report)
+    p = patient.AsyncPatient(id)
+    try:
+        await p.load()
+    except patient.PatientNotFound as e:
+        logger.error(f"Error: {e}")
+        return {"error": "Patient not found"}
+
+    headers = {
+        "X-Report-Version": report_version_token(p),
+        "ETag": report_etag(p, since, since_version, budget, stream, from_, to, limit_encounters,
+                            None if include is None else sorted(include)),
+    }
+    if etag_matches(request.headers.get("If-None-Match"), headers["ETag"]):
+        return Response(status_code=304, headers=headers)
+    response.headers.update(headers)
+
+    if since is not None or since_version is not None or scope is not None:
+        # The filters are pushed down into the queries, the records outside them are never read
+        since_text = None
+        if since_version is not None:
+            since_text = "the previous report"
+        elif since is not None:
+            since_text = since.isoformat()
+        if since_version is not None and version == p.data_version():
+            # Nothing has been indexed for the patient since the previous report
+            rendered = report.render_report(p, [], {}, since=since_text, max_chars=budget, scope=scope)
+            return Response(rendered, media_type=MARKDOWN, headers=headers) if stream else rendered
+        if stream:
+            return ClosingStreamingResponse(
+                report.stream_report(
+                    p, p.stream_encounters(since=since, version_after=version, include=include, **window),
+                    since=since_text, scope=scope,
+                ),
+                media_type=MARKDOWN,
+                headers=headers,
+            )
+        encounters, records = await asyncio.gather(
+            p.encounters(since=since, version_after=version, **window),
+            p.encounter_records(since=since, version_after=version, include=include, **window),
+        )
+        return report.render_report(p, encounters, records, since=since_text, max_chars=budget, scope=scope)
+
+    cache = report_cache.get_cache()
+    options = () if budget is None else (("max_chars", budget),)
+    rendered = cache.get(id, p.data_version(), options)
+    if stream:
+        # Streamed reports are not cached, the point is not to hold the whole report in memory
+        if rendered is not None:
+            return Response(rendered, media_type=MARKDOWN, headers=headers)
+        return ClosingStreamingResponse(report.stream_report(p, p.stream_encounters()), media_type=MARKDOWN, headers=headers)
+    if rendered is None:
+        # Fetch the encounters and their child records concurrently, one query per table
+        encounters, records = await asyncio.gather(p.encounters(), p.encounter_records())
+        rendered = report.render_report(p, encounters, records, max_chars=budget)
+        cache.put(id, p.data_version(), rendered, options)
+    return rendered
+
+
+async def fetch_report_batch(patient_ids: list[str], options: tuple) -> tuple[dict, dict, dict, dict]:
+    """
+    Fetch what is needed to render the reports of the patients with set based queries.
+
+    Reports found in the cache are not fetched again.
+
+    :return: Patients by id, cached reports by id, encounters by patient id and the encounter records.
+    """
+    cache = report_cache.get_cache()
+    patients = await patient.AsyncPatientBatch(patient_ids).load()
+    cached = {}
+    for patient_id, p in patients.items():
+        rendered = cache.get(patient_id, p.data_version(), options)
+        if rendered is not None:
+            cached[patient_id] = rendered
+    missing = [patient_id for patient_id in patients if patient_id not in cached]
+    if not missing:
+        return patients, cached, {}, {}
+    batch = patient.AsyncPatientBatch(missing)
+    encounters, records = await asyncio.gather(batch.encounters(), batch.encounter_records())
+    return patients, cached, encounters, records
+
+
+async def stream_batch_reports(patient_ids: list[str], budget: int | None):
+    """
+    Render the reports of the patients and yield them as NDJSON lines.
+
+    The patients are fetched in chunks of BATCH_REPORT_CHUNK_SIZE patients. The next chunk
+    is fetched while the reports of the current chunk are rendered in the threadpool, at most
+    BATCH_REPORT_CONCURRENCY at a time. The lines are yielded in the order of the patients.
+    """
+    chunk_size = int(os.environ.get('BATCH_REPORT_CHUNK_SIZE', 100))
+    chunks = [patient_ids[i:i + chunk_size] for i in range(0, len(patient_ids), chunk_size)]
+    options = () if budget is None else (("max_chars", budget),)
+    cache = report_cache.get_cache()
+    rendering = asyncio.Semaphore(int(os.environ.get('BATCH_REPORT_CONCURRENCY', 8)))
+
+    async def render_line(patient_id: str, patients: dict, cached: dict, encounters: dict, records: dict) -> str:
+        p = patients.get(patient_id)
+        if p is None:
+            return json.dumps({"id": patient_id, "error": "Patient not found"}) + "\n"
+        rendered = cached.get(patient_id)
+        if rendered is None:
+            async with rendering:
+                rendered = await run_in_threadpool(
+                    report.render_report, p, encounters.get(patient_id, []), records, max_chars=budget,
+                )
+            cache.put(patient_id, p.data_version(), rendered, options)
+        return json.dumps({"id": patient_id, "version": report_version_token(p), "report": rendered}) + "\n"
+
+    fetching = asyncio.ensure_future(fetch_report_batch(chunks[0], options)) if chunks else None
+    try:
+        for i, chunk in enumerate(chunks):
+            fetched = await fetching
+            fetching = asyncio.ensure_future(fetch_report_batch(chunks[i + 1], options)) if i + 1 < len(chunks) else None
+            lines = await asyncio.gather(*(render_line(patient_id, *fetched) for patient_id in chunk))
+            for line in lines:
+                yield line
+    finally:
+        if fetching is not None:
+            fetching.cancel()
+
+
+@app.post("/patients/report")
+async def get_patients_reports(data: BatchReportRequest):
+    """
+    Retrieve the full reports of many patients.
+
+    The records of all the patients are fetched with a few set based queries and the
+    reports are streamed back as NDJSON, one line per patient as soon as it is rendered.
+    max_tokens and max_chars work as in /patient/{id}/report.
+
+    Example line: {"id": "...", "version": "...", "report": "Patient is 59 year old female. ..."}
+    """
+    budget = report.report_budget(data.max_tokens, data.max_chars)
+    if budget is not None and budget <= 0:
+        return {"error": "max_tokens and max_chars must be positive"}
+    # Keep the order of the request, without duplicates
+    patient_ids = list(dict.fromkeys(str(patient_id) for patient_id in data.ids))
+    return ClosingStreamingResponse(stream_batch_reports(patient_ids, budget), media_type="application/x-ndjson")
+
+
+@app.get("/cache/stats")
+async def get_cache_stats():
+    """
+    Retrieve the hit, miss and eviction counters of the report cache.
+    """
+    return report_cache.get_cache().info()
+
+
+@app.get("/queries/stats")
+async def get_query_stats():
+    """
+    Retrieve the number of executions and the latencies of the prepared statements per statement name.
+
+    Example: {"observations": {"variants": 2, "count": 120, "total_ms": 84.1, "mean_ms": 0.7, "max_ms": 5.2}}
+    """
+    return queries.stats()
+
+
+@app.get("/metrics")
+async def get_metrics():
+    """
+    Metrics of the service in the Prometheus text format: query and endpoint latencies,
+    rows returned, indexed resources and rows, report cache and connection pool.
+    """
+    return Response(metrics.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
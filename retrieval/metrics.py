@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+
+"""
+Instrumentation of the retrieval service.
+
+Counters and histograms of the database queries, the endpoints and the indexer,
+rendered in the Prometheus text format by /metrics. The metrics are kept in the
+process, so each worker of the service has its own.
+
+Logging is configured here as well, from the environment:
+- LOG_LEVEL: level of the root logger (default INFO)
+- SLOW_QUERY_MS: log the queries which take at least this many milliseconds
+  at WARNING level (default: disabled)
+
+Author: Olli Puhakka
+"""
+import os
+import bisect
+import threading
+import logging
+from typing import Callable
+
+logger = logging.getLogger(__file__)
+
+# Upper bounds of the histogram buckets in seconds
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def configure_logging(level: int | str | None = None):
+    """
+    Configure the root logger with the level from LOG_LEVEL, INFO by default.
+    """
+    if level is None:
+        level = os.environ.get('LOG_LEVEL', 'INFO').upper()
+    logging.basicConfig(level=level)
+
+
+def slow_query_threshold() -> float | None:
+    """
+    Return the slow query threshold in seconds, None if slow queries are not logged.
+    """
+    value = os.environ.get('SLOW_QUERY_MS')
+    return float(value) / 1000 if value else None
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names: tuple[str, ...], values: tuple, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _number(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+class Counter:
+    """
+    Monotonically increasing count per label values.
+    """
+
+    def __init__(self, name: str, documentation: str, labels: tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *label_values, amount: float = 1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def render(self) -> list[str]:
+        with self._lock:
+            values = sorted(self._values.items())
+        return [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} counter",
+            *(f"{self.name}{_labels(self.labels, label_values)} {_number(value)}" for label_values, value in values),
+        ]
+
+
+class Histogram:
+    """
+    Distribution of observed values per label values, in cumulative buckets.
+    """
+
+    def __init__(self, name: str, documentation: str, labels: tuple[str, ...] = (),
+                 buckets: tuple[float, ...] = DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self.buckets = tuple(sorted(buckets))
+        self._values = {}  # label values -> [count per bucket (last one +Inf), sum]
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, *label_values):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(label_values)
+            if entry is None:
+                entry = self._values[label_values] = [[0] * (len(self.buckets) + 1), 0.0]
+            entry[0][index] += 1
+            entry[1] += value
+
+    def render(self) -> list[str]:
+        with self._lock:
+            values = sorted((label_values, list(counts), total) for label_values, (counts, total) in self._values.items())
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} histogram",
+        ]
+        for label_values, counts, total in values:
+            cumulative = 0
+            for bound, count in zip((*self.buckets, "+Inf"), counts):
+                cumulative += count
+                le = bound if bound == "+Inf" else _number(bound)
+                bucket = _labels(self.labels, label_values, f'le="{le}"')
+                lines.append(f"{self.name}_bucket{bucket} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(self.labels, label_values)} {repr(total)}")
+            lines.append(f"{self.name}_count{_labels(self.labels, label_values)} {cumulative}")
+        return lines
+
+
+QUERY_DURATION = Histogram("db_query_duration_seconds", "Time spent executing database queries.", ("statement",))
+QUERY_ROWS = Counter("db_query_rows_total", "Rows returned or affected by database queries.", ("statement",))
+SLOW_QUERIES = Counter("db_slow_queries_total", "Queries slower than SLOW_QUERY_MS.", ("statement",))
+REQUEST_DURATION = Histogram("http_request_duration_seconds", "Time until the response of an endpoint started.",
+                             ("method", "route", "status"))
+RESOURCES_INDEXED = Counter("fhir_resources_indexed_total", "FHIR resources parsed by the indexer.", ("resource_type",))
+ROWS_WRITTEN = Counter("fhir_rows_written_total", "Rows written by the indexer.", ("table",))
+INGEST_ERRORS = Counter("fhir_ingest_errors_total", "Resources quarantined by the indexer in tolerant mode.",
+                        ("resource_type", "error_class"))
+
+_metrics = [QUERY_DURATION, QUERY_ROWS, SLOW_QUERIES, REQUEST_DURATION, RESOURCES_INDEXED, ROWS_WRITTEN, INGEST_ERRORS]
+_collectors = []
+
+
+def register_collector(collect: Callable[[], list[str]]):
+    """
+    Register a function returning metric lines computed when the metrics are rendered,
+    e.g. the counters of the report cache.
+    """
+    _collectors.append(collect)
+
+
+def gauge(name: str, documentation: str, value: float, kind: str = "gauge") -> list[str]:
+    """
+    Lines of a single value metric without labels, for the collectors.
+    """
+    return [f"# HELP {name} {documentation}", f"# TYPE {name} {kind}", f"{name} {_number(value)}"]
+
+
+def render() -> str:
+    """
+    Render all the metrics in the Prometheus text format.
+    """
+    lines = []
+    for metric in _metrics:
+        lines.extend(metric.render())
+    for collect in _collectors:
+        try:
+            lines.extend(collect())
+        except Exception as e:
+            logger.warning(f"Metric collector {collect.__name__} failed: {e!r}")
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+
+"""
+Apply the versioned schema migrations in database/migrations to an existing database.
+
+Migrations are plain SQL files named <version>_<name>.sql. Each pending migration
+is applied in its own transaction and recorded in the schema_migrations table,
+so running the script again only applies the migrations added since.
+Fresh databases created with create_database.sql already include all migrations.
+
+The migrations create indexes and tables, which requires the owner of the tables,
+so the script connects as POSTGRES_MIGRATION_USER (default: postgres) with
+POSTGRES_MIGRATION_PASSWORD (default: POSTGRES_PASSWORD).
+
+Usage:
+    python migrate.py [--directory migrations] [--list]
+
+Author: Olli Puhakka
+"""
+import os
+import re
+import argparse
+import logging
+import psycopg2
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__file__)
+
+MIGRATION_FILE = re.compile(r"^(\d+)_(\w+)\.sql$")
+
+
+def find_migrations(directory: str) -> list[tuple[int, str, str]]:
+    """
+    Find the migration files in the directory.
+
+    :return: List of (version, name, path) sorted by version.
+    """
+    migrations = []
+    for filename in os.listdir(directory):
+        match = MIGRATION_FILE.match(filename)
+        if match is None:
+            continue
+        migrations.append((int(match.group(1)), filename.removesuffix(".sql"), os.path.join(directory, filename)))
+    migrations.sort()
+    versions = [version for version, _, _ in migrations]
+    if len(versions) != len(set(versions)):
+        raise ValueError(f"Duplicate migration versions in {directory}")
+    return migrations
+
+
+def connect():
+    return psycopg2.connect(
+        host     = os.environ['POSTGRES_HOST'],
+        port     = os.environ['POSTGRES_PORT'],
+        database = os.environ['POSTGRES_DB'],
+        user     = os.environ.get('POSTGRES_MIGRATION_USER', 'postgres'),
+        password = os.environ.get('POSTGRES_MIGRATION_PASSWORD', os.environ.get('POSTGRES_PASSWORD')),
+    )
+
+
+def applied_migrations(conn) -> dict[int, str]:
+    """
+    Return the applied migrations, creating the bookkeeping table if needed.
+    """
+    with conn:
+        with conn.cursor() as curs:
+            curs.execute("""CREATE TABLE IF NOT EXISTS schema_migrations (
+                version INTEGER PRIMARY KEY,
+                name TEXT NOT NULL,
+                applied_at TIMESTAMPTZ NOT NULL DEFAULT now()
+            )""")
+            curs.execute("SELECT version, name FROM schema_migrations")
+            return dict(curs.fetchall())
+
+
+def migrate(conn, directory: str) -> int:
+    """
+    Apply the pending migrations in version order.
+
+    :return: Number of migrations applied.
+    """
+    applied = applied_migrations(conn)
+    count = 0
+    for version, name, path in find_migrations(directory):
+        if version in applied:
+            continue
+        logger.info(f"Applying migration {name}")
+        with open(path, 'r') as f:
+            sql = f.read()
+        with conn:
+            with conn.cursor() as curs:
+                curs.execute(sql)
+                curs.execute("INSERT INTO schema_migrations (version, name) VALUES (%s, %s)", (version, name))
+        count += 1
+    return count
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Apply pending schema migrations.")
+    parser.add_argument("--directory", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "migrations"),
+                        help="Directory of the migration files (default: migrations next to this script).")
+    parser.add_argument("--list", action="store_true", help="Only list the migrations and whether they are applied.")
+    args = parser.parse_args()
+
+    conn = connect()
+    try:
+        if args.list:
+            applied = applied_migrations(conn)
+            for version, name, _ in find_migrations(args.directory):
+                print(f"{name}: {'applied' if version in applied else 'pending'}")
+        else:
+            count = migrate(conn, args.directory)
+            logger.info(f"Applied {count} migrations")
+    finally:
+        conn.close()
@@ -1,30 +1,223 @@
 #!/usr/bin/env python3
 
 import os
+import asyncio
+import collections
+import decimal
 import logging
 import datetime
+from typing import Iterator, AsyncIterator, NamedTuple
 
+import async_database
 import database
+import queries
 
 
-logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger(__name__)
 
 
-class Patient:
+# Rows fetched per round trip when the records are read from a server side cursor
+ITERSIZE = int(os.environ.get('CURSOR_ITERSIZE', 500))
 
-    def __init__(self, patient_id: str):
+
+# Records of the patient tables. The rows are kept as named tuples, which take a
+# fraction of the memory of a dict per row and are built straight from the cursor rows.
+# The columns are decoded by the driver as the rows are fetched, timestamps included,
+# only the values of the observations are kept as text, see Observation.values().
+
+class Encounter(NamedTuple):
+    id: str
+    class_: str
+    type: str
+    period_start: datetime.datetime
+    duration: datetime.timedelta
+    reason: str
+    patient_id: str
+
+
+class Condition(NamedTuple):
+    id: str
+    encounter_id: str
+    clinical_status: str
+    verification_status: str
+    onset_date: datetime.datetime
+    abatement_date: datetime.datetime | None
+    code_display: str
+
+
+class Observation(NamedTuple):
+    id: str
+    encounter_id: str
+    observation_date: datetime.datetime
+    status: str
+    display: list[str]
+    value: list[str | None] | None
+    unit: list[str | None] | None
+
+    def values(self) -> list[decimal.Decimal | None]:
         """
-        Patient class constructor.
+        The values as decimals. They are fetched as text and only decoded here,
+        the reports use the text as is. The other fields are decoded on fetch.
         """
-        self.db = database.Database()
+        return [None if value is None else decimal.Decimal(value) for value in self.value or ()]
+
+
+class Procedure(NamedTuple):
+    encounter_id: str
+    condition_id: str | None
+    status: str
+    performed_date: datetime.datetime
+    performed_date_end: datetime.datetime | None
+    code_display: str
+
+
+class CarePlan(NamedTuple):
+    encounter_id: str
+    status: str
+    category_display: str
+    period_start_date: datetime.datetime
+    period_end_date: datetime.datetime | None
+    details: str
+
+
+class Immunization(NamedTuple):
+    encounter_id: str
+    date: datetime.datetime
+    status: str
+    vaccine_display: str
+
+
+class Medication(NamedTuple):
+    encounter_id: str
+    date_written: datetime.datetime
+    medication_display: str
+    dosage_instruction: str | None
+
+
+# Record type of the rows of each table, by the name used in encounter_records()
+RECORD_TYPES = {
+    "encounters": Encounter,
+    "conditions": Condition,
+    "observations": Observation,
+    "procedures": Procedure,
+    "care_plans": CarePlan,
+    "immunizations": Immunization,
+    "medications": Medication,
+}
+
+# Records of the encounters, in the order they are queried and rendered
+RECORD_NAMES = ("conditions", "observations", "procedures", "care_plans", "immunizations", "medications")
+
+# Table, columns, extra condition and order of the queries of each record type
+RECORD_TABLES = {
+    "encounters": ("encounters", "id, class, type, period_start, period_end-period_start duration, coalesce(reason_display, 'Not specified') reason, patient_id", None, "period_start, id"),
+    "conditions": ("conditions", "id, encounter_id, clinical_status, verification_status, onset_date, abatement_data abatement_date, code_display", None, "onset_date, id"),
+    "observations": ("observations", "id, encounter_id, observation_date, status, display, value::text[] AS value, unit", None, "observation_date, id"),
+    "procedures": ("procedures", "encounter_id, condition_id, status, performed_date, performed_date_end, code_display", None, "performed_date, id"),
+    "care_plans": ("care_plans", "encounter_id, status, category_display, period_start_date, period_end_date, details", None, "period_start_date, id"),
+    "immunizations": ("immunizations", "encounter_id, date, status, vaccine_display", "was_given IS TRUE", "id"),
+    "medications": ("medication_requests", "encounter_id, date_written, medication_display, dosage_instruction", None, "id"),
+}
+
+# Encounters of the patient which started after `since`, at or after `start` and before
+# `end`, and which were written, or had records written, after the data version
+# `version_after`, of those the `limit` most recent ones. The filters left NULL select
+# all the encounters. Parameters: patient, since, since, start, start, end, end,
+# version_after, version_after, limit, see PatientRecords._selection().
+SELECTED_ENCOUNTERS = (
+    "SELECT id FROM encounters WHERE patient_id = %s"
+    " AND (%s::timestamptz IS NULL OR period_start > %s::timestamptz)"
+    " AND (%s::timestamptz IS NULL OR period_start >= %s::timestamptz)"
+    " AND (%s::timestamptz IS NULL OR period_start < %s::timestamptz)"
+    " AND (%s::bigint IS NULL OR indexed_version > %s::bigint)"
+    " ORDER BY period_start DESC, id DESC LIMIT %s::bigint"
+)
+
+
+def _records_statement(name: str, scope: str, by_encounter: bool) -> str:
+    """
+    Query of the records `name` of RECORD_TABLES.
+
+    :param scope: "patient" for all the records of the patient, "selected" for the records
+        of the SELECTED_ENCOUNTERS, optionally of one encounter (and of one condition for
+        procedures), "batch" for all the records of many patients.
+    :param by_encounter: Group the rows by encounter in the order of the encounters, for
+        walking them together with the encounters.
+    """
+    table, columns, condition, order = RECORD_TABLES[name]
+    _where = ["patient_id = ANY(%s::uuid[])" if scope == "batch" else "patient_id = %s"]
+    if condition is not None:
+        _where.append(condition)
+    if scope == "selected":
+        if name == "encounters":
+            _where.append(f"id IN ({SELECTED_ENCOUNTERS})")
+        else:
+            _where.append("(%s::uuid IS NULL OR encounter_id = %s::uuid)")
+            if name == "procedures":
+                _where.append("(%s::uuid IS NULL OR condition_id = %s::uuid)")
+            _where.append(f"encounter_id IN ({SELECTED_ENCOUNTERS})")
+        if name == "observations":
+            # Bounded by the earliest observation of the selected encounters as well, kept by
+            # the indexer in encounters.first_observation_at. The bound doesn't change the
+            # result, but it lets Postgres skip the older partitions of the observations
+            # partitioned by date, and the older rows of the (patient_id, observation_date) index.
+            _where.append(f"observation_date >= (SELECT min(first_observation_at) FROM encounters WHERE id IN ({SELECTED_ENCOUNTERS}))")
+    if by_encounter and name != "encounters":
+        order = f"(SELECT period_start FROM encounters e WHERE e.id = encounter_id), encounter_id, {order}"
+    return f"SELECT {columns} FROM {table} WHERE {' AND '.join(_where)} ORDER BY {order}"
+
+
+# Statements of the record queries by (name, scope, by_encounter), registered once
+RECORD_QUERIES = {
+    (name, scope, by_encounter): queries.query(name, _records_statement(name, scope, by_encounter))
+    for name in RECORD_TABLES
+    for scope in ("patient", "selected", "batch")
+    for by_encounter in (False, True)
+    if not (scope == "batch" and by_encounter)
+}
+DETAILS_QUERY = queries.query("details", "SELECT date_of_birth, deceased_at, gender, email, data_version FROM patients WHERE id = %s")
+BATCH_DETAILS_QUERY = queries.query(
+    "batch_details", "SELECT id, date_of_birth, deceased_at, gender, email, data_version FROM patients WHERE id = ANY(%s::uuid[])")
+# Allergies of the patient by only_active
+ALLERGIES_QUERIES = {
+    True: queries.query("allergies", "SELECT asserted_date, clinical_status, category, criticality, display FROM allergy_intolerances "
+                                     "WHERE patient_id = %s AND type = 'allergy' AND clinical_status = 'active' ORDER BY asserted_date, id"),
+    False: queries.query("allergies", "SELECT asserted_date, clinical_status, category, criticality, display FROM allergy_intolerances "
+                                      "WHERE patient_id = %s AND type = 'allergy' ORDER BY asserted_date, id"),
+}
+SUMMARY_QUERY = queries.query("summary", """SELECT p.date_of_birth, p.deceased_at, p.gender, s.data_version, s.active_conditions,
+    s.active_medications, s.allergies, s.latest_observations, s.encounter_count, s.encounters_by_class,
+    s.first_encounter_at, s.last_encounter_at, s.refreshed_at
+    FROM patient_summary s JOIN patients p ON p.id = s.patient_id WHERE s.patient_id = %s""")
+
+
+class PatientNotFound(LookupError):
+    """
+    Raised when the patient is not in the patients table.
+    """
+
+
+class PatientRecords:
+    """
+    Queries of the patient records and formatting of their rows.
+
+    The queries are run by the subclasses: Patient with the blocking driver and
+    AsyncPatient with the async driver, so both return the same data.
+    """
+
+    def __init__(self, patient_id: str):
         self.id = patient_id
+        self._date_of_birth = self._deceased_at = self._gender = self._email = self._data_version = None
 
+    def _details_query(self) -> tuple[str, tuple]:
         # Fetch basid details from the patients table
-        query = f"SELECT date_of_birth, deceased_at, gender, email FROM patients WHERE id = %s"
-        logger.debug(query)
-        data = (self.id,)
-        self._date_of_birth, self._deceased_at, self._gender, self._email = self.db.db_execute(query, data)[0]
+        logger.debug(DETAILS_QUERY)
+        return DETAILS_QUERY, (self.id,)
+
+    def _set_details(self, result: list[tuple]):
+        if not result:
+            raise PatientNotFound(f"Patient {self.id} not found")
+        self._date_of_birth, self._deceased_at, self._gender, self._email, self._data_version = result[0]
 
     def date_of_birth(self):
         return self._date_of_birth
@@ -47,183 +240,399 @@ class Patient:
     def email(self):
         return self._email
 
-    def allergies(self, only_active: bool = True) -> dict[list[str]]:
+    def data_version(self) -> int:
         """
-        Retrieves allergies for the patient.
+        Version of the patient data, bumped by the indexer on every write.
         """
+        return self._data_version
 
+    def _allergies_query(self, only_active: bool = True) -> tuple[str, tuple]:
         # Define the query to retrieve allergies for the patient
-        _where = ["patient_id = %s", "type = 'allergy'"]
-        if only_active:
-            _where.append("clinical_status = 'active'")
-        _where = " AND ".join(_where)
-        query = f"SELECT asserted_date, clinical_status, category, criticality, display FROM allergy_intolerances WHERE {_where} ORDER BY asserted_date"
+        query = ALLERGIES_QUERIES[only_active]
         logger.debug(query)
+        return query, (self.id,)
 
-        data = (self.id,)
-        result = self.db.db_execute(query, data)
+    @staticmethod
+    def _format_allergy(display: str, criticality: str) -> str:
+        # Edit the display
+        display = display.removeprefix("Allergy to ").removesuffix(" allergy").capitalize()
+        # Format the string
+        if criticality == "high":
+            criticality = "severe"
+        elif criticality == "low":
+            criticality = "mild"
+        return f"{display} ({criticality})"
 
+    @classmethod
+    def _allergies_rows(cls, result: list[tuple]) -> dict[list[str]]:
         strings = []
         d = {}
         for row in result:
             logger.debug(row)
-            # Edit the display
-            display = row[4].removeprefix("Allergy to ").removesuffix(" allergy").capitalize()
-            # Format the string
-            if row[3] == "high":
-                criticality = "severe"
-            elif row[3] == "low":
-                criticality = "mild"
-            else:
-                criticality = row[3]
-            s = f"{display} ({criticality})"
+            s = cls._format_allergy(row[4], row[3])
             if row[2] not in d:
                 d[row[2]] = []
             d[row[2]].append(s)
             strings.append(s)
         return d
 
-    def encounters(self):
-        _where = ["patient_id = %s",]
-        data = (self.id,)
-        _where = " AND ".join(_where)
-        query = f"SELECT id, class, type, period_start, period_end-period_start duration, reason_display FROM encounters WHERE {_where} ORDER BY period_start"
-        logger.debug(query)
-        result = self.db.db_execute(query, data)
-        return [{
-            "id": row[0],
-            "class": row[1],
-            "type": row[2],
-            "period_start": row[3],
-            "duration": row[4],
-            "reason": row[5] if row[5] is not None else "Not specified",
-        } for row in result]
-
-    def conditions(self, encounter_id: str = None):
-        _where = ["patient_id = %s",]
-        data = (self.id,)
-        if encounter_id is not None:
-            _where.append("encounter_id = %s")
-            data = (*data, encounter_id,)
-        _where = " AND ".join(_where)
-        query = f"SELECT id, encounter_id, clinical_status, verification_status, onset_date, abatement_data abatement_date, code_display FROM conditions WHERE {_where} ORDER BY onset_date"
-        logger.debug(query)
+    def _summary_query(self) -> tuple[str, tuple]:
+        logger.debug(SUMMARY_QUERY)
+        return SUMMARY_QUERY, (self.id,)
 
-        result = self.db.db_execute(query, data)
-        return [{
-            "id": row[0],
-            "encounter_id": row[1],
-            "clinical_status": row[2],
-            "verification_status": row[3],
-            "onset_date": row[4],
-            "abatement_date": row[5],
-            "code_display": row[6],
-        } for row in result]
-
-    def observations(self, encounter_id: str = None):
-        _where = ["patient_id = %s",]
-        data = (self.id,)
-        if encounter_id is not None:
-            _where.append("encounter_id = %s")
-            data = (*data, encounter_id,)
-        _where = " AND ".join(_where)
-        query = f"SELECT id, encounter_id, observation_date, status, display, value, unit FROM observations WHERE {_where} ORDER BY observation_date"
-        logger.debug(query)
+    def _summary_row(self, result: list[tuple]) -> dict:
+        if not result:
+            raise PatientNotFound(f"Summary of patient {self.id} not found")
+        row = result[0]
+        self._date_of_birth, self._deceased_at, self._gender = row[0:3]
+        return {
+            "age": self.age(),
+            "gender": row[2],
+            "date_of_birth": row[0],
+            "data_version": row[3],
+            "active_conditions": row[4],
+            "active_medications": row[5],
+            "allergies": {
+                category: [self._format_allergy(allergy["display"], allergy["criticality"]) for allergy in allergies]
+                for category, allergies in row[6].items()
+            },
+            "latest_observations": row[7],
+            "encounters": {
+                "count": row[8],
+                "by_class": row[9],
+                "first": row[10],
+                "last": row[11],
+            },
+            "refreshed_at": row[12],
+        }
 
-        result = self.db.db_execute(query, data)
-        return [{
-            "id": row[0],
-            "encounter_id": row[1],
-            "observation_date": row[2],
-            "status": row[3],
-            "display": row[4],
-            "value": row[5],
-            "unit": row[6],
-        } for row in result]
-
-    def procedures(self, encounter_id: str = None, condition_id: str = None):
-        _where = ["patient_id = %s",]
-        data = (self.id,)
-        if encounter_id is not None:
-            _where.append("encounter_id = %s")
-            data = (*data, encounter_id,)
-        if condition_id is not None:
-            _where.append("condition_id = %s")
-            data = (*data, condition_id,)
-        _where = " AND ".join(_where)
-        query = f"SELECT encounter_id, condition_id, status, performed_date, performed_date_end, code_display FROM procedures WHERE {_where} ORDER BY performed_date"
-        logger.debug(query)
+    def _records_query(self, name: str, since: datetime.datetime = None, version_after: int = None,
+                       by_encounter: bool = False, start: datetime.datetime = None, end: datetime.datetime = None,
+                       limit: int = None, encounter_id: str = None, condition_id: str = None) -> tuple[str, tuple]:
+        """
+        Query of the rows of the table `name`, a key of RECORD_TYPES, one of the RECORD_QUERIES.
 
-        result = self.db.db_execute(query, data)
-        return [{
-            "encounter_id": row[0],
-            "condition_id": row[1],
-            "status": row[2],
-            "performed_date": row[3],
-            "performed_date_end": row[4],
-            "code_display": row[5],
-        } for row in result]
-
-    def care_plans(self, encounter_id: str = None, condition_id: str = None):
-        _where = ["patient_id = %s",]
-        data = (self.id,)
-        if encounter_id is not None:
-            _where.append("encounter_id = %s")
-            data = (*data, encounter_id,)
-        if condition_id is not None:
-            _where.append("condition_id = %s")
-            data = (*data, condition_id,)
-        _where = " AND ".join(_where)
-        query = f"SELECT encounter_id, status, category_display, period_start_date, period_end_date, details FROM care_plans WHERE {_where} ORDER BY period_start_date"
+        :param since, version_after, start, end, limit: Only the records of the encounters
+            selected by these, see SELECTED_ENCOUNTERS.
+        :param by_encounter: Group the rows by encounter in the order of the encounters.
+        :param encounter_id: Only the records of this encounter.
+        :param condition_id: Only the procedures of this condition.
+        """
+        if condition_id is not None and name != "procedures":
+            raise ValueError(f"The {name} are not linked to conditions")
+        if all(value is None for value in (since, version_after, start, end, limit, encounter_id, condition_id)):
+            query, data = RECORD_QUERIES[(name, "patient", by_encounter)], (self.id,)
+        else:
+            selection = (self.id, since, since, start, start, end, end, version_after, version_after, limit)
+            data = (self.id,)
+            if name != "encounters":
+                data = (*data, encounter_id, encounter_id)
+            if name == "procedures":
+                data = (*data, condition_id, condition_id)
+            data = (*data, *selection)
+            if name == "observations":
+                data = (*data, *selection)
+            query = RECORD_QUERIES[(name, "selected", by_encounter)]
         logger.debug(query)
+        return query, data
 
-        result = self.db.db_execute(query, data)
-        return [{
-            "encounter_id": row[0],
-            "status": row[1],
-            "category_display": row[2],
-            "period_start_date": row[3],
-            "period_end_date": row[4],
-            "details": row[5],
-        } for row in result]
-
-    def immunizations(self, encounter_id: str = None):
-        _where = ["patient_id = %s", "was_given IS TRUE",]
-        data = (self.id,)
-        if encounter_id is not None:
-            _where.append("encounter_id = %s")
-            data = (*data, encounter_id,)
-        _where = " AND ".join(_where)
-        query = f"SELECT encounter_id, date, status, vaccine_display FROM immunizations WHERE {_where}"
-        logger.debug(query)
+    @staticmethod
+    def _record_names(include: set[str] | None) -> tuple[str, ...]:
+        """
+        Names of the records to fetch, all of RECORD_NAMES if include is None.
+        """
+        return RECORD_NAMES if include is None else tuple(name for name in RECORD_NAMES if name in include)
+
+    @staticmethod
+    def _group_by_encounter(named_rows: dict[str, list[tuple]]) -> dict[str, dict[str, list[tuple]]]:
+        records = {}
+        for name, rows in named_rows.items():
+            for row in rows:
+                records.setdefault(row.encounter_id, {}).setdefault(name, []).append(row)
+        return records
+
+
+class Patient(PatientRecords):
+
+    def __init__(self, patient_id: str):
+        """
+        Patient class constructor.
+        """
+        super().__init__(patient_id)
+        self.db = database.Database()
+        self._set_details(self.db.db_execute(*self._details_query()))
+
+    def _fetch(self, record_type: type, query: tuple[str, tuple]) -> list[tuple]:
+        return list(map(record_type._make, self.db.db_execute(*query)))
+
+    def allergies(self, only_active: bool = True) -> dict[list[str]]:
+        """
+        Retrieves allergies for the patient.
+        """
+        return self._allergies_rows(self.db.db_execute(*self._allergies_query(only_active)))
+
+    def summary(self) -> dict:
+        """
+        Retrieves the precomputed summary of the patient: active conditions, medications
+        and allergies, the latest value of each observation and the encounter counts.
+        """
+        return self._summary_row(self.db.db_execute(*self._summary_query()))
+
+    def encounters(self, since: datetime.datetime = None, version_after: int = None,
+                   start: datetime.datetime = None, end: datetime.datetime = None, limit: int = None) -> list[Encounter]:
+        return self._fetch(Encounter, self._records_query("encounters", since, version_after, start=start, end=end, limit=limit))
 
-        result = self.db.db_execute(query, data)
-        return [{
-            "encounter_id": row[0],
-            "date": row[1],
-            "status": row[2],
-            "vaccine_display": row[3],
-        } for row in result]
-
-    def medications(self, encounter_id: str = None):
-        _where = ["patient_id = %s",]
-        data = (self.id,)
-        if encounter_id is not None:
-            _where.append("encounter_id = %s")
-            data = (*data, encounter_id,)
-        _where = " AND ".join(_where)
-        query = f"SELECT encounter_id, date_written, medication_display, dosage_instruction FROM medication_requests WHERE {_where}"
+    def conditions(self, encounter_id: str = None, since: datetime.datetime = None, version_after: int = None) -> list[Condition]:
+        return self._fetch(Condition, self._records_query("conditions", since, version_after, encounter_id=encounter_id))
+
+    def observations(self, encounter_id: str = None, since: datetime.datetime = None, version_after: int = None) -> list[Observation]:
+        return self._fetch(Observation, self._records_query("observations", since, version_after, encounter_id=encounter_id))
+
+    def procedures(self, encounter_id: str = None, condition_id: str = None, since: datetime.datetime = None, version_after: int = None) -> list[Procedure]:
+        return self._fetch(Procedure, self._records_query("procedures", since, version_after, encounter_id=encounter_id, condition_id=condition_id))
+
+    def care_plans(self, encounter_id: str = None, condition_id: str = None, since: datetime.datetime = None, version_after: int = None) -> list[CarePlan]:
+        return self._fetch(CarePlan, self._records_query("care_plans", since, version_after, encounter_id=encounter_id, condition_id=condition_id))
+
+    def immunizations(self, encounter_id: str = None, since: datetime.datetime = None, version_after: int = None) -> list[Immunization]:
+        return self._fetch(Immunization, self._records_query("immunizations", since, version_after, encounter_id=encounter_id))
+
+    def medications(self, encounter_id: str = None, since: datetime.datetime = None, version_after: int = None) -> list[Medication]:
+        return self._fetch(Medication, self._records_query("medications", since, version_after, encounter_id=encounter_id))
+
+    def iterate(self, name: str, since: datetime.datetime = None, version_after: int = None,
+                itersize: int = None) -> Iterator[tuple]:
+        """
+        Iterate over the records of one table without fetching them all at once.
+
+        The rows are read from a server side cursor `itersize` rows at a time, so only
+        that many rows are in memory however many records the patient has.
+
+        :param name: Table of the records, "encounters", "conditions", "observations",
+                     "procedures", "care_plans", "immunizations" or "medications".
+        :param itersize: Rows fetched per round trip, CURSOR_ITERSIZE by default.
+        """
+        query, data = self._records_query(name, since, version_after)
+        return map(RECORD_TYPES[name]._make, self.db.db_iterate(query, data, itersize or ITERSIZE))
+
+    def encounter_records(self, since: datetime.datetime = None, version_after: int = None,
+                          start: datetime.datetime = None, end: datetime.datetime = None, limit: int = None,
+                          include: set[str] = None) -> dict[str, dict[str, list[tuple]]]:
+        """
+        Retrieves the conditions, observations, procedures, care plans, immunizations
+        and medications of all the patient encounters.
+
+        Each table is queried once for the whole patient and the rows are grouped by
+        encounter in memory, so the number of queries doesn't grow with the number of
+        encounters.
+
+        :param since: Only the encounters which started after this time.
+        :param version_after: Only the encounters written, or with records written, after this data version.
+        :param start, end: Only the encounters which started at or after start and before end.
+        :param limit: Only the `limit` most recent of the selected encounters.
+        :param include: Only these records, names of RECORD_NAMES. The other tables are not queried.
+
+        Example: {"<encounter_id>": {"conditions": [Condition(...)], "observations": [Observation(...)]}}
+        """
+        return self._group_by_encounter({
+            name: self._fetch(RECORD_TYPES[name], self._records_query(name, since, version_after, start=start, end=end, limit=limit))
+            for name in self._record_names(include)
+        })
+
+
+class AsyncPatient(PatientRecords):
+    """
+    Patient with the same queries as Patient, run with the async driver.
+
+    The details are not fetched by the constructor, await load() before using them.
+    Independent queries can be awaited concurrently, each one runs on its own
+    pooled connection.
+    """
+
+    def __init__(self, patient_id: str):
+        super().__init__(patient_id)
+        self.db = async_database.AsyncDatabase()
+
+    async def load(self) -> "AsyncPatient":
+        """
+        Fetch the details of the patient from the patients table.
+        """
+        self._set_details(await self.db.db_execute(*self._details_query()))
+        return self
+
+    async def _fetch(self, record_type: type, query: tuple[str, tuple]) -> list[tuple]:
+        return list(map(record_type._make, await self.db.db_execute(*query)))
+
+    async def allergies(self, only_active: bool = True) -> dict[list[str]]:
+        """
+        Retrieves allergies for the patient.
+        """
+        return self._allergies_rows(await self.db.db_execute(*self._allergies_query(only_active)))
+
+    async def summary(self) -> dict:
+        """
+        Retrieves the precomputed summary of the patient: active conditions, medications
+        and allergies, the latest value of each observation and the encounter counts.
+        """
+        return self._summary_row(await self.db.db_execute(*self._summary_query()))
+
+    async def encounters(self, since: datetime.datetime = None, version_after: int = None,
+                         start: datetime.datetime = None, end: datetime.datetime = None, limit: int = None) -> list[Encounter]:
+        return await self._fetch(Encounter, self._records_query("encounters", since, version_after, start=start, end=end, limit=limit))
+
+    async def conditions(self, encounter_id: str = None, since: datetime.datetime = None, version_after: int = None) -> list[Condition]:
+        return await self._fetch(Condition, self._records_query("conditions", since, version_after, encounter_id=encounter_id))
+
+    async def observations(self, encounter_id: str = None, since: datetime.datetime = None, version_after: int = None) -> list[Observation]:
+        return await self._fetch(Observation, self._records_query("observations", since, version_after, encounter_id=encounter_id))
+
+    async def procedures(self, encounter_id: str = None, condition_id: str = None, since: datetime.datetime = None, version_after: int = None) -> list[Procedure]:
+        return await self._fetch(Procedure, self._records_query("procedures", since, version_after, encounter_id=encounter_id, condition_id=condition_id))
+
+    async def care_plans(self, encounter_id: str = None, condition_id: str = None, since: datetime.datetime = None, version_after: int = None) -> list[CarePlan]:
+        return await self._fetch(CarePlan, self._records_query("care_plans", since, version_after, encounter_id=encounter_id, condition_id=condition_id))
+
+    async def immunizations(self, encounter_id: str = None, since: datetime.datetime = None, version_after: int = None) -> list[Immunization]:
+        return await self._fetch(Immunization, self._records_query("immunizations", since, version_after, encounter_id=encounter_id))
+
+    async def medications(self, encounter_id: str = None, since: datetime.datetime = None, version_after: int = None) -> list[Medication]:
+        return await self._fetch(Medication, self._records_query("medications", since, version_after, encounter_id=encounter_id))
+
+    async def iterate(self, name: str, since: datetime.datetime = None, version_after: int = None,
+                      itersize: int = None) -> AsyncIterator[tuple]:
+        """
+        Iterate over the records of one table from a server side cursor like Patient.iterate.
+        """
+        query, data = self._records_query(name, since, version_after)
+        async for row in self.db.db_iterate(query, data, itersize or ITERSIZE):
+            yield RECORD_TYPES[name]._make(row)
+
+    async def stream_encounters(self, since: datetime.datetime = None, version_after: int = None,
+                                itersize: int = None, start: datetime.datetime = None, end: datetime.datetime = None,
+                                limit: int = None, include: set[str] = None):
+        """
+        Yield the encounters of the patient in order together with their records,
+        (encounter, {"conditions": [...], "observations": [...], ...}).
+
+        The encounters and each child table are read from server side cursors on one
+        connection, ordered by encounter, and walked together. Only `itersize` rows per
+        table are in memory at a time, CURSOR_ITERSIZE by default. The encounters and
+        records are selected like in Patient.encounter_records.
+        """
+        names = self._record_names(include)
+        async with self.db.connection() as conn:
+            cursors = {}
+            for name in ("encounters", *names):
+                curs = conn.cursor(name=f"stream_{name}")
+                await curs.execute(*self._records_query(name, since, version_after, by_encounter=True,
+                                                        start=start, end=end, limit=limit))
+                cursors[name] = _RowStream(curs, RECORD_TYPES[name], itersize or ITERSIZE)
+            while (encounter := await cursors["encounters"].next()) is not None:
+                records = {}
+                for name in names:
+                    rows = []
+                    while (row := await cursors[name].peek()) is not None and row.encounter_id == encounter.id:
+                        rows.append(await cursors[name].next())
+                    if rows:
+                        records[name] = rows
+                yield encounter, records
+
+    async def encounter_records(self, since: datetime.datetime = None, version_after: int = None,
+                                start: datetime.datetime = None, end: datetime.datetime = None, limit: int = None,
+                                include: set[str] = None) -> dict[str, dict[str, list[tuple]]]:
+        """
+        Retrieves the records of all the patient encounters like Patient.encounter_records,
+        querying the tables concurrently.
+        """
+        names = self._record_names(include)
+        results = await asyncio.gather(*(
+            self._fetch(RECORD_TYPES[name], self._records_query(name, since, version_after, start=start, end=end, limit=limit))
+            for name in names
+        ))
+        return self._group_by_encounter(dict(zip(names, results)))
+
+
+
+class _RowStream:
+    """
+    Rows of a server side cursor, fetched `itersize` at a time as `record_type` records.
+    """
+
+    def __init__(self, curs, record_type: type, itersize: int):
+        self._curs = curs
+        self._make = record_type._make
+        self._itersize = itersize
+        self._buffer = collections.deque()
+        self._done = False
+
+    async def peek(self) -> tuple | None:
+        if not self._buffer and not self._done:
+            result = await self._curs.fetchmany(self._itersize)
+            self._buffer.extend(map(self._make, result))
+            self._done = len(result) < self._itersize
+        return self._buffer[0] if self._buffer else None
+
+    async def next(self) -> tuple | None:
+        row = await self.peek()
+        if row is not None:
+            self._buffer.popleft()
+        return row
+
+
+class AsyncPatientBatch(PatientRecords):
+    """
+    Records of many patients fetched with the same queries as AsyncPatient, one set
+    based query per table for all the patients.
+    """
+
+    def __init__(self, patient_ids: list[str]):
+        super().__init__(None)
+        self.ids = list(patient_ids)
+        self.db = async_database.AsyncDatabase()
+
+    def _details_query(self) -> tuple[str, tuple]:
+        logger.debug(BATCH_DETAILS_QUERY)
+        return BATCH_DETAILS_QUERY, (self.ids,)
+
+    def _records_query(self, name: str) -> tuple[str, tuple]:
+        """
+        Query of the rows of the table `name` of all the patients.
+        """
+        query = RECORD_QUERIES[(name, "batch", False)]
         logger.debug(query)
+        return query, (self.ids,)
+
+    async def load(self) -> dict[str, AsyncPatient]:
+        """
+        Fetch the details of the patients.
 
-        result = self.db.db_execute(query, data)
-        return [{
-            "encounter_id": row[0],
-            "date_written": row[1],
-            "medication_display": row[2],
-            "dosage_instruction": row[3],
-        } for row in result]
+        :return: Patients with the details loaded by id, patients not found are left out.
+        """
+        patients = {}
+        for row in await self.db.db_execute(*self._details_query()):
+            p = AsyncPatient(str(row[0]))
+            p._set_details([row[1:]])
+            patients[p.id] = p
+        return patients
 
+    async def encounters(self) -> dict[str, list[Encounter]]:
+        """
+        Retrieves the encounters of the patients, grouped by patient id.
+        """
+        encounters = {}
+        for row in await self.db.db_execute(*self._records_query("encounters")):
+            encounter = Encounter._make(row)
+            encounters.setdefault(str(encounter.patient_id), []).append(encounter)
+        return encounters
 
-if __name__ == "__main__":
-    # Test the module
-    pass
+    async def encounter_records(self) -> dict[str, dict[str, list[tuple]]]:
+        """
+        Retrieves the records of the encounters of all the patients like
+        AsyncPatient.encounter_records, grouped by encounter.
+        """
+        results = await asyncio.gather(*(
+            self.db.db_execute(*self._records_query(name)) for name in RECORD_NAMES
+        ))
+        return self._group_by_encounter({
+            name: list(map(RECORD_TYPES[name]._make, result)) for name, result in zip(RECORD_NAMES, results)
+        })
@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+
+"""
+Registry of the SQL statements run by the patient queries and the indexer.
+
+The statements are defined once at module level by the modules running them, e.g.
+patient.RECORD_QUERIES and index_fhir.INSERT_QUERIES, with the optional filters as
+parameters, so their number doesn't grow with the combinations of the filters.
+Each distinct statement is registered once under a name and runs as a prepared
+statement: the async driver prepares it on each pooled connection
+(psycopg prepare=True) and the blocking driver with PREPARE / EXECUTE, see
+database.Database.db_execute. Postgres then parses and plans the statement once
+per connection instead of on every call.
+
+The executions, rows and time spent per statement name are recorded by record(),
+returned by stats() and exported to the metrics of the service.
+
+Author: Olli Puhakka
+"""
+import re
+import itertools
+import threading
+import collections
+import logging
+
+import metrics
+
+logger = logging.getLogger(__file__)
+
+
+class Query(str):
+    """
+    SQL text of a registered statement, usable wherever a query string is.
+
+    - name: Name of the statement, variants of a query share the name.
+    - key: Unique name of this variant, the name of the prepared statement.
+    """
+    name: str
+    key: str
+
+    def positional(self) -> str:
+        """
+        The statement as PREPARE takes it: the %s placeholders numbered $1, $2, ... and
+        the escaped %% as a literal %, like the driver sends them. Named placeholders
+        are not supported.
+        """
+        counter = itertools.count(1)
+
+        def replace(match: re.Match) -> str:
+            if match.group(1) == "s":
+                return f"${next(counter)}"
+            if match.group(1) == "%":
+                return "%"
+            raise ValueError(f"Unsupported placeholder %{match.group(1)} in statement {self.key}")
+
+        return re.sub(r"%(.)", replace, self, flags=re.DOTALL)
+
+
+_queries = {}  # sql -> Query
+_variants = collections.Counter()  # name -> number of variants
+_lock = threading.Lock()
+_stats = {}  # name -> [count, seconds, max_seconds, rows]
+_stats_lock = threading.Lock()
+_slow_query_seconds = metrics.slow_query_threshold()
+
+# Name the queries outside the registry are recorded under
+UNREGISTERED = "unregistered"
+
+
+def query(name: str, sql: str) -> Query:
+    """
+    Return the registered statement with the text `sql`, registering it on first use.
+
+    The variants of a query register one statement per distinct text, e.g.
+    "conditions_0" and "conditions_1", all recorded under the name "conditions".
+    """
+    registered = _queries.get(sql)
+    if registered is not None:
+        return registered
+    with _lock:
+        registered = _queries.get(sql)
+        if registered is None:
+            registered = Query(sql)
+            registered.name = name
+            registered.key = f"{name}_{_variants[name]}"
+            _variants[name] += 1
+            _queries[sql] = registered
+            logger.debug(f"Registered statement {registered.key}")
+        return registered
+
+
+def record(q: str, seconds: float, rows: int = 0):
+    """
+    Record one execution of the query which took `seconds` and returned or affected `rows` rows.
+
+    Queries not in the registry are recorded under the name "unregistered". Queries
+    slower than SLOW_QUERY_MS are logged.
+    """
+    name = q.name if isinstance(q, Query) else UNREGISTERED
+    with _stats_lock:
+        entry = _stats.get(name)
+        if entry is None:
+            entry = _stats[name] = [0, 0.0, 0.0, 0]
+        entry[0] += 1
+        entry[1] += seconds
+        entry[2] = max(entry[2], seconds)
+        entry[3] += rows
+    metrics.QUERY_DURATION.observe(seconds, name)
+    metrics.QUERY_ROWS.inc(name, amount=rows)
+    if _slow_query_seconds is not None and seconds >= _slow_query_seconds:
+        metrics.SLOW_QUERIES.inc(name)
+        logger.warning(f"Slow query {name} took {seconds * 1000:.1f} ms, {rows} rows: {' '.join(q.split())}")
+
+
+def stats() -> dict[str, dict]:
+    """
+    Executions and latencies per statement name.
+
+    Example: {"observations": {"variants": 2, "count": 120, "rows": 4800, "total_ms": 84.1, "mean_ms": 0.7, "max_ms": 5.2}}
+    """
+    with _stats_lock:
+        return {
+            name: {
+                "variants": _variants[name],
+                "count": count,
+                "rows": rows,
+                "total_ms": round(seconds * 1000, 3),
+                "mean_ms": round(seconds * 1000 / count, 3),
+                "max_ms": round(max_seconds * 1000, 3),
+            }
+            for name, (count, seconds, max_seconds, rows) in sorted(_stats.items())
+        }
+
+
+def reset_stats():
+    with _stats_lock:
+        _stats.clear()
@@ -0,0 +1,381 @@
+#!/usr/bin/env python3
+
+"""
+Markdown reports of the patient encounters for the LLM.
+
+The full report lists every encounter with all of its records. The budgeted
+report fits in a given number of characters: observation series are collapsed
+into one line per observation, the most recent encounters are listed in full
+and the older encounters are summarized.
+
+Author: Olli Puhakka
+"""
+import datetime
+import itertools
+import collections
+import contextlib
+import logging
+import numpy as np
+
+import patient
+
+logger = logging.getLogger(__file__)
+
+# Rough number of characters per LLM token in the markdown reports
+CHARS_PER_TOKEN = 4
+
+# Relative change over the series below which an observation is reported as stable
+TREND_THRESHOLD = 0.05
+
+
+def report_budget(max_tokens: int | None = None, max_chars: int | None = None) -> int | None:
+    """
+    Return the size budget of a report in characters, None if neither limit is given.
+    """
+    limits = []
+    if max_tokens is not None:
+        limits.append(max_tokens * CHARS_PER_TOKEN)
+    if max_chars is not None:
+        limits.append(max_chars)
+    return min(limits) if limits else None
+
+
+def describe_scope(start: datetime.datetime | None = None, end: datetime.datetime | None = None,
+                   limit: int | None = None, include: set[str] | None = None) -> str | None:
+    """
+    Describe the encounters and records selected for a report, None if it has all of them.
+
+    Example: "3 most recent, from 2024-01-01T00:00:00+00:00, only medications"
+    """
+    scope = []
+    if limit is not None:
+        scope.append(f"{limit} most recent")
+    if start is not None:
+        scope.append(f"from {start.isoformat()}")
+    if end is not None:
+        scope.append(f"before {end.isoformat()}")
+    if include is not None:
+        names = [name.replace("_", " ") for name in patient.RECORD_NAMES if name in include]
+        scope.append(f"only {', '.join(names)}" if names else "without records")
+    return ", ".join(scope) if scope else None
+
+
+def encounters_heading(since: str | None = None, scope: str | None = None) -> str:
+    heading = "## Medical encounters" if since is None else f"## New medical encounters since {since}"
+    return heading if scope is None else f"{heading} ({scope})"
+
+
+def render_no_encounters(since: str | None = None, scope: str | None = None) -> list[str]:
+    """
+    Line telling that a report of only some of the encounters has none.
+    """
+    if since is not None:
+        return ["No new encounters."]
+    if scope is not None:
+        return ["No encounters."]
+    return []
+
+
+def render_header(p: patient.PatientRecords) -> list[str]:
+    return [
+        f"Patient is {p.age()} year old {p.gender()}.",
+        f"**Date of Birth:** {p.date_of_birth()}",
+        "",
+    ]
+
+
+def render_encounter(encounter: patient.Encounter, encounter_records: dict[str, list[tuple]], observations: bool = True) -> list[str]:
+    """
+    Render one encounter and its records.
+
+    :param observations: Include the observations of the encounter.
+    """
+    report = []
+    report.append(f"### {encounter.class_.capitalize()} - {encounter.type}")
+    report.append(f"- **Date**: {encounter.period_start.replace(tzinfo=None)}")
+    if encounter.duration > datetime.timedelta(hours=1):
+        report.append(f"- **Duration**: {encounter.duration}")
+    report.append(f"- **Reason**: {encounter.reason}")
+
+    # Add conditions to the report:
+    conditions = [
+        condition.code_display if condition.abatement_date is None
+        else f"{condition.code_display} (until {condition.abatement_date.replace(tzinfo=None)})"
+        for condition in encounter_records.get('conditions', [])
+    ]
+    if conditions:
+        report.append(f"- **Conditions confirmed:** {', '.join(conditions)}")
+
+    # Add observations to the report
+    if observations:
+        observations = encounter_records.get('observations', [])
+        if observations:
+            report.append("- **Observations**:")
+        for observation in observations:
+            for i in range(len(observation.display)):
+                report.append(f"  - {observation.display[i]}: {observation.value[i]} {observation.unit[i]}")
+
+    # Add procedures to the report
+    procedures = encounter_records.get('procedures', [])
+    if procedures:
+        report.append("- **Procedures**:")
+    for procedure in procedures:
+        report.append(f"  - {procedure.code_display}")
+
+    # Add care plans to the report
+    care_plans = encounter_records.get('care_plans', [])
+    if care_plans:
+        report.append("- **Care Plans**:")
+    for care_plan in care_plans:
+        report.append(f"  - {care_plan.details} (Status: {care_plan.status})")
+
+    # Add immunizations to the report
+    immunizations = encounter_records.get('immunizations', [])
+    if immunizations:
+        report.append("- **Immunizations**:")
+    for immunization in immunizations:
+        report.append(f"  - {immunization.vaccine_display}")
+
+    # Add medication to the report
+    medications = encounter_records.get('medications', [])
+    if medications:
+        report.append("- **Medications**:")
+    for medication in medications:
+        report.append(f"  - {medication.medication_display}")
+
+    report.append("")
+    return report
+
+
+def render_report(p: patient.PatientRecords, encounters: list[patient.Encounter], records: dict[str, dict[str, list[tuple]]],
+                  since: str | None = None, max_chars: int | None = None, scope: str | None = None) -> str:
+    """
+    Render the full report of all patient encounters in markdown.
+
+    :param p: Patient with the details loaded.
+    :param encounters: Encounters of the patient, from p.encounters().
+    :param records: Records of the encounters, from p.encounter_records().
+    :param since: The encounters are only the ones new since this, e.g. "the previous report".
+    :param max_chars: Render the budgeted report in at most this many characters instead.
+    :param scope: The encounters and records are only the selected ones, from describe_scope().
+    """
+    if max_chars is not None:
+        return render_budgeted_report(p, encounters, records, max_chars, since=since, scope=scope)
+    report = render_header(p)
+    report.append(encounters_heading(since, scope))
+    if not encounters:
+        report.extend(render_no_encounters(since, scope))
+    for encounter in encounters:
+        report.extend(render_encounter(encounter, records.get(encounter.id, {})))
+    return "\n".join(report)
+
+
+async def stream_report(p: patient.PatientRecords, sections, since: str | None = None, scope: str | None = None):
+    """
+    Render the full report like render_report, yielding the header right away and
+    then each encounter as it arrives.
+
+    :param sections: Async generator of (encounter, encounter_records), e.g. AsyncPatient.stream_encounters().
+                     It is closed when the report is, also when the report is not read to the end.
+    """
+    async with contextlib.aclosing(sections):
+        yield "\n".join([*render_header(p), encounters_heading(since, scope)])
+        empty = True
+        async for encounter, encounter_records in sections:
+            empty = False
+            yield "\n" + "\n".join(render_encounter(encounter, encounter_records))
+    if empty:
+        for line in render_no_encounters(since, scope):
+            yield "\n" + line
+
+
+def observation_series(observations: list[patient.Observation]) -> list[dict]:
+    """
+    Collapse the observations into one series per display.
+
+    The observation components are flattened into arrays once and the aggregates
+    of all the series are computed with grouped numpy operations.
+
+    :return: Series ordered by the latest observation, most recent first. Example:
+        [{"display": "Body Weight", "unit": "kg", "count": 12, "latest": 81.2, "latest_date": ...,
+          "min": 78.0, "max": 84.5, "trend": "rising"}]
+    """
+    lengths = np.fromiter((len(observation.display) for observation in observations), dtype=np.int64, count=len(observations))
+    if lengths.sum() == 0:
+        return []
+    displays = list(itertools.chain.from_iterable(observation.display for observation in observations))
+    units = list(itertools.chain.from_iterable(observation.unit for observation in observations))
+    values = np.array([
+        np.nan if value is None else float(value)
+        for value in itertools.chain.from_iterable(observation.value for observation in observations)
+    ])
+    times = np.repeat(
+        np.array([observation.observation_date.timestamp() for observation in observations]),
+        lengths,
+    )
+
+    names, groups = np.unique(np.array(displays, dtype=object), return_inverse=True)
+    # Only numeric values take part in the aggregates
+    valid = ~np.isnan(values)
+    groups, values, times, positions = groups[valid], values[valid], times[valid], np.flatnonzero(valid)
+    if len(values) == 0:
+        return []
+
+    # Sort by series and time, each series becomes a contiguous segment
+    order = np.lexsort((times, groups))
+    groups, values, times, positions = groups[order], values[order], times[order], positions[order]
+    starts = np.flatnonzero(np.r_[True, groups[1:] != groups[:-1]])
+    ends = np.r_[starts[1:], len(groups)] - 1
+    count = np.diff(np.r_[starts, len(groups)])
+    minimum = np.minimum.reduceat(values, starts)
+    maximum = np.maximum.reduceat(values, starts)
+    mean = np.add.reduceat(values, starts) / count
+
+    # Least squares slope of each series over time, from the per-series sums
+    t = times - times[starts].repeat(count)
+    n = count.astype(float)
+    sum_t = np.add.reduceat(t, starts)
+    sum_v = np.add.reduceat(values, starts)
+    sum_tt = np.add.reduceat(t * t, starts)
+    sum_tv = np.add.reduceat(t * values, starts)
+    denominator = n * sum_tt - sum_t * sum_t
+    with np.errstate(divide="ignore", invalid="ignore"):
+        slope = np.where(denominator > 0, (n * sum_tv - sum_t * sum_v) / denominator, 0.0)
+        change = slope * (times[ends] - times[starts]) / np.maximum(np.abs(mean), np.finfo(float).eps)
+
+    series = []
+    for i in np.argsort(-times[ends], kind="stable"):
+        if count[i] < 3:
+            trend = None
+        elif change[i] > TREND_THRESHOLD:
+            trend = "rising"
+        elif change[i] < -TREND_THRESHOLD:
+            trend = "falling"
+        else:
+            trend = "stable"
+        series.append({
+            "display": names[groups[starts[i]]],
+            "unit": units[positions[ends[i]]],
+            "count": int(count[i]),
+            "latest": float(values[ends[i]]),
+            "latest_date": datetime.datetime.fromtimestamp(times[ends[i]], datetime.timezone.utc),
+            "min": float(minimum[i]),
+            "max": float(maximum[i]),
+            "trend": trend,
+        })
+    return series
+
+
+def render_observation_series(series: dict) -> str:
+    unit = f" {series['unit']}" if series['unit'] else ""
+    line = f"- {series['display']}: latest {series['latest']:g}{unit} ({series['latest_date'].date()})"
+    if series['count'] > 1:
+        line += f", min {series['min']:g}, max {series['max']:g}"
+    if series['trend'] is not None:
+        line += f", {series['trend']}"
+    return line + f", {series['count']} measurement{'s' if series['count'] > 1 else ''}"
+
+
+def summarize_encounters(encounters: list[patient.Encounter], records: dict[str, dict[str, list[tuple]]]) -> list[str]:
+    """
+    Summarize the encounters in a few lines: number of encounters per type and the
+    distinct conditions, procedures, medications and immunizations.
+    """
+    if not encounters:
+        return []
+    types = collections.Counter(f"{encounter.class_.capitalize()} - {encounter.type}" for encounter in encounters)
+    distinct = {name: {} for name in ("conditions", "procedures", "medications", "immunizations")}
+    for encounter in encounters:
+        encounter_records = records.get(encounter.id, {})
+        for condition in encounter_records.get('conditions', []):
+            distinct["conditions"][condition.code_display] = None
+        for procedure in encounter_records.get('procedures', []):
+            distinct["procedures"][procedure.code_display] = None
+        for medication in encounter_records.get('medications', []):
+            distinct["medications"][medication.medication_display] = None
+        for immunization in encounter_records.get('immunizations', []):
+            distinct["immunizations"][immunization.vaccine_display] = None
+    first = encounters[0].period_start.date()
+    last = encounters[-1].period_start.date()
+    summary = [
+        f"{len(encounters)} encounters from {first} to {last}: "
+        + ", ".join(f"{name} ({count})" for name, count in types.most_common()),
+    ]
+    for name, title in (("conditions", "Conditions"), ("procedures", "Procedures"),
+                        ("medications", "Medications"), ("immunizations", "Immunizations")):
+        if distinct[name]:
+            summary.append(f"- **{title}:** {', '.join(distinct[name])}")
+    return summary
+
+
+def _fit_lines(lines: list[str], max_chars: int) -> list[str]:
+    """
+    Return the leading lines which fit in max_chars, including the newlines.
+    """
+    size = 0
+    for i, line in enumerate(lines):
+        size += len(line) + 1
+        if size > max_chars:
+            return lines[:i]
+    return lines
+
+
+def render_budgeted_report(p: patient.PatientRecords, encounters: list[patient.Encounter], records: dict[str, dict[str, list[tuple]]],
+                           max_chars: int, since: str | None = None, scope: str | None = None) -> str:
+    """
+    Render the report of the patient encounters in at most max_chars characters.
+
+    - Observations are collapsed into one line per observation display with the
+      latest value, min, max, trend and the number of measurements.
+    - The most recent encounters are rendered in full, without the observations,
+      as long as they fit in the budget.
+    - Older encounters are summarized with the number of encounters per type and
+      the distinct conditions, procedures, medications and immunizations.
+
+    :param max_chars: Size budget of the report.
+    :param since: The encounters are only the ones new since this, e.g. "the previous report".
+    :param scope: The encounters and records are only the selected ones, from describe_scope().
+    """
+    header = render_header(p)
+    budget = max_chars - sum(len(line) + 1 for line in header)
+
+    observations = [
+        observation
+        for encounter in encounters
+        for observation in records.get(encounter.id, {}).get('observations', [])
+    ]
+    trends = [render_observation_series(series) for series in observation_series(observations)]
+    if trends:
+        # The trends get at most half of the budget, the most recently measured first
+        trends = _fit_lines(["## Observations" if since is None else f"## New observations since {since}", *trends], budget // 2 - 1)
+        trends = [*trends, ""] if len(trends) > 1 else []
+        budget -= sum(len(line) + 1 for line in trends)
+
+    heading = encounters_heading(since, scope)
+    budget -= len(heading) + 1
+    # Reserve a part of the budget for the summary of the older encounters
+    rendered = [render_encounter(encounter, records.get(encounter.id, {}), observations=False) for encounter in encounters]
+    reserve = 0
+    if sum(len(line) + 1 for lines in rendered for line in lines) > budget:
+        reserve = budget // 5
+        budget -= reserve
+    recent = []
+    for lines in reversed(rendered):
+        size = sum(len(line) + 1 for line in lines)
+        if size > budget:
+            break
+        recent.insert(0, lines)
+        budget -= size
+    older = encounters[:len(encounters) - len(recent)]
+    summary = []
+    if older:
+        summary = _fit_lines(["## Earlier encounters", *summarize_encounters(older, records), ""], max(budget + reserve, 0))
+        summary = summary if len(summary) > 1 else []
+
+    report = [*header, *trends, *summary]
+    report.append(heading.replace("## Medical", "## Recent medical") if summary else heading)
+    if not encounters:
+        report.extend(render_no_encounters(since, scope))
+    for lines in recent:
+        report.extend(lines)
+    return "\n".join(_fit_lines(report, max_chars))
@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+
+"""
+Cache of rendered patient reports.
+
+Reports are cached per patient and report options together with the data version
+of the patient. The indexer bumps the version whenever it writes rows of the
+patient, so a cached report is only used while the patient data is unchanged.
+
+The cache has a bounded in-memory LRU tier and an optional on-disk tier, which
+survives restarts and is shared by all the workers of the service.
+
+Author: Olli Puhakka
+"""
+import os
+import shutil
+import hashlib
+import threading
+import collections
+import logging
+
+logger = logging.getLogger(__file__)
+
+
+class ReportCache:
+
+    def __init__(self, max_entries: int, directory: str | None = None):
+        """
+        :param max_entries: Number of reports kept in memory.
+        :param directory: Directory of the on-disk tier, disabled if None.
+        """
+        self.max_entries = max_entries
+        self.directory = directory
+        self._entries = collections.OrderedDict()  # (patient_id, options) -> (version, report)
+        self._lock = threading.Lock()
+        self.stats = collections.Counter(hits=0, disk_hits=0, misses=0, evictions=0, invalidations=0)
+
+    def _path(self, patient_id: str, options: tuple, version: int) -> str:
+        key = hashlib.sha256(repr(options).encode()).hexdigest()[:16]
+        return os.path.join(self.directory, patient_id, f"{key}-{version}.md")
+
+    def get(self, patient_id: str, version: int, options: tuple = ()) -> str | None:
+        """
+        Return the cached report if it was rendered from the given data version.
+        """
+        key = (patient_id, options)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] == version:
+                self._entries.move_to_end(key)
+                self.stats["hits"] += 1
+                return entry[1]
+        if self.directory is not None:
+            try:
+                with open(self._path(patient_id, options, version), 'r') as f:
+                    report = f.read()
+            except (FileNotFoundError, NotADirectoryError):
+                pass
+            else:
+                self.stats["disk_hits"] += 1
+                self._put_memory(key, version, report)
+                return report
+        self.stats["misses"] += 1
+        return None
+
+    def put(self, patient_id: str, version: int, report: str, options: tuple = ()):
+        """
+        Cache the report rendered from the given data version.
+        """
+        self._put_memory((patient_id, options), version, report)
+        if self.directory is not None:
+            path = self._path(patient_id, options, version)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # Write atomically, other workers may be reading the same file
+            tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp_path, 'w') as f:
+                f.write(report)
+            os.replace(tmp_path, path)
+            # Remove the reports of older versions
+            prefix = os.path.basename(path).split("-")[0] + "-"
+            for filename in os.listdir(os.path.dirname(path)):
+                if filename.startswith(prefix) and filename.endswith(".md") and filename != os.path.basename(path):
+                    try:
+                        os.remove(os.path.join(os.path.dirname(path), filename))
+                    except FileNotFoundError:
+                        pass
+
+    def _put_memory(self, key: tuple, version: int, report: str):
+        with self._lock:
+            self._entries[key] = (version, report)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.stats["evictions"] += 1
+
+    def invalidate(self, patient_id: str):
+        """
+        Drop all the cached reports of the patient.
+        """
+        with self._lock:
+            for key in [key for key in self._entries if key[0] == patient_id]:
+                del self._entries[key]
+        if self.directory is not None:
+            shutil.rmtree(os.path.join(self.directory, patient_id), ignore_errors=True)
+        self.stats["invalidations"] += 1
+
+    def info(self) -> dict:
+        """
+        Return the cache counters and size.
+        """
+        with self._lock:
+            return {**self.stats, "entries": len(self._entries), "max_entries": self.max_entries}
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_cache() -> ReportCache:
+    """
+    Return the process wide report cache, creating it on first use.
+
+    Cache settings are read from the environment:
+    - REPORT_CACHE_SIZE: number of reports kept in memory (default 256)
+    - REPORT_CACHE_DIR: directory of the on-disk tier (default: disabled)
+    """
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = ReportCache(
+                max_entries = int(os.environ.get('REPORT_CACHE_SIZE', 256)),
+                directory   = os.environ.get('REPORT_CACHE_DIR') or None,
+            )
+        return _cache
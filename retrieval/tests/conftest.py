@@ -0,0 +1,78 @@
+"""
+Fixtures of the retrieval tests.
+
+The tests which index bundles need the database configured in the environment
+(POSTGRES_HOST etc., see .env.template) and are skipped without it. They index copies
+of the fixture bundle with fresh ids and delete the rows of their patients afterwards.
+
+Run from the retrieval directory:
+    python -m pytest tests
+"""
+
+import json
+import os
+import pathlib
+import re
+import sys
+import uuid
+
+import pytest
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent.parent))
+
+import database
+
+BUNDLE = pathlib.Path(__file__).resolve().parent / "data" / "bundle.json"
+UUID = re.compile(r"[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}")
+
+
+@pytest.fixture
+def bundle() -> dict:
+    """
+    Small bundle of one patient with one encounter and a resource of each supported type.
+    """
+    return json.loads(BUNDLE.read_text())
+
+
+@pytest.fixture
+def db() -> database.Database:
+    if not os.environ.get("POSTGRES_HOST"):
+        pytest.skip("No database configured")
+    db = database.Database()
+    try:
+        db.db_execute("SELECT 1 FROM ingested_resources LIMIT 1", ())
+    except Exception as e:
+        pytest.skip(f"Database not available: {e}")
+    return db
+
+
+@pytest.fixture
+def new_bundle(db):
+    """
+    Return copies of the fixture bundle with the ids replaced by fresh ones, the rows
+    of their patients are deleted after the test.
+    """
+    patient_ids = []
+
+    def copy() -> dict:
+        ids = {}
+        text = UUID.sub(lambda m: ids.setdefault(m.group(), str(uuid.uuid4())), BUNDLE.read_text())
+        data = json.loads(text)
+        patient_ids.append(data["entry"][0]["resource"]["id"])
+        return data
+
+    yield copy
+    if patient_ids:
+        tables = [table for table, in db.db_execute(
+            "SELECT table_name FROM information_schema.columns "
+            "WHERE table_schema = current_schema() AND column_name = 'patient_id' AND table_name NOT IN ('encounters') "
+            "AND table_name IN (SELECT table_name FROM information_schema.tables WHERE table_type = 'BASE TABLE' "
+            "AND table_schema = current_schema()) AND table_name NOT LIKE 'observations\\_%%'", ())]
+        # One statement, the foreign keys are checked at its end
+        deletes = [f"d{i} AS (DELETE FROM {table} WHERE patient_id = ANY(%(ids)s::uuid[]))" for i, table in enumerate(tables)]
+        db.db_execute(
+            f"WITH {', '.join(deletes)}, e AS (DELETE FROM encounters WHERE patient_id = ANY(%(ids)s::uuid[])) "
+            "DELETE FROM patients WHERE id = ANY(%(ids)s::uuid[])", {"ids": patient_ids})
+        if db.db_execute("SELECT to_regclass('observation_dates') IS NOT NULL", ())[0][0]:
+            # Dates of the partitioned observations, see database/partitioning/observations.sql
+            db.db_execute("DELETE FROM observation_dates d WHERE NOT EXISTS (SELECT 1 FROM observations o WHERE o.id = d.id)", ())
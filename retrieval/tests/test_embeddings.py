@@ -0,0 +1,57 @@
+"""
+Tests of the semantic search, against the database with a stand-in embedding model.
+"""
+
+import hashlib
+
+import numpy as np
+import pytest
+
+import embeddings
+import index_fhir
+
+
+class WordModel:
+    """
+    Embeds the texts as normalized bags of their words, deterministic and without downloads.
+    """
+
+    def encode(self, texts, normalize_embeddings=True, **kwargs):
+        vectors = np.zeros((len(texts), 384), dtype=np.float32)
+        for i, text in enumerate(texts):
+            for word in text.lower().replace(",", " ").replace(":", " ").split():
+                vectors[i, int(hashlib.md5(word.encode()).hexdigest(), 16) % 384] += 1
+            norm = np.linalg.norm(vectors[i])
+            vectors[i] /= norm if norm else 1
+        return vectors
+
+
+@pytest.fixture
+def model(monkeypatch):
+    # The cached embeddings are keyed by the model name, the real model never sees these
+    monkeypatch.setenv("EMBEDDING_MODEL", "tests/word-model")
+    monkeypatch.setattr(embeddings, "_model", WordModel())
+
+
+def test_filtered_search_returns_limit(db, new_bundle, model):
+    patient_ids = []
+    for _ in range(3):
+        data = new_bundle()
+        index_fhir.parse_fhir(data["entry"])
+        patient_ids.append(data["entry"][0]["resource"]["id"])
+    assert embeddings.index_records(patient_ids) == 3 * 6
+    # Enough records of another patient for the searches to use the HNSW index
+    db.db_execute(
+        "INSERT INTO record_embeddings (patient_id, resource_type, record_id, record_date, content, embedding) "
+        "SELECT %s, 'Condition', 'tests-' || i, now(), '', "
+        "(SELECT array_agg(random())::real[]::vector FROM generate_series(1, 384) WHERE i > 0) "
+        "FROM generate_series(1, 500) i", (patient_ids[0],))
+    db.db_execute("ANALYZE record_embeddings", ())
+
+    results = embeddings.search("Body Weight", patient_id=patient_ids[1], limit=5)
+    assert len(results) == 5
+    assert {str(result["patient_id"]) for result in results} == {patient_ids[1]}
+
+    results = embeddings.search("Aspirin", resource_types=["Observation"], limit=5)
+    assert len(results) == 5
+    assert {result["resourceType"] for result in results} == {"Observation"}
@@ -0,0 +1,84 @@
+"""
+Tests of the pure transform of the bundles into rows.
+"""
+
+import collections
+import datetime
+
+import pytest
+
+import fhir_transform
+
+
+def test_bundle_rows(bundle):
+    rows = fhir_transform.bundle_rows(bundle["entry"])
+    counts = {table: len(table_rows) for table, table_rows in rows.items() if table_rows}
+    assert counts == {
+        "patients": 1, "encounters": 1, "conditions": 1, "observations": 2, "procedures": 1,
+        "immunizations": 1, "care_plans": 1, "medication_requests": 1, "allergy_intolerances": 1,
+        # The DiagnosticReport is not stored, nor recorded in the ledger
+        "ingested_resources": 10,
+    }
+    for table, table_rows in rows.items():
+        for row in table_rows:
+            assert len(row) == len(fhir_transform.TABLE_COLUMNS[table])
+
+
+def test_bundle_rows_values(bundle):
+    rows = fhir_transform.bundle_rows(bundle["entry"])
+    patient_id = bundle["entry"][0]["resource"]["id"]
+    encounter = bundle["entry"][1]["resource"]
+    assert rows["patients"][0][0] == patient_id
+    observation = dict(zip(fhir_transform.TABLE_COLUMNS["observations"], rows["observations"][0]))
+    assert observation["patient_id"] == patient_id
+    assert observation["encounter_id"] == encounter["id"]
+    assert observation["observation_date"] == (
+        datetime.datetime.fromisoformat(encounter["period"]["start"]).replace(tzinfo=None) + fhir_transform.DATE_SHIFT)
+
+
+def test_ledger_rows(bundle):
+    rows = fhir_transform.bundle_rows(bundle["entry"])
+    ledger = {(resource_type, id): content_hash for resource_type, id, _, content_hash in rows["ingested_resources"]}
+    assert all(patient_id == rows["patients"][0][0] for _, _, patient_id, _ in rows["ingested_resources"])
+    for resource_type, table in (("Encounter", "encounters"), ("Observation", "observations")):
+        for row in rows[table]:
+            assert ledger[(resource_type, row[0])] == fhir_transform.row_hash(row)
+
+
+def test_row_hash():
+    row = ("id", datetime.datetime(2020, 1, 2), ["Body Weight"], [80.1], ["kg"])
+    assert fhir_transform.row_hash(row) == fhir_transform.row_hash(tuple(row))
+    assert len(fhir_transform.row_hash(row)) == 32
+    assert fhir_transform.row_hash(row) != fhir_transform.row_hash((*row[:3], [80.2], row[4]))
+
+
+def test_row_hash_of_changed_resource(bundle):
+    before = fhir_transform.bundle_rows(bundle["entry"])["ingested_resources"]
+    observation = next(item["resource"] for item in bundle["entry"] if item["resource"]["resourceType"] == "Observation")
+    observation["status"] = "amended"
+    after = fhir_transform.bundle_rows(bundle["entry"])["ingested_resources"]
+    changed = {row[1] for row in set(after) - set(before)}
+    assert changed == {observation["id"]}
+
+
+def test_error_row():
+    res = {"resourceType": "Observation", "id": "o1", "status": "final"}
+    row = fhir_transform.error_row(res, KeyError("code"), "p1")
+    assert row[:5] == ("p1", "Observation", "o1", "KeyError", "Missing 'code'")
+    assert row[5] == '{"resourceType": "Observation", "id": "o1", "status": "final"}'
+    assert fhir_transform.error_row("not a resource", ValueError(), None)[:5] == (None, None, None, "ValueError", "ValueError()")
+
+
+def test_bundle_rows_tolerant(bundle):
+    entry = [{"resource": {"resourceType": "Claim", "id": "c1"}}, *bundle["entry"],
+             {"resource": {"resourceType": "Observation", "id": "o1"}}]
+    with pytest.raises(Exception, match="Not handled: Claim"):
+        fhir_transform.bundle_rows(entry)
+    errors = collections.Counter()
+    rows = fhir_transform.bundle_rows(entry, tolerant=True, errors=errors)
+    assert errors == {"Claim/Exception": 1, "Observation/NotImplementedError": 1}
+    # The error before the Patient gets the patient of the bundle as well
+    patient_id = bundle["entry"][0]["resource"]["id"]
+    assert [row[:4] for row in rows["ingest_errors"]] == [
+        (patient_id, "Claim", "c1", "Exception"), (patient_id, "Observation", "o1", "NotImplementedError")]
+    assert len(rows["observations"]) == 2
@@ -0,0 +1,108 @@
+"""
+Tests of indexing bundles with the ingestion ledger, against the database.
+"""
+
+import json
+import uuid
+
+import pytest
+
+import fhir_transform
+import index_fhir
+
+
+def index(data: dict, bulk: bool, tolerant: bool = False) -> bool:
+    """
+    Index the bundle like index_fhir.py does, return False if it was skipped as unchanged.
+    """
+    content_hash = fhir_transform.bundle_hash(json.dumps(data).encode())
+    if index_fhir.bundle_indexed(content_hash):
+        return False
+    index_fhir.parse_fhir(data["entry"], bulk=bulk, tolerant=tolerant, bundle_hash=content_hash)
+    return True
+
+
+def observations(db, patient_id: str) -> dict:
+    return {id: value for id, value in db.db_execute(
+        "SELECT id::text, value::float8[] FROM observations WHERE patient_id = %s", (patient_id,))}
+
+
+def count(db, table: str, patient_id: str) -> int:
+    return db.db_execute(f"SELECT count(*) FROM {table} WHERE patient_id = %s", (patient_id,))[0][0]
+
+
+def data_version(db, patient_id: str) -> int:
+    return db.db_execute("SELECT data_version FROM patients WHERE id = %s", (patient_id,))[0][0]
+
+
+@pytest.mark.parametrize("bulk", [True, False], ids=["bulk", "row-by-row"])
+def test_unchanged_bundle_is_skipped(db, new_bundle, bulk):
+    data = new_bundle()
+    patient_id = data["entry"][0]["resource"]["id"]
+    assert index(data, bulk)
+    version = data_version(db, patient_id)
+    assert not index(data, bulk)
+    assert data_version(db, patient_id) == version
+    assert db.db_execute("SELECT count(*) FROM ingested_resources WHERE patient_id = %s", (patient_id,)) == [(10,)]
+
+
+@pytest.mark.parametrize("bulk", [True, False], ids=["bulk", "row-by-row"])
+def test_changed_resource_is_upserted(db, new_bundle, bulk):
+    data = new_bundle()
+    patient_id = data["entry"][0]["resource"]["id"]
+    assert index(data, bulk)
+    before = observations(db, patient_id)
+    version = data_version(db, patient_id)
+
+    observation = next(item["resource"] for item in data["entry"] if item["resource"]["resourceType"] == "Observation")
+    observation["valueQuantity"]["value"] = 12345.0
+    assert index(data, bulk)
+    after = observations(db, patient_id)
+    assert after == {**before, observation["id"]: [12345.0]}
+    assert data_version(db, patient_id) == version + 1
+    assert db.db_execute("SELECT count(*) FROM ingested_resources WHERE patient_id = %s", (patient_id,)) == [(10,)]
+
+
+@pytest.mark.parametrize("bulk", [True, False], ids=["bulk", "row-by-row"])
+def test_legacy_records_are_replaced(db, new_bundle, bulk):
+    data = new_bundle()
+    patient_id = data["entry"][0]["resource"]["id"]
+    assert index(data, bulk)
+    tables = [table for table, (_, column) in index_fhir.RESOURCE_KEYS.items() if column == "fhir_id"]
+    # Rows indexed before the ingestion ledger, without fhir_id nor ledger entries
+    for table in tables:
+        db.db_execute(f"UPDATE {table} SET fhir_id = NULL WHERE patient_id = %s", (patient_id,))
+    db.db_execute("DELETE FROM ingested_resources WHERE patient_id = %s", (patient_id,))
+    db.db_execute("DELETE FROM ingested_bundles WHERE patient_id = %s", (patient_id,))
+
+    assert index(data, bulk)
+    for table in tables:
+        assert db.db_execute(f"SELECT count(*), count(fhir_id) FROM {table} WHERE patient_id = %s", (patient_id,)) == [(1, 1)]
+
+
+@pytest.mark.parametrize("bulk", [True, False], ids=["bulk", "row-by-row"])
+def test_quarantined_resources_are_updated(db, new_bundle, bulk):
+    data = new_bundle()
+    patient_id = data["entry"][0]["resource"]["id"]
+    data["entry"].append({"resource": {"resourceType": "Claim", "id": str(uuid.uuid4())}})
+    assert index(data, bulk, tolerant=True)
+    assert count(db, "ingest_errors", patient_id) == 1
+
+    observation = next(item["resource"] for item in data["entry"] if item["resource"]["resourceType"] == "Observation")
+    observation["valueQuantity"]["value"] = 12345.0
+    assert index(data, bulk, tolerant=True)
+    assert count(db, "ingest_errors", patient_id) == 1
+
+
+def test_streamed_bundle_refreshes_summary_once(db, new_bundle, monkeypatch):
+    data = new_bundle()
+    patient_id = data["entry"][0]["resource"]["id"]
+    refreshed = []
+    refresh = index_fhir.refresh_patient_summaries
+    monkeypatch.setattr(index_fhir, "refresh_patient_summaries",
+                        lambda curs, patient_ids: refreshed.append(patient_ids) or refresh(curs, patient_ids))
+    patient = index_fhir.parse_fhir(data["entry"], max_buffered_rows=2)
+    assert sum(patient.written.values()) > 2
+    assert refreshed == [[patient_id]]
+    assert db.db_execute("SELECT s.data_version = p.data_version, s.encounter_count FROM patient_summary s "
+                         "JOIN patients p ON p.id = s.patient_id WHERE p.id = %s", (patient_id,)) == [(True, 1)]
@@ -0,0 +1,48 @@
+"""
+Tests of the streamed reports, against the database.
+"""
+
+import asyncio
+
+import pytest
+from starlette.requests import ClientDisconnect
+
+import async_database
+import index_fhir
+import main
+import patient
+import report
+
+
+@pytest.mark.parametrize("spec_version", ["2.0", "2.4"])
+def test_disconnect_releases_connection(db, new_bundle, spec_version):
+    data = new_bundle()
+    index_fhir.parse_fhir(data["entry"])
+    patient_id = data["entry"][0]["resource"]["id"]
+
+    async def stream() -> int:
+        p = patient.AsyncPatient(patient_id)
+        await p.load()
+        response = main.ClosingStreamingResponse(report.stream_report(p, p.stream_encounters()))
+
+        sent = []
+
+        async def send(message):
+            if message["type"] == "http.response.body":
+                sent.append(message)
+                if len(sent) == 2:
+                    # The client is gone while the encounters are read
+                    raise OSError("Connection reset")
+
+        async def receive():
+            await asyncio.sleep(60)
+
+        try:
+            with pytest.raises((OSError, ClientDisconnect)):
+                await response({"type": "http", "asgi": {"spec_version": spec_version}}, receive, send)
+            stats = (await async_database.get_pool()).get_stats()
+            return stats.get("pool_size", 0) - stats.get("pool_available", 0)
+        finally:
+            await async_database.close_pool()
+
+    assert asyncio.run(stream()) == 0
@@ -1,7 +1,10 @@
 import os
 import sys
-import requests
+import json
+import asyncio
 import logging
+from collections import OrderedDict
+import aiohttp
 from pydantic import BaseModel, Field
 from datetime import datetime
 from open_webui.env import GLOBAL_LOG_LEVEL
@@ -12,9 +15,84 @@ log = logging.getLogger(__name__)
 log.setLevel(GLOBAL_LOG_LEVEL)
 
 
+# HTTP client shared by the tool calls, keeps the connections to the retrieval service alive
+_session: aiohttp.ClientSession | None = None
+# Responses with an ETag per (user, url, params): (etag, body, headers), least recently used first
+_responses: OrderedDict = OrderedDict()
+# Headers of the responses the tool uses
+RESPONSE_HEADERS = ("X-Report-Version",)
+
+
+def get_session() -> aiohttp.ClientSession:
+    """Return the shared HTTP client session, creating it on first use."""
+    global _session
+    if _session is None or _session.closed:
+        _session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=32, keepalive_timeout=60),
+            raise_for_status=False,
+        )
+    return _session
+
+
+def format_summary(summary: dict) -> str:
+    """Format the patient summary from the retrieval service as markdown."""
+    lines = [
+        f"Patient is {summary['age']} year old {summary['gender']}.",
+        f"**Date of Birth:** {summary['date_of_birth']}",
+    ]
+    encounters = summary["encounters"]
+    if encounters["count"]:
+        lines.append(
+            f"**Encounters:** {encounters['count']} between {encounters['first'][:10]} and {encounters['last'][:10]}"
+        )
+    conditions = [condition["display"] for condition in summary["active_conditions"]]
+    if conditions:
+        lines.append(f"**Active conditions:** {', '.join(conditions)}")
+    medications = [
+        medication["display"]
+        + (f" ({medication['dosage_instruction']})" if medication["dosage_instruction"] else "")
+        for medication in summary["active_medications"]
+    ]
+    if medications:
+        lines.append(f"**Current medications:** {', '.join(medications)}")
+    for category, allergies in summary["allergies"].items():
+        lines.append(f"**Allergies ({category}):** {', '.join(allergies)}")
+    if summary["latest_observations"]:
+        lines.append("**Latest observations:**")
+    for observation in summary["latest_observations"]:
+        unit = f" {observation['unit']}" if observation["unit"] else ""
+        lines.append(
+            f"- {observation['display']}: {observation['value']}{unit} ({observation['date'][:10]})"
+        )
+    return "\n".join(lines)
+
+
 class Tools:
     class Valves(BaseModel):
-        pass
+        incremental_reports: bool = Field(
+            default=True,
+            description="Only fetch the encounters added since the records were last fetched in the same chat.",
+        )
+        retrieval_url: str = Field(
+            default="http://retrieval:8000",
+            description="Base URL of the retrieval service.",
+        )
+        connect_timeout: float = Field(
+            default=5.0,
+            description="Seconds to wait for a connection to the retrieval service.",
+        )
+        read_timeout: float = Field(
+            default=60.0,
+            description="Seconds to wait for data from the retrieval service.",
+        )
+        retries: int = Field(
+            default=2,
+            description="Times a request is retried after a connection error, a timeout or a server error.",
+        )
+        cache_size: int = Field(
+            default=64,
+            description="Number of responses cached and revalidated with their ETag, 0 disables the cache.",
+        )
 
     class UserValves(BaseModel):
         pass
@@ -22,10 +100,102 @@ class Tools:
     def __init__(self):
         self.valves = self.Valves()
 
+    async def fetch(self, path: str, user_id: str, params: dict | None = None) -> tuple[str, dict]:
+        """Get a path of the retrieval service.
+
+        The request is retried with a backoff after connection errors, timeouts and
+        server errors. Responses with an ETag are cached per user and revalidated with
+        If-None-Match, a 304 Not Modified response returns the cached body.
+        :return: The body and the headers in RESPONSE_HEADERS of the response
+        """
+        url = self.valves.retrieval_url.rstrip("/") + path
+        params = params or {}
+        key = (user_id, url, tuple(sorted(params.items())))
+        cached = _responses.get(key)
+        request_headers = {"If-None-Match": cached[0]} if cached is not None else {}
+        timeout = aiohttp.ClientTimeout(
+            sock_connect=self.valves.connect_timeout, sock_read=self.valves.read_timeout
+        )
+        for attempt in range(self.valves.retries + 1):
+            try:
+                async with get_session().get(
+                    url, params=params, headers=request_headers, timeout=timeout
+                ) as response:
+                    if response.status == 304 and cached is not None:
+                        _responses.move_to_end(key)
+                        headers = {name: response.headers[name] for name in RESPONSE_HEADERS if name in response.headers}
+                        return cached[1], {**cached[2], **headers}
+                    if response.status < 500 or attempt == self.valves.retries:
+                        response.raise_for_status()
+                        body = await response.text()
+                        headers = {name: response.headers[name] for name in RESPONSE_HEADERS if name in response.headers}
+                        etag = response.headers.get("ETag")
+                        if etag is not None and self.valves.cache_size > 0:
+                            _responses[key] = (etag, body, headers)
+                            _responses.move_to_end(key)
+                            while len(_responses) > self.valves.cache_size:
+                                _responses.popitem(last=False)
+                        return body, headers
+                    log.warning(f"Retrieval service returned {response.status} for {path}, retrying.")
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                if attempt == self.valves.retries:
+                    raise
+                log.warning(f"Request to the retrieval service failed ({e!r}), retrying.")
+            await asyncio.sleep(0.5 * 2**attempt)
+
     # Add your custom tools using pure Python code here, make sure to add type hints
     # Use Sphinx-style docstrings to document your tools, they will be used for generating tools specifications
     # Please refer to function_calling_filter_pipeline.py file from pipelines project for an example
 
+    async def get_user_medical_summary(
+        self,
+        __user__: dict = {},
+        __event_emitter__=None,
+        __metadata__=None,
+    ) -> str:
+        """Get a short summary of the user's medical records: active conditions, current medications, allergies and latest observations. Use this first, and fetch the full medical records only if the summary is not enough.
+        :return: The summary of the medical records in markdown format
+        """
+        log.info("Agent fetched medical summary.")
+        # Called outside of a chat there is no metadata
+        chat_id = (__metadata__ or {}).get("chat_id")
+        chat = Chats.get_chat_by_id(chat_id) if chat_id else None
+        chat = chat.chat if chat is not None else {}
+        history = chat.get("history", {})
+        messages = history.get("messages", {})
+        message_id = (__metadata__ or {}).get("message_id")
+        message = messages.get(message_id, {})
+        status_history = message.get("statusHistory", [])
+        status_history = [
+            item["description"] for item in status_history if "description" in item
+        ]
+
+        patient_id = __user__["name"]
+        try:
+            body, _ = await self.fetch(f"/patient/{patient_id}/summary", __user__.get("id", patient_id))
+            summary = json.loads(body)
+            if "error" in summary:
+                raise ValueError(summary["error"])
+            status_history.append("Got health summary")
+            description = " | ".join(status_history)
+            await __event_emitter__(
+                {
+                    "type": "status",
+                    "data": {"description": description, "done": True},
+                }
+            )
+            return format_summary(summary)
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+            status_history.append("No health summary")
+            description = " ".join(status_history)
+            await __event_emitter__(
+                {
+                    "type": "status",
+                    "data": {"description": description, "done": True},
+                }
+            )
+            return f"Error fetching health summary: {str(e)}"
+
     async def get_user_medical_records(
         self,
         __user__: dict = {},
@@ -36,12 +206,14 @@ class Tools:
         :return: The official medical records in markdown format
         """
         log.info("Agent fetched medical records.")
-        chat = Chats.get_chat_by_id(__metadata__.get("chat_id"))
-        chat = chat.chat
+        # Called outside of a chat there is no metadata, nor earlier reports
+        chat_id = (__metadata__ or {}).get("chat_id")
+        chat = Chats.get_chat_by_id(chat_id) if chat_id else None
+        chat = chat.chat if chat is not None else {}
         history = chat.get("history", {})
         messages = history.get("messages", {})
-        message_id = __metadata__.get("message_id")
-        message = messages.get(message_id, [])
+        message_id = (__metadata__ or {}).get("message_id")
+        message = messages.get(message_id, {})
         status_history = message.get("statusHistory", [])
         status_history = [
             item["description"] for item in status_history if "description" in item
@@ -49,10 +221,23 @@ class Tools:
 
         log.info("Agent fetched medical records.")
         patient_id = __user__["name"]
-        base_url = f"http://retrieval:8000/patient/{patient_id}/report"
+        # Token of the report fetched earlier in this chat, the model has already seen it
+        params = {}
+        report_version = chat.get("medical_records_version", {}).get(patient_id)
+        if self.valves.incremental_reports and report_version is not None:
+            params["since_version"] = report_version
         try:
-            response = requests.get(base_url)
-            response.raise_for_status()  # Raise HTTPError for bad responses (4xx and 5xx)
+            body, headers = await self.fetch(
+                f"/patient/{patient_id}/report", __user__.get("id", patient_id), params
+            )
+            if chat_id and headers.get("X-Report-Version") is not None:
+                # The chat was read before the request, read it again so that the messages
+                # and versions saved meanwhile are kept, and only the version is changed
+                current = Chats.get_chat_by_id(chat_id)
+                if current is not None:
+                    current = current.chat
+                    versions = {**current.get("medical_records_version", {}), patient_id: headers["X-Report-Version"]}
+                    Chats.update_chat_by_id(chat_id, {**current, "medical_records_version": versions})
             status_history.append(f"Got health records")
             description = " | ".join(status_history)
             await __event_emitter__(
@@ -61,8 +246,8 @@ class Tools:
                     "data": {"description": description, "done": True},
                 }
             )
-            return response.text
-        except requests.RequestException as e:
+            return body
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
             status_history.append(f"No health records")
             description = " ".join(status_history)
             await __event_emitter__(